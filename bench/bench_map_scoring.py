@@ -0,0 +1,63 @@
+# Map result ingestion: one update_one per scored row (the naive shape) against a
+# single bulk_write for the whole batch. Scoring time and wire bytes are measured
+# offline; the writes are timed too when MONGO_URI points at a scratch server.
+#   python bench/bench_map_scoring.py [rows ...]
+import os
+import random
+import sys
+import time
+
+import bson
+from pymongo import MongoClient, UpdateOne
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+import main
+
+def sample_rows(n):
+    return [(bson.ObjectId(), i % main.TOURNAMENT_LOBBY_SIZE + 1, random.randint(0, 15)) for i in range(n)]
+
+def update_for(row, map_key):
+    tid, placement, kills, pp, kp = row
+    return ({"_id": tid, map_key: {"$exists": False}},
+            {"$inc": {"pp": pp, "kp": kp, "booyahs": int(placement == 1)}, "$set": {map_key: {"p": placement, "k": kills}}})
+
+def timed(fn, repeat=5):
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        best = min(best, time.perf_counter() - start)
+    return best * 1000
+
+def wire_bytes(scored):
+    # update command per row vs one update command carrying every statement
+    stmts = [{"q": q, "u": u} for q, u in (update_for(row, "maps.1") for row in scored)]
+    per_row = sum(len(bson.encode({"update": "tournament_teams", "updates": [s]})) for s in stmts)
+    return per_row, len(bson.encode({"update": "tournament_teams", "updates": stmts, "ordered": False}))
+
+def write_bench(col, rows):
+    col.delete_many({})
+    col.insert_many([{"_id": tid, "pp": 0, "kp": 0, "booyahs": 0, "maps": {}} for tid, _, _ in rows])
+    start = time.perf_counter()
+    for row in main.score_results(rows): col.update_one(*update_for(row, "maps.1"))
+    per_row = (time.perf_counter() - start) * 1000
+    start = time.perf_counter()
+    col.bulk_write([UpdateOne(*update_for(row, "maps.2")) for row in main.score_results(rows)], ordered=False)
+    return per_row, (time.perf_counter() - start) * 1000
+
+def main_bench(sizes):
+    col = MongoClient(os.getenv("MONGO_URI"))["bench"]["bench_map_scoring"] if os.getenv("MONGO_URI") else None
+    print(f"{'rows':>7}{'score ms':>10}{'round trips':>14}{'per-row B':>12}{'bulk B':>10}" + (f"{'update_one ms':>15}{'bulk ms':>10}" if col is not None else ""))
+    for n in sizes:
+        rows = sample_rows(n)
+        per_row_b, bulk_b = wire_bytes(main.score_results(rows))
+        line = f"{n:>7}{timed(lambda: main.score_results(rows)):>10.2f}{f'{n} -> 1':>14}{per_row_b:>12}{bulk_b:>10}"
+        if col is not None:
+            per_row, batch = write_bench(col, rows)
+            line += f"{per_row:>15.1f}{batch:>10.1f}"
+        print(line)
+    if col is not None: col.drop()
+    else: print("\nset MONGO_URI to a scratch server to time the writes as well")
+
+if __name__ == "__main__":
+    main_bench([int(a) for a in sys.argv[1:]] or [1000, 10000])
@@ -0,0 +1,68 @@
+# Bytes transferred and allocated per command for user reads, before and after
+# projection-aware get_user_data. Runs offline: documents are BSON-encoded locally.
+# The baseline is a current user doc, whose history is capped at HISTORY_RECENT,
+# so the savings are the projection's alone.
+#   python bench/bench_user_reads.py [history_entries]
+import os
+import sys
+import tracemalloc
+from datetime import datetime, timezone
+
+import bson
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+import main
+
+COMMANDS = {
+    "/status": main.FIELDS_BALANCE,
+    "/boostshop": main.FIELDS_BALANCE,
+    "/buy_boost": main.FIELDS_BALANCE,
+    "/challenge": main.FIELDS_BALANCE,
+    "/addtime": main.FIELDS_BALANCE,
+    "/leave": main.FIELDS_TEAM,
+    "/acceptjoin": main.FIELDS_TEAM,
+    "/jointeam": main.FIELDS_TEAM_BALANCE,
+    "/payteamrent": main.FIELDS_TEAM_BALANCE,
+    "/profile": main.FIELDS_PROFILE,
+}
+
+def sample_user(history_len):
+    doc = main.new_user_doc(986251574982606888)
+    doc.update(coins=4210, wins=history_len // 2, losses=history_len // 2, weekly_wins=7, streak=3, rank="Gold", team_id=bson.ObjectId())
+    doc["boosts"] = {"double_coins": True, "highlight": True}
+    ts = datetime.now(timezone.utc)
+    doc["history"] = [{"res": "W" if i % 2 else "L", "vs": 1458812527055212585, "s": "13-9", "t": ts} for i in range(history_len)]
+    return doc
+
+def project(doc, fields):
+    out = {"_id": doc["_id"]}
+    for f in fields:
+        if f in doc: out[f] = doc[f][-main.HISTORY_RECENT:] if f == "history" else doc[f]
+    return out
+
+def allocated(build):
+    tracemalloc.start()
+    obj = build()
+    size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del obj
+    return size
+
+def main_bench(history_len):
+    full = sample_user(history_len)
+    print(f"user doc with {history_len} history entries\n")
+    print(f"{'command':<14}{'before B':>10}{'after B':>10}{'saved':>8}{'before alloc':>14}{'after alloc':>13}")
+    total_before = total_after = 0
+    for cmd, fields in COMMANDS.items():
+        projected = project(full, fields)
+        before = len(bson.encode(full))
+        after = len(bson.encode(projected))
+        alloc_before = allocated(lambda: bson.decode(bson.encode(full)))
+        alloc_after = allocated(lambda: main.UserRecord(bson.decode(bson.encode(projected)), fields))
+        total_before += before
+        total_after += after
+        print(f"{cmd:<14}{before:>10}{after:>10}{1 - after / before:>8.0%}{alloc_before:>14}{alloc_after:>13}")
+    print(f"\n{'total':<14}{total_before:>10}{total_after:>10}{1 - total_after / total_before:>8.0%}")
+
+if __name__ == "__main__":
+    main_bench(int(sys.argv[1]) if len(sys.argv) > 1 else main.HISTORY_RECENT)
@@ -0,0 +1,209 @@
+# Load test for the interaction hot paths. The real callbacks (challenge, the
+# accept button, winner, settlement, leaderboard, on_message) are driven with
+# stand-in Interaction/Guild/Member/Channel objects against mongomock, and each
+# one is reported as throughput, p50/p99 latency and DB ops per interaction.
+#   pip install -r bench/requirements.txt         (mongomock needs pymongo < 4.9)
+#   python bench/loadtest.py [users ...]          (default 1000 10000 100000)
+#   LOADTEST_CALLS=500 LOADTEST_CONCURRENCY=32 python bench/loadtest.py 10000
+# mongomock is in-process and not thread-safe, so the DB executor is cut to one
+# thread: absolute numbers are not what a real server gives, but DB ops per
+# interaction are exact and latency regressions in our own code show up.
+import asyncio
+import os
+import random
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import mongomock
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+import main
+
+CALLS = int(os.getenv("LOADTEST_CALLS", "500"))
+CONCURRENCY = int(os.getenv("LOADTEST_CONCURRENCY", "32"))
+GUILD_ID = 1_000_000_000_000_001
+CH_GENERAL = 1_000_000_000_000_002
+ADMIN_ID = main.ADMIN_IDS[0]
+USER_BASE = 2_000_000_000_000_000
+
+# 🗄️ MONGO STAND-IN
+# Every collection handle counts its calls into the current metrics span, the
+# same counter MongoMetrics fills from command events on a real server.
+class CountingCollection:
+    def __init__(self, col): self._col = col
+
+    def __getattr__(self, name):
+        attr = getattr(self._col, name)
+        if name.startswith("_") or not callable(attr): return attr
+        def call(*args, **kwargs):
+            span = main.current_span.get()
+            if span: span.db_ops += 1
+            return attr(*args, **kwargs)
+        return call
+
+class CountingDatabase:
+    def __init__(self, db):
+        self._db = db
+        self._cols = {}
+
+    def __getitem__(self, name):
+        if name not in self._cols: self._cols[name] = CountingCollection(self._db[name])
+        return self._cols[name]
+
+class NoSession:
+    # mongomock has no sessions: the transaction body runs directly, as on a standalone server.
+    def __enter__(self): return self
+    def __exit__(self, *exc): return False
+    def with_transaction(self, fn): return fn(None)
+
+class MockClient(mongomock.MongoClient):
+    def start_session(self, **kwargs): return NoSession()
+
+def use_mongomock():
+    main.mongo_client = MockClient()
+    main.db = CountingDatabase(main.mongo_client[main.DB_NAME])
+    main.db_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="mongomock")
+
+# 🎭 DISCORD STAND-INS
+class FakeRole:
+    def __init__(self, rid, name):
+        self.id, self.name = rid, name
+    mention = property(lambda self: f"<@&{self.id}>")
+
+class FakeMember:
+    bot = False
+    def __init__(self, uid, guild):
+        self.id, self.name, self.guild, self.roles = uid, f"user{uid}", guild, []
+    mention = property(lambda self: f"<@{self.id}>")
+    def __hash__(self): return hash(self.id)
+    def __eq__(self, other): return getattr(other, "id", None) == self.id
+    async def add_roles(self, *roles): self.roles.extend(roles)
+
+class FakeMessage:
+    def __init__(self, mid, channel, author=None, content=""):
+        self.id, self.channel, self.author, self.content = mid, channel, author, content
+        self.guild = channel.guild
+    async def delete(self): pass
+    async def add_reaction(self, emoji): pass
+    async def edit(self, **kwargs): pass
+
+class FakeChannel:
+    category = None
+    def __init__(self, cid, name, guild):
+        self.id, self.name, self.guild, self.overwrites = cid, name, guild, {}
+    mention = property(lambda self: f"<#{self.id}>")
+    async def send(self, content=None, **kwargs): return FakeMessage(self.guild.next_id(), self, content=content)
+    async def edit(self, **kwargs):
+        if "name" in kwargs: self.name = kwargs["name"]
+        if "overwrites" in kwargs: self.overwrites = kwargs["overwrites"]
+    async def delete(self): self.guild.channels.pop(self.id, None)
+    async def purge(self, **kwargs): return []
+    async def set_permissions(self, target, **kwargs): pass
+
+class FakeGuild:
+    def __init__(self, gid):
+        self.id, self.roles, self.members, self.channels = gid, [], {}, {}
+        self._ids = iter(range(3_000_000_000_000_000, 4_000_000_000_000_000))
+        self.default_role = FakeRole(gid, "@everyone")
+        self.me = FakeMember(USER_BASE - 1, self)
+        conf = main.cfg(self)
+        for cid, name in ((conf.ff_bet, "ff-bet"), (conf.weekly_lb, "weekly-lb"), (CH_GENERAL, "general")): self.channels[cid] = FakeChannel(cid, name, self)
+    def next_id(self): return next(self._ids)
+    def get_member(self, uid):
+        member = self.members.get(uid)
+        if member is None: member = self.members[uid] = FakeMember(uid, self)
+        return member
+    def get_channel(self, cid): return self.channels.get(cid)
+    def get_role(self, rid): return None
+    async def create_text_channel(self, name, category=None, overwrites=None):
+        channel = FakeChannel(self.next_id(), name, self)
+        channel.overwrites = overwrites or {}
+        self.channels[channel.id] = channel
+        return channel
+
+class FakeResponse:
+    def __init__(self): self.sent, self._done = [], False
+    def is_done(self): return self._done
+    async def send_message(self, content=None, **kwargs):
+        self.sent.append((content, kwargs))
+        self._done = True
+    async def defer(self, **kwargs): self._done = True
+    async def edit_message(self, **kwargs): self._done = True
+
+class FakeFollowup:
+    async def send(self, content=None, **kwargs): pass
+
+class FakeInteraction:
+    def __init__(self, user, channel):
+        self.user, self.channel, self.guild = user, channel, channel.guild
+        self.response, self.followup = FakeResponse(), FakeFollowup()
+
+# 🌱 SEEDING
+def seed(n):
+    use_mongomock()
+    main.user_cache.clear()
+    main.router.vouch, main.router.matches = {}, {}
+    main.db["users"].insert_many([{**main.new_user_doc(USER_BASE + i), "coins": 1_000_000, "weekly_wins": random.randint(1, 5) if i % 10 == 0 else 0} for i in range(n)])
+
+def random_pairs(n, k):
+    ids = random.sample(range(USER_BASE, USER_BASE + n), min(n, 2 * k))
+    return list(zip(ids[::2], ids[1::2]))
+
+# ⏱️ MEASUREMENT
+def pct(sorted_values, q): return sorted_values[min(len(sorted_values) - 1, int(q * len(sorted_values)))]
+
+async def measure(calls):
+    latencies, ops, sem = [], [], asyncio.Semaphore(CONCURRENCY)
+    async def one(call):
+        async with sem:
+            span, start = main.Span(), time.perf_counter()
+            token = main.current_span.set(span)
+            try: await call()
+            finally: main.current_span.reset(token)
+            latencies.append(time.perf_counter() - start)
+            ops.append(span.db_ops)
+    start = time.perf_counter()
+    await asyncio.gather(*(one(c) for c in calls))
+    wall = time.perf_counter() - start
+    latencies.sort()
+    return len(calls) / wall, pct(latencies, 0.5) * 1000, pct(latencies, 0.99) * 1000, sum(ops) / len(ops)
+
+async def run_size(n):
+    seed(n)
+    await main.weekly_board.rebuild()
+    guild = FakeGuild(GUILD_ID)
+    main.cfg(guild).admins = [ADMIN_ID]
+    conf, results = main.cfg(guild), {}
+    bet, lb, general = guild.get_channel(conf.ff_bet), guild.get_channel(conf.weekly_lb), guild.get_channel(CH_GENERAL)
+    pairs = random_pairs(n, CALLS)
+    admin = guild.get_member(ADMIN_ID)
+
+    challenges = [FakeInteraction(guild.get_member(a), bet) for a, _ in pairs]
+    results["challenge"] = await measure([lambda i=i: main.challenge.callback(i, 100, "1v1") for i in challenges])
+    views = [i.response.sent[0][1]["view"] for i in challenges]
+
+    results["accept"] = await measure([lambda v=v, b=b: v.accept(FakeInteraction(guild.get_member(b), bet)) for v, (_, b) in zip(views, pairs)])
+    matches = list(main.db["matches"].find({"status": "playing"}))
+
+    results["winner"] = await measure([lambda m=m: main.winner.callback(FakeInteraction(admin, general), m["round_id"], guild.get_member(m["team_a"][0]), "13-7") for m in matches])
+    results["settle"] = await measure([lambda m=m: main.process_match_result(guild, m, m["team_a"][0], "13-7", ADMIN_ID, show_score=True) for m in matches])
+
+    results["leaderboard"] = await measure([lambda: main.leaderboard.callback(FakeInteraction(guild.get_member(random.randrange(USER_BASE, USER_BASE + n)), lb)) for _ in range(CALLS)])
+    results["on_message"] = await measure([lambda: main.on_message(FakeMessage(guild.next_id(), general, guild.get_member(random.randrange(USER_BASE, USER_BASE + n)), "gg")) for _ in range(CALLS)])
+    await main.coin_journal.flush()
+    return results
+
+async def main_bench(sizes):
+    # Prefix commands need a logged-in client; they are not what is measured here.
+    async def no_prefix_commands(message): pass
+    main.bot.process_commands = no_prefix_commands
+    # Every simulated user would trip the global buckets; measure the work behind the limiter instead.
+    main.rate_limiter.enabled = False
+    print(f"{'users':>7}  {'interaction':<12}{'ops/s':>9}{'p50 ms':>9}{'p99 ms':>9}{'db ops':>8}")
+    for n in sizes:
+        for name, (rate, p50, p99, ops) in (await run_size(n)).items():
+            print(f"{n:>7}  {name:<12}{rate:>9.0f}{p50:>9.2f}{p99:>9.2f}{ops:>8.1f}")
+
+if __name__ == "__main__":
+    asyncio.run(main_bench([int(a) for a in sys.argv[1:]] or [1000, 10000, 100000]))
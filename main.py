@@ -3,6 +3,8 @@ import os
 from discord import app_commands
 from discord.ext import commands, tasks
 import pymongo
+from pymongo import monitoring, UpdateOne, IndexModel, ReturnDocument, ASCENDING, DESCENDING
+from pymongo.errors import OperationFailure, DuplicateKeyError, BulkWriteError
 from bson import ObjectId
 from datetime import datetime, timedelta, timezone
 import asyncio
@@ -10,6 +12,24 @@ import re
 import traceback
 import random
 import string
+import csv
+import io
+import json
+import math
+import hashlib
+import functools
+import heapq
+import itertools
+import time
+import bisect
+import contextvars
+import logging
+import threading
+import signal
+import socket
+import uuid
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
 
 # =========================================
 # ⚙️ CONFIGURATION
@@ -19,6 +39,11 @@ TOKEN = os.getenv("TOKEN")
 MONGO_URI = os.getenv("MONGO_URI")
 
 DB_NAME = "enjoined_gaming_db"
+# REPLICAS > 1 or SHARD_IDS means other processes write the same data, so the
+# per-process caches below are disabled or refreshed from Mongo.
+MULTI_PROCESS = int(os.getenv("REPLICAS", "1")) > 1 or bool(os.getenv("SHARD_IDS"))
+# The guild the channel constants below belong to; found on READY when unset.
+HOME_GUILD_ID = int(os.getenv("HOME_GUILD_ID")) if os.getenv("HOME_GUILD_ID") else None
 ADMIN_IDS = [986251574982606888, 1458812527055212585]
 HELPER_ROLE_NAME = "Winner Results ⭐"
 HELPER_ROLE_ID = 1467388385508462739
@@ -41,13 +66,18 @@ CH_HELPER_LOG = 1467388385508462739
 # 📊 CONFIGS
 PLACEMENT_POINTS = {1: 12, 2: 9, 3: 8, 4: 7, 5: 6, 6: 5, 7: 4, 8: 3, 9: 2, 10: 1}
 KILL_POINT = 1
+TOURNAMENT_LOBBY_SIZE = 12
 TEAM_JOIN_COST = 100
 TEAM_CHANNEL_RENT = 500
 SYSTEM_FEE = 0.20
 MIN_ENTRY = 50
+MATCH_TIMEOUT = timedelta(hours=6)
 HELPER_REWARD = 10
 COST_ADD_USER = 100
 COST_ADD_TIME = 100
+HISTORY_RECENT = 10
+HISTORY_PAGE_SIZE = 10
+RANKS = {"Bronze": 0, "Silver": 10, "Gold": 25, "Platinum": 50, "Diamond": 100, "Heroic": 200}
 
 # ⚡ BOOSTS CONFIG
 BOOSTS = {
@@ -75,66 +105,1687 @@ PRICES = {
 
 EG_COND = """**EG cond:**\n• Respect everyone\n• Vouch after redeem\n• No abuse or spam\n• Follow admin instructions"""
 
+# =========================================
+# 📈 METRICS
+# =========================================
+
+# Latency histograms and counters kept in process. A span wraps each slash
+# command, view callback, task-loop iteration, deadline and job; Mongo commands
+# issued inside it (even from executor threads) are attributed to it, so a span
+# also reports its round trips and DB time. Exposed via /botstats, a Prometheus
+# text endpoint on METRICS_PORT and/or a periodic dump to METRICS_FILE.
+METRICS_PORT = int(os.getenv("METRICS_PORT", "0"))
+METRICS_FILE = os.getenv("METRICS_FILE")
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+class Histogram:
+    __slots__ = ("counts", "n", "total", "max")
+    def __init__(self):
+        self.counts = [0] * (len(LATENCY_BUCKETS) + 1)
+        self.n, self.total, self.max = 0, 0.0, 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(LATENCY_BUCKETS, value)] += 1
+        self.n += 1
+        self.total += value
+        if value > self.max: self.max = value
+
+    def quantile(self, q):
+        # Upper bound of the bucket holding the q-th observation.
+        rank, seen = q * self.n, 0
+        for bound, count in zip(LATENCY_BUCKETS + (self.max,), self.counts):
+            seen += count
+            if seen >= rank: return min(bound, self.max)
+        return self.max
+
+class Span:
+    __slots__ = ("db_ops", "db_time")
+    def __init__(self): self.db_ops, self.db_time = 0, 0.0
+
+current_span = contextvars.ContextVar("current_span", default=None)
+
+class Metrics:
+    def __init__(self):
+        self.histograms = {}
+        self.counters = {}
+        self.started = time.time()
+        # Mongo events arrive on executor threads.
+        self._lock = threading.Lock()
+
+    def observe(self, name, label, value):
+        with self._lock:
+            hist = self.histograms.get((name, label))
+            if hist is None: hist = self.histograms[(name, label)] = Histogram()
+            hist.observe(value)
+
+    def inc(self, name, label, n=1):
+        with self._lock: self.counters[(name, label)] = self.counters.get((name, label), 0) + n
+
+    def error(self, where, exc):
+        self.inc("errors_total", where)
+        print(f"⚠️ {where}: {type(exc).__name__}: {exc}")
+
+    async def span(self, kind, name, coro):
+        span, start = Span(), time.perf_counter()
+        token = current_span.set(span)
+        try: return await coro
+        finally:
+            current_span.reset(token)
+            self.observe(f"{kind}_seconds", name, time.perf_counter() - start)
+            self.observe(f"{kind}_db_seconds", name, span.db_time)
+            self.inc(f"{kind}_db_ops_total", name, span.db_ops)
+
+    def rows(self, name):
+        with self._lock: return sorted(((label, h) for (n, label), h in self.histograms.items() if n == name), key=lambda r: -r[1].total)
+
+    def counter_rows(self, name):
+        with self._lock: return sorted(((label, v) for (n, label), v in self.counters.items() if n == name), key=lambda r: -r[1])
+
+    def render(self):
+        out = []
+        with self._lock:
+            for (name, label), hist in sorted(self.histograms.items()):
+                seen = 0
+                for bound, count in zip(LATENCY_BUCKETS, hist.counts):
+                    seen += count
+                    out.append(f'eg_{name}_bucket{{name="{label}",le="{bound}"}} {seen}')
+                out.append(f'eg_{name}_bucket{{name="{label}",le="+Inf"}} {hist.n}')
+                out.append(f'eg_{name}_sum{{name="{label}"}} {hist.total:.6f}')
+                out.append(f'eg_{name}_count{{name="{label}"}} {hist.n}')
+            for (name, label), value in sorted(self.counters.items()): out.append(f'eg_{name}{{name="{label}"}} {value}')
+        return "\n".join(out) + "\n"
+
+metrics = Metrics()
+
+def instrumented(kind, name=None):
+    def wrap(fn):
+        label = name or fn.__name__
+        @functools.wraps(fn)
+        async def wrapper(*args, **kwargs): return await metrics.span(kind, label, fn(*args, **kwargs))
+        return wrapper
+    return wrap
+
+class MongoMetrics(monitoring.CommandListener):
+    def __init__(self): self._pending = {}
+
+    def started(self, event):
+        target = event.command.get(event.command_name)
+        self._pending[event.request_id] = (target if isinstance(target, str) else event.database_name, current_span.get())
+
+    def _finish(self, event, failed):
+        collection, span = self._pending.pop(event.request_id, (event.database_name, None))
+        seconds = event.duration_micros / 1e6
+        metrics.observe("mongo_seconds", f"{collection}.{event.command_name}", seconds)
+        if failed: metrics.inc("mongo_failures_total", f"{collection}.{event.command_name}")
+        if span:
+            span.db_ops += 1
+            span.db_time += seconds
+
+    def succeeded(self, event): self._finish(event, False)
+    def failed(self, event): self._finish(event, True)
+
+class RateLimitCounter(logging.Handler):
+    # discord.py logs every 429 it retries on the discord.http logger.
+    def emit(self, record):
+        if "rate limited" in record.getMessage():
+            args = record.args if isinstance(record.args, tuple) else ()
+            metrics.inc("rest_429_total", " ".join(re.sub(r"\d{15,}", "{id}", str(a)) for a in args[:2]) or "?")
+
+logging.getLogger("discord.http").addHandler(RateLimitCounter(logging.WARNING))
+
+def instrument_http(http):
+    request = http.request
+    async def timed_request(route, **kwargs):
+        start = time.perf_counter()
+        try: return await request(route, **kwargs)
+        finally:
+            metrics.observe("rest_seconds", f"{route.method} {route.path}", time.perf_counter() - start)
+    http.request = timed_request
+
+async def serve_metrics():
+    if METRICS_PORT:
+        from aiohttp import web
+        app = web.Application()
+        app.router.add_get("/metrics", lambda request: web.Response(text=metrics.render(), content_type="text/plain"))
+        runner = web.AppRunner(app)
+        await runner.setup()
+        await web.TCPSite(runner, "127.0.0.1", METRICS_PORT).start()
+        print(f"📈 Metrics on http://127.0.0.1:{METRICS_PORT}/metrics")
+    while METRICS_FILE:
+        await asyncio.sleep(60)
+        try:
+            with open(METRICS_FILE + ".tmp", "w") as f: f.write(metrics.render())
+            os.replace(METRICS_FILE + ".tmp", METRICS_FILE)
+        except OSError as e: metrics.error("metrics_dump", e)
+
 # =========================================
 # 🗄️ DATABASE
 # =========================================
 
-mongo_client = pymongo.MongoClient(MONGO_URI)
-db = mongo_client[DB_NAME]
-
-col_users = db["users"]
-col_channels = db["active_channels"]
-col_settings = db["settings"]
-col_requests = db["pending_requests"]
-col_tournaments = db["tournaments"]
-col_tournament_teams = db["tournament_teams"]
-col_teams = db["teams"]
-col_matches = db["matches"]
-col_codes = db["codes"]
-col_items = db["shop_items"]
-col_vouch = db["vouch_pending"]
-col_invites = db["invites_tracking"]
-col_giveaways = db["active_giveaways"]
-col_cleanup = db["cleanup_tasks"]
-
-if not col_settings.find_one({"_id": "config"}):
-    col_settings.insert_one({"_id": "config", "panic": False, "locked": False})
+# The client is built by connect_db() from setup_hook, not at import: resolving a
+# mongodb+srv URI is blocking DNS, and nothing needs the database before login.
+mongo_client = None
+db = None
+
+# All pymongo calls run on a bounded thread pool so a slow round trip never
+# stalls the gateway loop. Handlers only ever touch the async wrappers below.
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "8"))
+db_executor = ThreadPoolExecutor(max_workers=DB_POOL_SIZE, thread_name_prefix="mongo")
+
+async def run_db(fn, *args, **kwargs):
+    loop = asyncio.get_running_loop()
+    # Carry the context over so Mongo events on the worker thread find the current span.
+    return await loop.run_in_executor(db_executor, contextvars.copy_context().run, functools.partial(fn, *args, **kwargs))
+
+def _connect_sync():
+    global mongo_client, db
+    if mongo_client is not None: return
+    mongo_client = pymongo.MongoClient(MONGO_URI, event_listeners=[MongoMetrics()])
+    db = mongo_client[DB_NAME]
+    # First round trip here, so the pool's sockets are warm before the gateway is.
+    mongo_client.admin.command("ping")
+
+async def connect_db(): await run_db(_connect_sync)
+
+class AsyncCollection:
+    def __init__(self, name):
+        self.name = name
+
+    @property
+    def sync(self): return db[self.name]
+
+    async def find_one(self, *args, **kwargs): return await run_db(self.sync.find_one, *args, **kwargs)
+    async def find(self, *args, **kwargs): return await run_db(lambda: list(self.sync.find(*args, **kwargs)))
+    async def count_documents(self, *args, **kwargs): return await run_db(self.sync.count_documents, *args, **kwargs)
+    async def aggregate(self, pipeline, **kwargs): return await run_db(lambda: list(self.sync.aggregate(pipeline, **kwargs)))
+    async def insert_one(self, *args, **kwargs): return await run_db(self.sync.insert_one, *args, **kwargs)
+    async def insert_many(self, *args, **kwargs): return await run_db(self.sync.insert_many, *args, **kwargs)
+    async def update_one(self, *args, **kwargs): return await run_db(self.sync.update_one, *args, **kwargs)
+    async def update_many(self, *args, **kwargs): return await run_db(self.sync.update_many, *args, **kwargs)
+    async def delete_one(self, *args, **kwargs): return await run_db(self.sync.delete_one, *args, **kwargs)
+    async def delete_many(self, *args, **kwargs): return await run_db(self.sync.delete_many, *args, **kwargs)
+    async def find_one_and_update(self, *args, **kwargs): return await run_db(self.sync.find_one_and_update, *args, **kwargs)
+    async def find_one_and_delete(self, *args, **kwargs): return await run_db(self.sync.find_one_and_delete, *args, **kwargs)
+    async def bulk_write(self, *args, **kwargs): return await run_db(self.sync.bulk_write, *args, **kwargs)
+    async def create_indexes(self, *args, **kwargs): return await run_db(self.sync.create_indexes, *args, **kwargs)
+    async def explain(self, filter, sort=None): return await run_db(lambda: self.sync.find(filter, sort=sort).explain())
+
+# 👤 USER CACHE
+# Writes from another process can't invalidate this one's entries, so coin
+# balances could be served stale: with more than one process the cache is off.
+USER_CACHE_SIZE = 0 if MULTI_PROCESS else int(os.getenv("USER_CACHE_SIZE", "5000"))
+USER_CACHE_TTL = int(os.getenv("USER_CACHE_TTL", "60"))
+
+class UserCache:
+    # Entries are (doc, fields, expires_at); fields is None for a full document,
+    # otherwise the frozenset of projected fields the doc is known to hold.
+    def __init__(self, maxsize, ttl):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self._writing = {}
+        self.version = 0
+        self.hits = self.misses = self.evictions = 0
+
+    def __contains__(self, uid): return uid in self._data
+
+    def get(self, uid, fields=None):
+        entry = self._data.get(uid)
+        if entry and entry[2] > time.monotonic():
+            if entry[1] is None or (fields is not None and fields <= entry[1]):
+                self._data.move_to_end(uid)
+                self.hits += 1
+                return entry[0]
+        elif entry:
+            del self._data[uid]
+            self.evictions += 1
+        self.misses += 1
+        return None
+
+    def projection(self, uid):
+        entry = self._data.get(uid)
+        return sorted(entry[1]) if entry and entry[1] is not None else None
+
+    def put(self, uid, doc, version=None, fields=None):
+        # A read that raced with any write is dropped rather than cached stale.
+        if version is not None and version != self.version: return
+        now = time.monotonic()
+        old = self._data.get(uid)
+        if fields is not None and old and old[2] > now:
+            doc = {**old[0], **doc}
+            fields = None if old[1] is None else fields | old[1]
+        self._data[uid] = (doc, fields, now + self.ttl)
+        self._data.move_to_end(uid)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+            self.evictions += 1
+
+    def invalidate(self, *uids):
+        self.version += 1
+        for uid in uids: self._data.pop(uid, None)
+
+    def clear(self):
+        self.version += 1
+        self._data.clear()
+
+    def begin_write(self, uid):
+        self.version += 1
+        state = self._writing.get(uid)
+        if state: state[0] += 1; state[1] = True
+        else: self._writing[uid] = [1, False]
+
+    def end_write(self, uid, doc, fields=None):
+        # Overlapping writes to one user may return out of order, so only a lone write is cached.
+        state = self._writing[uid]
+        state[0] -= 1
+        if state[0] == 0: del self._writing[uid]
+        if state[1] or doc is None or state[0]: self.invalidate(uid)
+        else:
+            self._data.pop(uid, None)
+            self.put(uid, doc, fields=fields)
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {"size": len(self._data), "hits": self.hits, "misses": self.misses, "evictions": self.evictions, "hit_rate": self.hits / total if total else 0.0}
+
+user_cache = UserCache(USER_CACHE_SIZE, USER_CACHE_TTL)
+
+def _id_filter(filter):
+    if len(filter) == 1 and "_id" in filter and not isinstance(filter["_id"], dict): return filter["_id"]
+    return None
+
+class UserCollection(AsyncCollection):
+    async def find_one(self, filter, projection=None, *args, **kwargs):
+        uid = _id_filter(filter)
+        if uid is None or args or kwargs: return await super().find_one(filter, projection, *args, **kwargs)
+        fields = frozenset(projection) if projection else None
+        doc = user_cache.get(uid, fields)
+        if doc is not None: return doc
+        version = user_cache.version
+        doc = await super().find_one(filter, projection)
+        if doc is not None: user_cache.put(uid, doc, version, fields)
+        return doc
+
+    async def insert_one(self, doc, **kwargs):
+        result = await super().insert_one(doc, **kwargs)
+        user_cache.invalidate(doc["_id"])
+        user_cache.put(doc["_id"], doc)
+        return result
+
+    async def update_one(self, filter, update, **kwargs):
+        result = await super().update_one(filter, update, **kwargs)
+        uid = _id_filter(filter)
+        if uid is None: user_cache.clear()
+        else: user_cache.invalidate(uid)
+        return result
+
+    async def update_cached(self, filter, update, **kwargs):
+        # Write-through variant of update_one: returns the updated doc (None if no
+        # match) and refreshes the cache entry when the user is already cached.
+        uid = _id_filter(filter)
+        if uid is None or uid not in user_cache: return await self.find_one_and_update(filter, update, return_document=ReturnDocument.AFTER, **kwargs)
+        projection = user_cache.projection(uid)
+        user_cache.begin_write(uid)
+        doc = None
+        try: doc = await super().find_one_and_update(filter, update, projection, return_document=ReturnDocument.AFTER, **kwargs)
+        finally: user_cache.end_write(uid, doc, frozenset(projection) if projection else None)
+        return doc
+
+    async def update_many(self, filter, update, **kwargs):
+        result = await super().update_many(filter, update, **kwargs)
+        ids = filter.get("_id", {}).get("$in") if isinstance(filter.get("_id"), dict) else None
+        if ids is not None: user_cache.invalidate(*ids)
+        else: user_cache.clear()
+        return result
+
+    async def find_one_and_update(self, filter, update, **kwargs):
+        result = await super().find_one_and_update(filter, update, **kwargs)
+        uid = _id_filter(filter)
+        if uid is None: user_cache.clear()
+        else: user_cache.invalidate(uid)
+        return result
+
+    async def bulk_write(self, requests, **kwargs):
+        result = await super().bulk_write(requests, **kwargs)
+        user_cache.clear()
+        return result
+
+col_users = UserCollection("users")
+col_channels = AsyncCollection("active_channels")
+col_settings = AsyncCollection("settings")
+col_requests = AsyncCollection("pending_requests")
+col_tournaments = AsyncCollection("tournaments")
+col_tournament_teams = AsyncCollection("tournament_teams")
+col_teams = AsyncCollection("teams")
+col_matches = AsyncCollection("matches")
+col_codes = AsyncCollection("codes")
+col_items = AsyncCollection("shop_items")
+col_vouch = AsyncCollection("vouch_pending")
+col_invites = AsyncCollection("invites_tracking")
+col_giveaways = AsyncCollection("active_giveaways")
+col_cleanup = AsyncCollection("cleanup_tasks")
+col_seasons = AsyncCollection("weekly_seasons")
+col_history = AsyncCollection("match_history")
+col_pool = AsyncCollection("channel_pool")
+col_leases = AsyncCollection("leases")
+col_ledger = AsyncCollection("ledger")
+col_journal = AsyncCollection("coin_journal")
+col_snapshots = AsyncCollection("balance_snapshots")
+col_jobs = AsyncCollection("jobs")
+col_dead_jobs = AsyncCollection("dead_jobs")
+col_views = AsyncCollection("view_state")
+
+# 📇 INDEXES
+# TTL indexes keep a grace period past the deadline: the bot still handles every
+# expiry itself, the TTL monitor only sweeps documents it never got to.
+TTL_GRACE = 24 * 3600
+INDEX_MANIFEST = {
+    col_users: [IndexModel([("weekly_wins", DESCENDING)]), IndexModel([("team_id", ASCENDING)]), IndexModel([("escrow.m", ASCENDING)], sparse=True)],
+    col_vouch: [IndexModel([("channel_id", ASCENDING), ("user_id", ASCENDING)]), IndexModel([("start_time", ASCENDING)], expireAfterSeconds=TTL_GRACE)],
+    col_matches: [IndexModel([("channel_id", ASCENDING)]), IndexModel([("guild_id", ASCENDING), ("round_id", ASCENDING)]), IndexModel([("status", ASCENDING), ("opened_at", ASCENDING)]),
+                  IndexModel([("expires_at", ASCENDING)], sparse=True)],
+    col_channels: [IndexModel([("channel_id", ASCENDING)]), IndexModel([("end_time", ASCENDING)], expireAfterSeconds=TTL_GRACE)],
+    col_teams: [IndexModel([("name", ASCENDING)]), IndexModel([("rent_expiry", ASCENDING)])],
+    col_cleanup: [IndexModel([("delete_at", ASCENDING)], expireAfterSeconds=TTL_GRACE)],
+    col_requests: [IndexModel([("expires_at", ASCENDING)], expireAfterSeconds=TTL_GRACE)],
+    col_giveaways: [IndexModel([("end_time", ASCENDING)], expireAfterSeconds=TTL_GRACE)],
+    col_invites: [IndexModel([("valid", ASCENDING), ("joined_at", ASCENDING)]), IndexModel([("sweep", ASCENDING)], sparse=True)],
+    col_seasons: [IndexModel([("status", ASCENDING)])],
+    col_history: [IndexModel([("user_id", ASCENDING), ("t", DESCENDING)])],
+    col_pool: [IndexModel([("guild_id", ASCENDING), ("state", ASCENDING)])],
+    col_ledger: [IndexModel([("match_id", ASCENDING)]), IndexModel([("user_id", ASCENDING), ("t", DESCENDING)])],
+    col_journal: [IndexModel([("u", ASCENDING), ("t", ASCENDING)]), IndexModel([("t", ASCENDING)])],
+    col_snapshots: [IndexModel([("u", ASCENDING), ("t", DESCENDING)])],
+    col_jobs: [IndexModel([("state", ASCENDING), ("run_at", ASCENDING)]), IndexModel([("state", ASCENDING), ("locked_until", ASCENDING)])],
+    col_dead_jobs: [IndexModel([("failed_at", DESCENDING)])],
+    col_views: [IndexModel([("expires_at", ASCENDING)], expireAfterSeconds=0)],
+    col_tournaments: [IndexModel([("guild_id", ASCENDING), ("status", ASCENDING)])],
+    col_tournament_teams: [IndexModel([("tournament_id", ASCENDING), ("name_key", ASCENDING)], unique=True),
+                           IndexModel([("tournament_id", ASCENDING), ("members", ASCENDING)], unique=True)]
+}
+
+# (collection, filter, sort) for every query on a hot path; checked with explain() at startup.
+HOT_QUERIES = [
+    (col_vouch, {"channel_id": 0, "user_id": 0}, None),
+    (col_matches, {"channel_id": 0}, None),
+    (col_matches, {"guild_id": 0, "round_id": ""}, None),
+    (col_channels, {"channel_id": 0}, None),
+    (col_teams, {"name": ""}, None),
+    (col_users, {}, [("weekly_wins", -1)]),
+    (col_users, {"team_id": 0}, None),
+    (col_cleanup, {"delete_at": {"$lte": datetime.now(timezone.utc)}}, None),
+    (col_requests, {"expires_at": {"$lte": datetime.now(timezone.utc)}}, None),
+    (col_giveaways, {"end_time": {"$lte": datetime.now(timezone.utc)}}, None),
+    (col_matches, {"expires_at": {"$lte": datetime.now(timezone.utc)}}, None),
+    (col_teams, {"rent_expiry": {"$lte": datetime.now(timezone.utc)}}, None),
+    (col_channels, {"end_time": {"$lte": datetime.now(timezone.utc)}}, None),
+    (col_vouch, {"start_time": {"$lte": datetime.now(timezone.utc)}}, None),
+    (col_invites, {"valid": False, "joined_at": {"$lte": datetime.now(timezone.utc)}}, None),
+    (col_history, {"user_id": 0}, [("t", -1)]),
+    (col_users, {"escrow.m": {"$exists": True}}, None),
+    (col_matches, {"status": "opening", "opened_at": {"$lt": datetime.now(timezone.utc)}}, None),
+    (col_journal, {"u": 0, "t": {"$gt": datetime.now(timezone.utc)}}, [("t", 1)]),
+    (col_journal, {"t": {"$gt": datetime.now(timezone.utc)}}, None),
+    (col_snapshots, {"u": 0, "t": {"$lte": datetime.now(timezone.utc)}}, [("t", -1)]),
+    (col_jobs, {"state": "ready", "run_at": {"$lte": datetime.now(timezone.utc)}}, [("run_at", 1)]),
+    (col_tournament_teams, {"tournament_id": ""}, None)
+]
+
+def _plan_stages(plan):
+    yield plan.get("stage")
+    for key in ("inputStage", "queryPlan"):
+        if key in plan: yield from _plan_stages(plan[key])
+    for child in plan.get("inputStages", []): yield from _plan_stages(child)
+
+async def ensure_indexes():
+    async def apply(col, models):
+        try: await col.create_indexes(models)
+        except OperationFailure as e: print(f"⚠️ Index bootstrap failed on {col.name}: {e}")
+    await asyncio.gather(*(apply(col, models) for col, models in INDEX_MANIFEST.items()))
+
+    async def check(col, filter, sort):
+        try:
+            plan = (await col.explain(filter, sort))["queryPlanner"]["winningPlan"]
+            if "COLLSCAN" in _plan_stages(plan): return f"{col.name} {list(filter) or '{}'} sort={sort}"
+        except Exception as e: return f"{col.name} {list(filter)} (explain failed: {e})"
+    scans = [r for r in await asyncio.gather(*(check(*q) for q in HOT_QUERIES)) if r]
+    if scans: print("⚠️ Collection scans on hot paths:\n  " + "\n  ".join(scans))
+    else: print("✅ Indexes OK")
+
+def _run_transaction_sync(fn):
+    try:
+        with mongo_client.start_session() as session:
+            return session.with_transaction(fn)
+    except OperationFailure as e:
+        # Standalone servers (local dev) reject transactions before any write lands.
+        if e.code != 20: raise
+        return fn(None)
+
+async def run_transaction(fn): return await run_db(_run_transaction_sync, fn)
+
+async def ensure_settings():
+    await col_settings.update_one({"_id": "config"}, {"$setOnInsert": {"panic": False, "locked": False}}, upsert=True)
+
+# 🧾 COIN JOURNAL
+# Every coin change goes through change_coins() and leaves one compact journal
+# entry {u, d, r, ref, t}. Entries are buffered and written with insert_many
+# every JOURNAL_FLUSH seconds or JOURNAL_BATCH entries, whichever comes first.
+# Escrow and settlement write their entries inside their own transaction, so a
+# match's coins and its journal can't disagree after a crash.
+# Daily balance snapshots bound how much of the journal an audit has to replay.
+# Only users with journal entries since the last run get a new one, and past
+# SNAPSHOT_KEEP each user keeps just their newest, the base for older audits.
+JOURNAL_BATCH = int(os.getenv("JOURNAL_BATCH", "500"))
+JOURNAL_FLUSH = float(os.getenv("JOURNAL_FLUSH", "2"))
+SNAPSHOT_KEEP = timedelta(days=int(os.getenv("SNAPSHOT_KEEP_DAYS", "90")))
+
+def journal_entry(user_id, delta, reason, ref=None, key=None, t=None):
+    entry = {"u": user_id, "d": delta, "r": reason, "t": t or datetime.now(timezone.utc)}
+    if ref is not None: entry["ref"] = ref
+    # A natural key makes the entry idempotent when its source can be replayed.
+    if key is not None: entry["_id"] = key
+    return entry
+
+def record_journal_sync(entries, session=None):
+    try: col_journal.sync.insert_many(entries, ordered=False, session=session)
+    except BulkWriteError as e:
+        if any(err["code"] != 11000 for err in e.details["writeErrors"]): raise
+
+class CoinJournal:
+    def __init__(self):
+        # deque so settlement threads can append while the loop drains it.
+        self._buf = deque()
+        self._kick = None
+        self._task = None
+
+    def record(self, user_id, delta, reason, ref=None, key=None):
+        self._buf.append(journal_entry(user_id, delta, reason, ref, key))
+        if len(self._buf) >= JOURNAL_BATCH and self._kick: self._kick.set()
+
+    async def flush(self):
+        while self._buf:
+            batch = []
+            while self._buf and len(batch) < JOURNAL_BATCH: batch.append(self._buf.popleft())
+            try: await col_journal.insert_many(batch, ordered=False)
+            except BulkWriteError as e:
+                if any(err["code"] != 11000 for err in e.details["writeErrors"]): raise
+            except Exception:
+                self._buf.extendleft(reversed(batch))
+                raise
+
+    def start(self):
+        if self._task: return
+        self._kick = asyncio.Event()
+        self._task = asyncio.create_task(self._run())
+
+    async def _run(self):
+        while True:
+            try: await asyncio.wait_for(self._kick.wait(), JOURNAL_FLUSH)
+            except asyncio.TimeoutError: pass
+            self._kick.clear()
+            try: await self.flush()
+            except Exception: traceback.print_exc()
+
+coin_journal = CoinJournal()
+
+async def change_coins(user_id, delta, reason, ref=None, guard=False, extra=None, once=None):
+    # guard refuses a debit that would take the balance below zero; once is a token
+    # (e.g. a job id) that makes a retried change a no-op. Returns the new balance,
+    # or None when nothing was applied.
+    filter = {"_id": user_id}
+    if guard and delta < 0: filter["coins"] = {"$gte": -delta}
+    update = dict(extra or {})
+    update["$inc"] = {**update.get("$inc", {}), "coins": delta}
+    if once is not None:
+        filter["applied"] = {"$ne": once}
+        update["$push"] = {**update.get("$push", {}), "applied": {"$each": [once], "$slice": -20}}
+    doc = await col_users.find_one_and_update(filter, update, projection={"coins": 1}, return_document=ReturnDocument.AFTER)
+    if doc is None: return None
+    coin_journal.record(user_id, delta, reason, ref)
+    return doc["coins"]
+
+def snapshot_users_sync(user_ids, now):
+    users = list(col_users.sync.find({"_id": {"$in": user_ids}, "coins": {"$exists": True}}, {"coins": 1}))
+    if users: col_snapshots.sync.insert_many([{"u": u["_id"], "c": u["coins"], "t": now} for u in users])
+    kept, stale = set(), []
+    for snap in col_snapshots.sync.find({"u": {"$in": user_ids}, "t": {"$lt": now - SNAPSHOT_KEEP}}, {"u": 1}, sort=[("u", 1), ("t", -1)]):
+        if snap["u"] in kept: stale.append(snap["_id"])
+        else: kept.add(snap["u"])
+    if stale: col_snapshots.sync.delete_many({"_id": {"$in": stale}})
+    return len(users)
+
+def snapshot_balances_sync(since, now):
+    # The first run covers every balance; later ones only users whose balance could have moved.
+    if since is None: ids = (u["_id"] for u in col_users.sync.find({"coins": {"$exists": True}}, {"_id": 1}))
+    else: ids = (d["_id"] for d in col_journal.sync.aggregate([{"$match": {"t": {"$gt": since}}}, {"$group": {"_id": "$u"}}], allowDiskUse=True))
+    return sum(snapshot_users_sync(batch, now) for batch in iter(lambda: list(itertools.islice(ids, JOURNAL_BATCH)), []))
+
+async def snapshot_balances():
+    await coin_journal.flush()
+    now = datetime.now(timezone.utc)
+    last = await col_settings.find_one({"_id": "balance_snapshots"})
+    count = await run_db(snapshot_balances_sync, last["t"] if last else None, now)
+    await col_settings.update_one({"_id": "balance_snapshots"}, {"$set": {"t": now}}, upsert=True)
+    return count
+
+async def audit_balance(user_id, since):
+    # Replays the journal from the last snapshot before `since`; drift is what
+    # the stored balance differs from the replay (changes made outside the journal).
+    await coin_journal.flush()
+    snap = await col_snapshots.find({"u": user_id, "t": {"$lte": since}}, sort=[("t", -1)], limit=1)
+    base, base_t = (snap[0]["c"], snap[0]["t"]) if snap else (0, datetime.min.replace(tzinfo=timezone.utc))
+    entries = await col_journal.find({"u": user_id, "t": {"$gt": base_t}}, sort=[("t", 1)])
+    opening = base + sum(e["d"] for e in entries if as_utc(e["t"]) < since)
+    in_range = [e for e in entries if as_utc(e["t"]) >= since]
+    user = await col_users.find_one({"_id": user_id}, {"coins": 1}) or {}
+    replayed = opening + sum(e["d"] for e in in_range)
+    return {"opening": opening, "entries": in_range, "replayed": replayed, "actual": user.get("coins", 0), "drift": user.get("coins", 0) - replayed}
+
+# 🏠 GUILD SETTINGS
+# Per-guild channel/category/role IDs and admins, stored as "guild:<id>" docs in
+# settings and cached in memory. The module constants above are the defaults for
+# the home guild only; other guilds start with no channels until /setconfig.
+# With more than one process, /setconfig stamps the doc and every process reloads
+# the docs changed since its last look every SETTINGS_REFRESH seconds.
+SETTINGS_REFRESH = int(os.getenv("SETTINGS_REFRESH", "30"))
+GUILD_DEFAULTS = {
+    "welcome": CH_WELCOME, "find_team": CH_FIND_TEAM, "vouch_log": CH_VOUCH_LOG, "warnings": CH_WARNINGS,
+    "match_results": CH_MATCH_RESULTS, "ff_bet": CH_FF_BET, "mvp_highlights": CH_MVP_HIGHLIGHTS, "weekly_lb": CH_WEEKLY_LB,
+    "full_map_results": CH_FULL_MAP_RESULTS, "private_rooms": CAT_PRIVATE_ROOMS, "team_rooms": CAT_TEAM_ROOMS,
+    "code_use_log": CH_CODE_USE_LOG, "helper_log": CH_HELPER_LOG, "helper_role": HELPER_ROLE_ID, "admins": ADMIN_IDS
+}
+
+class GuildConfig:
+    __slots__ = ("guild_id",) + tuple(GUILD_DEFAULTS)
+    def __init__(self, guild_id, doc=None, home=False):
+        self.guild_id = guild_id
+        doc = doc or {}
+        for key, default in GUILD_DEFAULTS.items(): setattr(self, key, doc.get(key, default if home or key == "admins" else None))
+
+class GuildSettings:
+    def __init__(self):
+        self._cache = {}
+        self.home = HOME_GUILD_ID
+        self._checked = None
+
+    def _config(self, guild_id, doc=None): return GuildConfig(guild_id, doc, home=guild_id is not None and guild_id == self.home)
+
+    async def load(self, guild_ids):
+        docs = await col_settings.find({"_id": {"$in": [f"guild:{gid}" for gid in guild_ids]}})
+        found = {int(d["_id"].split(":", 1)[1]): d for d in docs}
+        for gid in guild_ids: self._cache[gid] = self._config(gid, found.get(gid))
+
+    async def refresh(self):
+        # One refresh interval of overlap covers clock skew between processes.
+        now = datetime.now(timezone.utc)
+        since, self._checked = (self._checked or now) - timedelta(seconds=SETTINGS_REFRESH), now
+        for doc in await col_settings.find({"_id": {"$regex": "^guild:"}, "updated_at": {"$gt": since}}):
+            gid = int(doc["_id"].split(":", 1)[1])
+            if gid in self._cache: self._cache[gid] = self._config(gid, doc)
+
+    def get(self, guild_id):
+        config = self._cache.get(guild_id)
+        if config is None: config = self._cache[guild_id] = self._config(guild_id)
+        return config
+
+    async def set(self, guild_id, key, value):
+        await col_settings.update_one({"_id": f"guild:{guild_id}"}, {"$set": {key: value, "updated_at": datetime.now(timezone.utc)}}, upsert=True)
+        setattr(self.get(guild_id), key, value)
+
+guild_settings = GuildSettings()
+
+def cfg(guild): return guild_settings.get(guild.id if guild else None)
+
+def channel_ref(channel_id): return f"<#{channel_id}>" if channel_id else "the configured channel (not set up yet, ask an admin to `/setconfig`)"
+
+# 🧭 CHANNEL ROUTING
+# Which channels have a pending vouch or a live match, so on_message can ignore
+# ordinary chat without touching the database. Vouch docs are written outside
+# this bot, so the index is topped up every VOUCH_REFRESH seconds from docs newer
+# than the last one seen; redeem channels are also looked up directly on a miss.
+VOUCH_REFRESH = int(os.getenv("VOUCH_REFRESH", "30"))
+VOUCH_CHANNEL_PREFIXES = ("redeem-", "buy-")
+
+class ChannelRouter:
+    def __init__(self):
+        self.vouch = {}
+        self.matches = {}
+        self._vouch_seen = None
+
+    async def load(self):
+        vouches, matches = await asyncio.gather(
+            col_vouch.find({}, {"channel_id": 1, "user_id": 1, "start_time": 1}),
+            col_matches.find({}, {"channel_id": 1, "status": 1})
+        )
+        self.vouch, self.matches, self._vouch_seen = {}, {}, None
+        self._index_vouches(vouches)
+        for m in matches: self.add_match(m["channel_id"], m.get("status"))
+
+    def _index_vouches(self, vouches):
+        for v in vouches:
+            self.add_vouch(v["channel_id"], v["user_id"])
+            if v.get("start_time") and (self._vouch_seen is None or as_utc(v["start_time"]) > self._vouch_seen): self._vouch_seen = as_utc(v["start_time"])
+
+    async def refresh_vouches(self):
+        query = {"start_time": {"$gte": self._vouch_seen}} if self._vouch_seen else {}
+        self._index_vouches(await col_vouch.find(query, {"channel_id": 1, "user_id": 1, "start_time": 1}))
+
+    def add_vouch(self, channel_id, user_id): self.vouch.setdefault(channel_id, set()).add(user_id)
+
+    def remove_vouch(self, channel_id, user_id):
+        users = self.vouch.get(channel_id)
+        if users is None: return
+        users.discard(user_id)
+        if not users: del self.vouch[channel_id]
+
+    def is_vouch(self, channel_id, user_id): return user_id in self.vouch.get(channel_id, ())
+
+    def add_match(self, channel_id, status): self.matches[channel_id] = status
+    def remove_match(self, channel_id): self.matches.pop(channel_id, None)
+    def match_status(self, channel_id): return self.matches.get(channel_id)
+
+router = ChannelRouter()
+
+# ⏱️ SCHEDULER
+# Deadlines are kept in an in-memory heap and fired by the lease holder. Some
+# documents (vouches, rooms, giveaways, cleanups) are written outside the bot and
+# others are scheduled by replicas that don't hold the lease, so the holder also
+# rescans every SCHEDULER_RESCAN seconds. A rescan only reads deadlines due within
+# the next two intervals, through an index on each deadline field, with a
+# projection; an idle bot costs one empty index probe per kind per interval.
+SCHEDULER_RESCAN = int(os.getenv("SCHEDULER_RESCAN", "60"))
+
+def as_utc(dt): return dt.replace(tzinfo=timezone.utc) if dt.tzinfo is None else dt
+
+class DeadlineScheduler:
+    def __init__(self):
+        self._heap = []
+        self._due = {}
+        self._jobs = {}
+        self._seq = itertools.count()
+        self._wake = None
+        self._task = None
+        self._firing = set()
+        # (kind, key) -> deadline last fired, so a doc its handler left in place isn't refired every rescan.
+        self._fired = {}
+        self.lease = None
+
+    def register(self, kind, handler, col, due, field=None, lead=timedelta(0), fields=None):
+        # due is either the deadline field name or a callable mapping a document to its
+        # deadline; a callable is windowed on the indexed field, which is never more
+        # than lead before the deadline, and reads only fields.
+        self._jobs[kind] = (handler, col, due, field or due, lead, fields or {field or due: 1})
+
+    def schedule(self, kind, key, when):
+        seq, when = next(self._seq), as_utc(when)
+        self._due[(kind, key)] = (seq, when)
+        heapq.heappush(self._heap, (when, seq, kind, key))
+        if self._wake: self._wake.set()
+
+    def cancel(self, kind, key): self._due.pop((kind, key), None)
+
+    def pending(self): return len(self._due)
+
+    async def _deadlines(self, kind, horizon):
+        handler, col, due, field, lead, fields = self._jobs[kind]
+        docs = await col.find({field: {"$lte": horizon - lead}}, fields)
+        return [(doc["_id"], doc[due] if isinstance(due, str) else due(doc)) for doc in docs]
+
+    async def rehydrate(self):
+        self._heap, self._due = [], {}
+        await self.rescan()
+
+    async def rescan(self):
+        seen, horizon = set(), datetime.now(timezone.utc) + timedelta(seconds=2 * SCHEDULER_RESCAN)
+        for kind in self._jobs:
+            for key, when in await self._deadlines(kind, horizon):
+                k, when = (kind, key), as_utc(when)
+                seen.add(k)
+                if (k in self._due and self._due[k][1] == when) or k in self._firing or self._fired.get(k) == when: continue
+                self.schedule(kind, key, when)
+        for k in [k for k in self._fired if k not in seen]: del self._fired[k]
+
+    def start(self, wait_until_ready):
+        if self._task: return
+        self._wake = asyncio.Event()
+        self._task = asyncio.create_task(self._run(wait_until_ready))
+        asyncio.create_task(self._rescan_loop(wait_until_ready))
+
+    async def _rescan_loop(self, wait_until_ready):
+        await wait_until_ready()
+        while True:
+            await asyncio.sleep(SCHEDULER_RESCAN)
+            if self.lease and not leases.holds(self.lease): continue
+            try: await metrics.span("task", "scheduler_rescan", self.rescan())
+            except Exception: traceback.print_exc()
+
+    async def _run(self, wait_until_ready):
+        await wait_until_ready()
+        while True:
+            self._wake.clear()
+            now = datetime.now(timezone.utc)
+            timeout = None
+            while self._heap:
+                when, seq, kind, key = self._heap[0]
+                if self._due.get((kind, key), (None,))[0] != seq:
+                    heapq.heappop(self._heap)
+                    continue
+                if when > now:
+                    timeout = (when - now).total_seconds()
+                    break
+                heapq.heappop(self._heap)
+                del self._due[(kind, key)]
+                asyncio.create_task(self._fire(kind, key, when))
+            try: await asyncio.wait_for(self._wake.wait(), timeout)
+            except asyncio.TimeoutError: pass
+
+    async def _fire(self, kind, key, when):
+        # Replicas that don't hold the lease drop the fire; the documents stay in
+        # Mongo and the lease holder picks them up on its next rescan.
+        if self.lease and not leases.holds(self.lease): return
+        self._firing.add((kind, key))
+        self._fired[(kind, key)] = when
+        try: await metrics.span("deadline", kind, self._jobs[kind][0](key))
+        except Exception: traceback.print_exc()
+        finally: self._firing.discard((kind, key))
+
+scheduler = DeadlineScheduler()
+
+VOUCH_FIRST_WARN = timedelta(minutes=10)
+
+def vouch_deadline(doc):
+    start = as_utc(doc["start_time"])
+    if not doc.get("warned_10"): return start + VOUCH_FIRST_WARN
+    if not doc.get("warned_20"): return start + timedelta(minutes=20)
+    return start + timedelta(minutes=30)
+
+# 👑 LEADER LEASES
+# Each background job is owned by one replica at a time through a lease doc that
+# the holder renews every LEASE_RENEW seconds. If the holder dies the lease
+# expires after LEASE_TTL and another replica takes it over.
+LEASE_TTL = int(os.getenv("LEASE_TTL", "30"))
+LEASE_RENEW = max(1, LEASE_TTL // 3)
+INSTANCE_ID = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:6]}"
+
+class LeaseManager:
+    def __init__(self, holder):
+        self.holder = holder
+        self._wanted = {}
+        self._held = {}
+        self._task = None
+
+    def want(self, name, on_acquire=None): self._wanted[name] = on_acquire
+
+    def holds(self, name):
+        # Local deadline stops one renew interval short of the Mongo expiry, so a
+        # stalled holder steps down before anyone else can take over.
+        return self._held.get(name, 0) > time.monotonic()
+
+    async def acquire(self, name):
+        started, now = time.monotonic(), datetime.now(timezone.utc)
+        try:
+            doc = await col_leases.find_one_and_update(
+                {"_id": name, "$or": [{"holder": self.holder}, {"expires_at": {"$lt": now}}]},
+                {"$set": {"holder": self.holder, "expires_at": now + timedelta(seconds=LEASE_TTL)}},
+                upsert=True, return_document=ReturnDocument.AFTER)
+        except DuplicateKeyError: doc = None
+        if doc: self._held[name] = started + LEASE_TTL - LEASE_RENEW
+        else: self._held.pop(name, None)
+        return doc is not None
+
+    def start(self):
+        if not self._task: self._task = asyncio.create_task(self._run())
+
+    async def _run(self):
+        while True:
+            for name, on_acquire in self._wanted.items():
+                had = self.holds(name)
+                try: got = await self.acquire(name)
+                except Exception:
+                    traceback.print_exc()
+                    continue
+                if got and not had:
+                    print(f"👑 {self.holder} now owns {name}")
+                    if on_acquire: asyncio.create_task(on_acquire())
+            await asyncio.sleep(LEASE_RENEW)
+
+    async def release_all(self):
+        if self._task: self._task.cancel()
+        self._held.clear()
+        await col_leases.delete_many({"holder": self.holder})
+
+leases = LeaseManager(INSTANCE_ID)
+
+# 📬 JOB QUEUE
+# Deferred side effects live in the jobs collection instead of in sleeping tasks.
+# Workers claim due jobs atomically and hold them for JOB_LOCK seconds; a job
+# whose worker died is reclaimed after that, so execution is at-least-once and
+# handlers must be idempotent. Failures retry with exponential backoff and land
+# in dead_jobs after JOB_MAX_ATTEMPTS. Jobs enqueued with local=True only run on
+# processes serving the same shards, since they touch channels.
+JOB_CONCURRENCY = int(os.getenv("JOB_CONCURRENCY", "8"))
+JOB_POLL = float(os.getenv("JOB_POLL", "2"))
+JOB_LOCK = 120
+JOB_MAX_ATTEMPTS = 5
+JOB_BACKOFF = 15
+
+class JobQueue:
+    def __init__(self):
+        self._handlers = {}
+        self.scope = None
+        self._slots = None
+        self._wake = None
+        self._task = None
+
+    def handler(self, kind):
+        def register(fn):
+            self._handlers[kind] = fn
+            return fn
+        return register
+
+    async def enqueue(self, kind, delay=0, key=None, local=False, **args):
+        now = datetime.now(timezone.utc)
+        job = {"kind": kind, "args": args, "state": "ready", "run_at": now + timedelta(seconds=delay), "attempts": 0, "created_at": now, "scope": self.scope if local else None}
+        # key dedupes: enqueueing the same logical job twice keeps the first one.
+        if key is not None: job["_id"] = key
+        try: await col_jobs.insert_one(job)
+        except DuplicateKeyError: return
+        if self._wake and delay <= JOB_POLL: self._wake.set()
+
+    async def _claim(self):
+        now = datetime.now(timezone.utc)
+        return await col_jobs.find_one_and_update(
+            {"scope": {"$in": [None, self.scope]}, "$or": [{"state": "ready", "run_at": {"$lte": now}}, {"state": "running", "locked_until": {"$lt": now}}]},
+            {"$set": {"state": "running", "locked_by": INSTANCE_ID, "locked_until": now + timedelta(seconds=JOB_LOCK)}, "$inc": {"attempts": 1}},
+            sort=[("run_at", ASCENDING)], return_document=ReturnDocument.AFTER)
+
+    def start(self, scope, wait_until_ready):
+        if self._task: return
+        self.scope = scope
+        self._slots = asyncio.Semaphore(JOB_CONCURRENCY)
+        self._wake = asyncio.Event()
+        self._task = asyncio.create_task(self._run(wait_until_ready))
+
+    async def _run(self, wait_until_ready):
+        await wait_until_ready()
+        while True:
+            self._wake.clear()
+            try:
+                while True:
+                    await self._slots.acquire()
+                    job = await self._claim()
+                    if not job:
+                        self._slots.release()
+                        break
+                    asyncio.create_task(self._execute(job))
+            except Exception:
+                self._slots.release()
+                traceback.print_exc()
+            try: await asyncio.wait_for(self._wake.wait(), JOB_POLL)
+            except asyncio.TimeoutError: pass
+
+    async def cancel(self, key): await col_jobs.delete_one({"_id": key, "state": "ready"})
+
+    async def _execute(self, job):
+        try:
+            await metrics.span("job", job["kind"], self._handlers[job["kind"]](job["_id"], **job["args"]))
+            await col_jobs.delete_one({"_id": job["_id"], "locked_by": INSTANCE_ID})
+        except Exception as e:
+            error = f"{type(e).__name__}: {e}"
+            print(f"⚠️ Job {job['kind']} {job['_id']} failed (attempt {job['attempts']}): {error}")
+            if job["attempts"] >= JOB_MAX_ATTEMPTS:
+                dead = {k: v for k, v in job.items() if k != "_id"}
+                await col_dead_jobs.update_one({"_id": job["_id"]}, {"$set": {**dead, "state": "dead", "last_error": error, "failed_at": datetime.now(timezone.utc)}}, upsert=True)
+                await col_jobs.delete_one({"_id": job["_id"]})
+            else:
+                retry_at = datetime.now(timezone.utc) + timedelta(seconds=JOB_BACKOFF * 2 ** (job["attempts"] - 1) + random.uniform(0, JOB_BACKOFF))
+                await col_jobs.update_one({"_id": job["_id"], "locked_by": INSTANCE_ID}, {"$set": {"state": "ready", "run_at": retry_at, "last_error": error}})
+        finally: self._slots.release()
+
+jobs = JobQueue()
+
+# 🧷 PERSISTENT VIEWS
+# Interactive views keep their state in Mongo and their buttons are DynamicItems
+# whose custom_id is "v:<kind>:<action>:<view id>". After a restart the callback
+# rebuilds the view from the stored state, so nothing is held per open message;
+# only the last VIEW_CACHE_SIZE states are cached. Expired states are swept by TTL.
+VIEW_CACHE_SIZE = int(os.getenv("VIEW_CACHE_SIZE", "512"))
+VIEW_KINDS = {}
+
+class ViewStates:
+    def __init__(self, size):
+        self.size = size
+        self._cache = OrderedDict()
+
+    def _remember(self, vid, state, expires):
+        self._cache[vid] = (state, expires)
+        self._cache.move_to_end(vid)
+        while len(self._cache) > self.size: self._cache.popitem(last=False)
+
+    async def create(self, kind, state, ttl):
+        vid, expires = ObjectId(), datetime.now(timezone.utc) + ttl
+        await col_views.insert_one({"_id": vid, "kind": kind, "state": state, "expires_at": expires})
+        self._remember(str(vid), state, expires)
+        return str(vid)
+
+    async def get(self, vid):
+        now = datetime.now(timezone.utc)
+        cached = self._cache.get(vid)
+        if cached and cached[1] > now:
+            self._cache.move_to_end(vid)
+            return cached[0]
+        doc = await col_views.find_one({"_id": ObjectId(vid), "expires_at": {"$gt": now}})
+        if not doc: return None
+        self._remember(vid, doc["state"], as_utc(doc["expires_at"]))
+        return doc["state"]
+
+    async def update(self, vid, field, value):
+        doc = await col_views.find_one_and_update({"_id": ObjectId(vid)}, {"$set": {f"state.{field}": value}}, return_document=ReturnDocument.AFTER)
+        if not doc: return None
+        self._remember(vid, doc["state"], as_utc(doc["expires_at"]))
+        return doc["state"]
+
+    # claim() lets exactly one click act on a view (across replicas too); unclaim() reopens it.
+    async def claim(self, vid): return bool((await col_views.update_one({"_id": ObjectId(vid), "claimed": {"$ne": True}}, {"$set": {"claimed": True}})).modified_count)
+
+    async def unclaim(self, vid): await col_views.update_one({"_id": ObjectId(vid)}, {"$unset": {"claimed": ""}})
+
+    async def close(self, vid):
+        self._cache.pop(vid, None)
+        await col_views.delete_one({"_id": ObjectId(vid)})
+
+view_states = ViewStates(VIEW_CACHE_SIZE)
+
+class PersistentButton(discord.ui.DynamicItem[discord.ui.Button], template=r"v:(?P<kind>[a-z]+):(?P<action>[a-z_]+):(?P<vid>[0-9a-f]{24})"):
+    def __init__(self, kind, action, vid, label=None, style=discord.ButtonStyle.secondary):
+        super().__init__(discord.ui.Button(label=label, style=style, custom_id=f"v:{kind}:{action}:{vid}"))
+        self.kind, self.action, self.vid = kind, action, vid
+
+    @classmethod
+    async def from_custom_id(cls, interaction, item, match):
+        return cls(match["kind"], match["action"], match["vid"], item.label, item.style)
+
+    async def callback(self, interaction: discord.Interaction):
+        view_cls = VIEW_KINDS.get(self.kind)
+        if not view_cls or self.action not in {a for a, _, _ in view_cls.buttons}: return
+        state = await view_states.get(self.vid)
+        if state is None: return await interaction.response.send_message("⌛ This has expired.", ephemeral=True)
+        await metrics.span("view", f"{self.kind}.{self.action}", getattr(view_cls(self.vid, state), self.action)(interaction))
+
+class PersistentView(discord.ui.View):
+    kind = None
+    ttl = timedelta(minutes=5)
+    buttons = ()
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        VIEW_KINDS[cls.kind] = cls
+
+    def __init__(self, vid, state):
+        super().__init__(timeout=None)
+        self.vid, self.state = vid, state
+        for action, label, style in self.buttons: self.add_item(PersistentButton(self.kind, action, vid, label, style))
+
+    @classmethod
+    async def open(cls, **state): return cls(await view_states.create(cls.kind, state, cls.ttl), state)
+
+# 🔐 PERMISSION BATCHING
+# Overwrite changes are merged per channel and applied with a single
+# channel.edit(overwrites=...). Edits for one channel run one at a time; edits
+# across channels share a small concurrency limit so a burst (e.g. many team
+# rents expiring together) queues locally instead of tripping 429s.
+REST_CONCURRENCY = int(os.getenv("REST_CONCURRENCY", "4"))
+
+class OverwriteBatcher:
+    def __init__(self, concurrency):
+        self.concurrency = concurrency
+        self._pending = {}
+        self._locks = {}
+        self._recent = {}
+        self._sem = None
+
+    def update(self, channel, updates):
+        # updates maps a role/member to a PermissionOverwrite (replace), a dict of
+        # permissions (merged into the current overwrite) or None (remove).
+        entry = self._pending.get(channel.id)
+        if entry:
+            for target, value in updates.items(): entry[1][target.id] = (target, value)
+            return entry[2]
+        fut = asyncio.get_running_loop().create_future()
+        self._pending[channel.id] = (channel, {t.id: (t, v) for t, v in updates.items()}, fut)
+        asyncio.create_task(self._flush(channel.id))
+        return fut
+
+    def _base(self, channel):
+        # The gateway update for our last edit may not have arrived yet.
+        recent = self._recent.pop(channel.id, None)
+        if recent and time.monotonic() - recent[0] < 5: return dict(recent[1])
+        return dict(channel.overwrites)
+
+    async def _flush(self, channel_id):
+        if self._sem is None: self._sem = asyncio.Semaphore(self.concurrency)
+        lock = self._locks.setdefault(channel_id, asyncio.Lock())
+        async with lock, self._sem:
+            channel, updates, fut = self._pending.pop(channel_id)
+            try:
+                current = {t.id: (t, ow) for t, ow in self._base(channel).items()}
+                for tid, (target, value) in updates.items():
+                    if value is None: current.pop(tid, None)
+                    elif isinstance(value, dict):
+                        ow = current[tid][1] if tid in current else discord.PermissionOverwrite()
+                        ow = discord.PermissionOverwrite(**{**dict(ow), **value})
+                        current[tid] = (target, ow)
+                    else: current[tid] = (target, value)
+                overwrites = dict(current.values())
+                edited = await channel.edit(overwrites=overwrites)
+                self._recent[channel_id] = (time.monotonic(), edited.overwrites if edited else overwrites)
+                fut.set_result(None)
+            except Exception as e:
+                fut.set_exception(e)
+        if not lock.locked() and channel_id not in self._pending: self._locks.pop(channel_id, None)
+        if len(self._recent) > 256:
+            cutoff = time.monotonic() - 5
+            self._recent = {k: v for k, v in self._recent.items() if v[0] >= cutoff}
+
+overwrite_batcher = OverwriteBatcher(REST_CONCURRENCY)
+
+async def set_overwrites(channel, updates): await overwrite_batcher.update(channel, updates)
+
+# 🏊 CHANNEL POOL
+# Hidden, pre-created rooms under each guild's private-rooms category. Acquiring renames and
+# re-permissions one in a single edit; releasing purges it and hides it again
+# instead of deleting. Rooms are claimed idle -> busy with one conditional write,
+# so replicas can't hand the same room to two matches, and only the deadline
+# lease holder tops the pool up. Discord allows two renames per channel per 10
+# minutes; the last two are kept on the doc and a room that has used its budget
+# is skipped until it recovers.
+POOL_SIZE = int(os.getenv("CHANNEL_POOL_SIZE", "5"))
+POOL_MAX = POOL_SIZE * 2
+POOL_REFILL = 60
+RENAME_WINDOW = timedelta(minutes=10)
+
+class ChannelPool:
+    def __init__(self, size, max_size):
+        self.size = size
+        self.max_size = max_size
+        self._filling = set()
+
+    def hidden_overwrites(self, guild):
+        return {guild.default_role: discord.PermissionOverwrite(read_messages=False), guild.me: discord.PermissionOverwrite(read_messages=True, manage_channels=True, manage_messages=True)}
+
+    async def _take(self, guild):
+        now = datetime.now(timezone.utc)
+        while True:
+            doc = await col_pool.find_one_and_update(
+                {"guild_id": guild.id, "state": "idle", "$or": [{"renames.1": {"$exists": False}}, {"renames.0": {"$lt": now - RENAME_WINDOW}}]},
+                {"$set": {"state": "busy"}, "$push": {"renames": {"$each": [now], "$slice": -2}}})
+            if doc is None: return None
+            channel = guild.get_channel(doc["_id"])
+            if channel: return channel
+            await col_pool.delete_one({"_id": doc["_id"]})
+
+    async def acquire(self, guild, name, overwrites):
+        channel = await self._take(guild)
+        if channel:
+            try: await channel.edit(name=name, overwrites=overwrites)
+            except discord.HTTPException:
+                await col_pool.update_one({"_id": channel.id}, {"$set": {"state": "idle"}})
+                channel = None
+        if channel is None:
+            channel = await guild.create_text_channel(name, category=guild.get_channel(cfg(guild).private_rooms), overwrites=overwrites)
+            await col_pool.insert_one({"_id": channel.id, "guild_id": guild.id, "state": "busy", "renames": []})
+        if leases.holds(scheduler.lease): asyncio.create_task(self.fill(guild))
+        return channel
+
+    async def release(self, channel):
+        doc = await col_pool.find_one({"_id": channel.id}, {"_id": 1})
+        if doc and await col_pool.count_documents({"guild_id": channel.guild.id, "state": "idle"}) < self.max_size:
+            try:
+                await channel.purge(limit=None)
+                await channel.edit(overwrites=self.hidden_overwrites(channel.guild))
+                await col_pool.update_one({"_id": channel.id}, {"$set": {"state": "idle"}})
+                return
+            except discord.HTTPException: pass
+        try: await channel.delete()
+        except discord.HTTPException: pass
+        if doc: await col_pool.delete_one({"_id": channel.id})
+
+    async def fill(self, guild):
+        if guild.id in self._filling or not leases.holds(scheduler.lease): return
+        self._filling.add(guild.id)
+        try:
+            idle = [d["_id"] for d in await col_pool.find({"guild_id": guild.id, "state": "idle"}, {"_id": 1})]
+            gone = [cid for cid in idle if not guild.get_channel(cid)]
+            if gone: await col_pool.delete_many({"_id": {"$in": gone}})
+            count = len(idle) - len(gone)
+            category = guild.get_channel(cfg(guild).private_rooms)
+            while category and count < self.size:
+                channel = await guild.create_text_channel(f"room-{count + 1}", category=category, overwrites=self.hidden_overwrites(guild))
+                await col_pool.insert_one({"_id": channel.id, "guild_id": guild.id, "state": "idle", "renames": []})
+                count += 1
+        except Exception: traceback.print_exc()
+        finally: self._filling.discard(guild.id)
+
+channel_pool = ChannelPool(POOL_SIZE, POOL_MAX)
+
+# 🏆 LEADERBOARD
+# Weekly wins of every player who has any, plus team rosters, kept in memory and
+# bumped on each settlement. rebuild() reloads both from Mongo and reports drift;
+# with more than one process it also runs every LEADERBOARD_REFRESH seconds so
+# wins settled (and the weekly reset done) elsewhere show up here.
+LEADERBOARD_REFRESH = int(os.getenv("LEADERBOARD_REFRESH", "60"))
+
+class WeeklyLeaderboard:
+    def __init__(self):
+        self.wins = {}
+        self.teams = {}
+
+    async def rebuild(self):
+        users, teams = await asyncio.gather(
+            col_users.find({"weekly_wins": {"$gt": 0}}, {"weekly_wins": 1}),
+            col_teams.find({}, {"name": 1, "members": 1})
+        )
+        wins = {u["_id"]: u["weekly_wins"] for u in users}
+        drift = sum(1 for uid in wins.keys() | self.wins.keys() if wins.get(uid, 0) != self.wins.get(uid, 0))
+        self.wins = wins
+        self.teams = {t["_id"]: (t["name"], set(t.get("members", []))) for t in teams}
+        return drift
+
+    def record_win(self, user_id): self.wins[user_id] = self.wins.get(user_id, 0) + 1
+    def reset(self): self.wins = {}
+
+    def set_team(self, team_id, name, members): self.teams[team_id] = (name, set(members))
+    def drop_team(self, team_id): self.teams.pop(team_id, None)
+
+    def add_member(self, team_id, user_id):
+        if team_id in self.teams: self.teams[team_id][1].add(user_id)
+
+    def remove_member(self, team_id, user_id):
+        if team_id in self.teams: self.teams[team_id][1].discard(user_id)
+
+    def top_players(self, n=10):
+        return heapq.nlargest(n, self.wins.items(), key=lambda kv: kv[1])
+
+    def top_teams(self, n=5):
+        totals = ((tid, name, members, sum(self.wins.get(m, 0) for m in members)) for tid, (name, members) in self.teams.items())
+        return heapq.nlargest(n, (t for t in totals if t[3] > 0), key=lambda t: t[3])
+
+weekly_board = WeeklyLeaderboard()
+
+# 🗓️ WEEKLY ROLLOVER
+# One archived season doc per ISO week drives the rollover through paying ->
+# resetting -> done, so a restart resumes from the last step.
+# Rewards are guarded by last_weekly_reward, so replaying the bulk write never double pays.
+WEEKLY_REWARDS = {1: 150, 2: 100, 3: 50}
+ROLLOVER_WEEKDAY = 6
+
+def season_key(now):
+    year, week, _ = now.isocalendar()
+    return f"{year}-W{week:02d}"
+
+async def open_season(key, now):
+    await weekly_board.rebuild()
+    players = weekly_board.top_players(10)
+    teams = weekly_board.top_teams(5)
+    rewards = {}
+    for i, (uid, _) in enumerate(players, 1):
+        rewards[uid] = rewards.get(uid, 0) + WEEKLY_REWARDS.get(i, 0)
+    for i, (_, _, members, _) in enumerate(teams, 1):
+        for uid in members: rewards[uid] = rewards.get(uid, 0) + WEEKLY_REWARDS.get(i, 0)
+    season = {
+        "_id": key, "status": "paying", "created_at": now,
+        "players": [[uid, wins] for uid, wins in players],
+        "teams": [[name, wins] for _, name, _, wins in teams],
+        "rewards": [[uid, amount] for uid, amount in rewards.items() if amount > 0]
+    }
+    try: await col_seasons.insert_one(season)
+    except DuplicateKeyError: season = await col_seasons.find_one({"_id": key})
+    return season
+
+async def advance_season(season):
+    key = season["_id"]
+    if season["status"] == "paying":
+        if season["rewards"]:
+            await col_users.bulk_write([
+                UpdateOne({"_id": uid, "last_weekly_reward": {"$ne": key}}, {"$inc": {"coins": amount}, "$set": {"last_weekly_reward": key}})
+                for uid, amount in season["rewards"]
+            ], ordered=False)
+            for uid, amount in season["rewards"]: coin_journal.record(uid, amount, "weekly", key, key=f"weekly:{key}:{uid}")
+        season["status"] = "resetting"
+        await col_seasons.update_one({"_id": key}, {"$set": {"status": "resetting"}})
+    if season["status"] == "resetting":
+        await col_users.update_many({"weekly_wins": {"$gt": 0}}, {"$set": {"weekly_wins": 0}})
+        weekly_board.reset()
+        await col_seasons.update_one({"_id": key}, {"$set": {"status": "done", "finished_at": datetime.now(timezone.utc)}})
+
+def leaderboard_embed(top_players, top_teams):
+    embed = discord.Embed(title="⭐ WEEKLY LEADERBOARD", color=discord.Color.gold())
+    p_text = "".join(f"**{i}.** <@{uid}> — 🏆 {wins}\n" for i, (uid, wins) in enumerate(top_players, 1))
+    embed.add_field(name="👤 Top Players", value=p_text if p_text else "No data.", inline=False)
+    t_text = "".join(f"**{i}.** 🛡️ {name} — 🏆 {wins}\n" for i, (name, wins) in enumerate(top_teams, 1))
+    embed.add_field(name="👥 Top Teams", value=t_text if t_text else "No data.", inline=False)
+    return embed
+
+# 📨 INVITE TRACKING
+# Per-guild invite use counters live in memory and are diffed to find who
+# invited a new member. A join resolves without any REST call only when a
+# limited invite was deleted on its last use, since that delete names the invite
+# that was taken. Every other join waits in a per-guild queue and a
+# single guild.invites() fetch, debounced by INVITE_DEBOUNCE, resolves every
+# queued join, so a raid costs one fetch per window instead of one per member.
+# Rewards are paid INVITE_HOLD after the join if the member is still here.
+INVITE_REWARD = 100
+INVITE_HOLD = timedelta(hours=24)
+INVITE_DEBOUNCE = float(os.getenv("INVITE_DEBOUNCE", "2"))
+
+class InviteTracker:
+    def __init__(self):
+        self.uses = {}
+        self.consumed = {}
+        self._pending = {}
+        self._refresh = {}
+
+    @staticmethod
+    def _snapshot(invites): return {inv.code: [inv.uses or 0, inv.max_uses or 0, inv.inviter.id if inv.inviter else None] for inv in invites}
+
+    async def load(self, guild): self.uses[guild.id] = self._snapshot(await guild.invites())
+
+    def created(self, invite):
+        if invite.guild and invite.guild.id in self.uses: self.uses[invite.guild.id][invite.code] = [invite.uses or 0, invite.max_uses or 0, invite.inviter.id if invite.inviter else None]
+
+    def deleted(self, invite):
+        if not invite.guild: return
+        entry = self.uses.get(invite.guild.id, {}).pop(invite.code, None)
+        # Discord deletes a limited invite on its last use; an expired one is not a candidate.
+        if entry and entry[1] and entry[0] == entry[1] - 1: self.consumed.setdefault(invite.guild.id, deque(maxlen=50)).append((invite.code, entry[2]))
+
+    def _resolve_now(self, guild):
+        if self._pending.get(guild.id): return None
+        consumed = self.consumed.get(guild.id)
+        if consumed and len(consumed) == 1: return consumed.pop()
+        return None
+
+    async def member_joined(self, member):
+        guild = member.guild
+        resolved = self._resolve_now(guild)
+        if resolved: return await record_invites(guild, [(member, *resolved)])
+        self._pending.setdefault(guild.id, []).append(member)
+        if guild.id not in self._refresh: self._refresh[guild.id] = asyncio.create_task(self._refresh_after(guild))
+
+    async def _refresh_after(self, guild):
+        await asyncio.sleep(INVITE_DEBOUNCE)
+        try: fresh = self._snapshot(await guild.invites())
+        except discord.HTTPException as e:
+            fresh = None
+            metrics.error(f"invites:{guild.id}", e)
+        # Joins that landed while the fetch was in flight are covered by it too.
+        joins = self._pending.pop(guild.id, [])
+        self._refresh.pop(guild.id, None)
+        if fresh is None: return metrics.inc("invites_unattributed", str(guild.id), len(joins))
+        old = self.uses.get(guild.id)
+        # Without a baseline (load() failed) every past use would look new; this fetch becomes the baseline.
+        if old is None:
+            self.uses[guild.id] = fresh
+            return metrics.inc("invites_unattributed", str(guild.id), len(joins))
+        gained = [(code, entry[2], entry[0] - old.get(code, [0])[0]) for code, entry in fresh.items() if entry[0] > old.get(code, [0])[0]]
+        gained += [(code, inviter, 1) for code, inviter in self.consumed.pop(guild.id, ())]
+        self.uses[guild.id] = fresh
+        # Uses only say how many joins each invite took, not which member took which,
+        # so a batch is attributed only when every gained use belongs to one inviter.
+        inviters = {inviter for _, inviter, _ in gained}
+        credited = min(len(joins), sum(n for _, _, n in gained)) if len(inviters) == 1 else 0
+        if credited: await record_invites(guild, [(member, gained[0][0], gained[0][1]) for member in joins[:credited]])
+        if len(joins) > credited: metrics.inc("invites_unattributed", str(guild.id), len(joins) - credited)
+
+invite_tracker = InviteTracker()
+
+async def record_invites(guild, joins):
+    now = datetime.now(timezone.utc)
+    # One doc per guild member: a rejoin after the reward was paid earns nothing.
+    docs = [{"_id": f"{guild.id}:{member.id}", "guild_id": guild.id, "user_id": member.id, "inviter_id": inviter, "code": code, "joined_at": now, "valid": False}
+            for member, code, inviter in joins if inviter and inviter != member.id and not member.bot]
+    if not docs: return
+    try: await col_invites.insert_many(docs, ordered=False)
+    except BulkWriteError as e:
+        if any(err["code"] != 11000 for err in e.details["writeErrors"]): raise
+
+async def validate_invites():
+    # Matured invites are claimed under a sweep id and paid in one bulk write. The
+    # sweep id doubles as the once-token, so a sweep that died mid-way is finished
+    # by the next one without paying anyone twice.
+    sweep, now = str(ObjectId()), datetime.now(timezone.utc)
+    await col_invites.update_many({"valid": False, "joined_at": {"$lte": now - INVITE_HOLD}}, {"$set": {"valid": True, "sweep": sweep}})
+    claimed = await col_invites.find({"sweep": {"$exists": True}}, {"inviter_id": 1, "sweep": 1})
+    if not claimed: return 0
+    counts = {}
+    for inv in claimed: counts[(inv["sweep"], inv["inviter_id"])] = counts.get((inv["sweep"], inv["inviter_id"]), 0) + 1
+    try:
+        await col_users.bulk_write([
+            UpdateOne({"_id": uid, "applied": {"$ne": f"invites:{sid}"}},
+                      {"$inc": {"coins": INVITE_REWARD * n, "invite_count": n}, "$push": {"applied": {"$each": [f"invites:{sid}"], "$slice": -20}}}, upsert=True)
+            for (sid, uid), n in counts.items()
+        ], ordered=False)
+    except BulkWriteError as e:
+        # A duplicate key is the upsert of an inviter who was already paid for this sweep.
+        if any(err["code"] != 11000 for err in e.details["writeErrors"]): raise
+    for (sid, uid), n in counts.items(): coin_journal.record(uid, INVITE_REWARD * n, "invite", sid, key=f"invites:{sid}:{uid}")
+    await col_invites.update_many({"_id": {"$in": [inv["_id"] for inv in claimed]}}, {"$unset": {"sweep": ""}})
+    return len(claimed)
+
+# 🚦 RATE LIMITS
+# Token buckets for the spam-prone economy commands and buttons: one per user
+# across all of them, one per (action, user) and one per action overall. A check
+# refills lazily from the elapsed time, so it is O(1) with no timers. Buckets are
+# kept in LRU order; ones idle long enough to be full again are dropped from the
+# cold end as new ones arrive, and RATE_LIMIT_BUCKETS caps the table outright.
+RATE_LIMIT_BUCKETS = int(os.getenv("RATE_LIMIT_BUCKETS", "50000"))
+USER_RATE = (1.0, 8)
+# action: (per-user rate/s, burst, global rate/s, burst)
+THROTTLES = {
+    "challenge": (0.1, 3, 5, 30),
+    "buy": (0.5, 3, 10, 50),
+    "jointeam": (1 / 30, 2, 2, 10),
+    "adduser": (0.1, 3, 5, 20)
+}
+
+class RateLimiter:
+    def __init__(self, max_buckets):
+        self.max_buckets = max_buckets
+        self.enabled = True
+        # key -> [tokens, last refill, time it is full again]
+        self._buckets = OrderedDict()
+
+    def _wait(self, key, rate, burst, now):
+        b = self._buckets.get(key)
+        tokens = burst if b is None else min(burst, b[0] + (now - b[1]) * rate)
+        return 0 if tokens >= 1 else (1 - tokens) / rate
+
+    def _take(self, key, rate, burst, now):
+        b = self._buckets.get(key)
+        tokens = (burst if b is None else min(burst, b[0] + (now - b[1]) * rate)) - 1
+        self._buckets[key] = [tokens, now, now + (burst - tokens) / rate]
+        self._buckets.move_to_end(key)
+
+    def check(self, action, user_id):
+        # Returns 0 and spends a token from every bucket, or the seconds until all three allow it.
+        if not self.enabled: return 0
+        now = time.monotonic()
+        rate, burst, g_rate, g_burst = THROTTLES[action]
+        buckets = (("user", user_id, *USER_RATE), (action, user_id, rate, burst), (action, None, g_rate, g_burst))
+        wait = max(self._wait((kind, uid), r, b, now) for kind, uid, r, b in buckets)
+        if wait: return wait
+        for kind, uid, r, b in buckets: self._take((kind, uid), r, b, now)
+        while self._buckets:
+            if next(iter(self._buckets.values()))[2] > now and len(self._buckets) <= self.max_buckets: break
+            self._buckets.popitem(last=False)
+        return 0
+
+rate_limiter = RateLimiter(RATE_LIMIT_BUCKETS)
+
+def throttled(action):
+    def wrap(fn):
+        @functools.wraps(fn)
+        async def wrapper(*args, **kwargs):
+            interaction = args[1] if isinstance(args[0], discord.ui.View) else args[0]
+            wait = rate_limiter.check(action, interaction.user.id)
+            if wait:
+                metrics.inc("throttled_total", action)
+                return await interaction.response.send_message(f"⏳ Slow down, try again in {math.ceil(wait)}s.", ephemeral=True)
+            return await fn(*args, **kwargs)
+        return wrapper
+    return wrap
 
 # =========================================
+# 💰 ESCROW
+# Entry fees move from coins into an escrow entry on the user doc in one
+# conditional update, so a hold can never be half-applied and never overdraws.
+# Settlement pulls the entry, cancellation refunds it. Every movement is
+# appended to the ledger under a deterministic _id, so replays are no-ops.
+# reconcile_escrow() repairs anything a crash left behind.
+def ledger_entry(match_id, user_id, kind, amount, t=None):
+    return {"_id": f"{match_id}:{kind}:{user_id}", "match_id": match_id, "user_id": user_id, "kind": kind, "amount": amount, "t": t or datetime.now(timezone.utc)}
+
+def record_ledger_sync(entries, session=None):
+    try: col_ledger.sync.insert_many(entries, ordered=False, session=session)
+    except BulkWriteError as e:
+        if any(err["code"] != 11000 for err in e.details["writeErrors"]): raise
+
+def hold_sync(match_id, user_id, amount, session=None, ref=None):
+    res = col_users.sync.update_one({"_id": user_id, "coins": {"$gte": amount}, "escrow.m": {"$ne": match_id}},
+                                    {"$inc": {"coins": -amount}, "$push": {"escrow": {"m": match_id, "amt": amount}}}, session=session)
+    if res.modified_count:
+        record_ledger_sync([ledger_entry(match_id, user_id, "hold", amount)], session)
+        record_journal_sync([journal_entry(user_id, -amount, "match_hold", ref, f"hold:{match_id}:{user_id}")], session)
+    return bool(res.modified_count)
+
+def refund_sync(match_id, user_id, amount, session=None, ref=None):
+    res = col_users.sync.update_one({"_id": user_id, "escrow.m": match_id}, {"$inc": {"coins": amount}, "$pull": {"escrow": {"m": match_id}}}, session=session)
+    if res.modified_count:
+        record_ledger_sync([ledger_entry(match_id, user_id, "refund", amount)], session)
+        record_journal_sync([journal_entry(user_id, amount, "match_refund", ref, f"refund:{match_id}:{user_id}")], session)
+
+def open_match_sync(match, session=None):
+    # Returns the id of the first player who can't cover the entry, after undoing
+    # any holds already taken; None once both are held and the match is recorded.
+    col_matches.sync.insert_one(match, session=session)
+    held = []
+    for uid in match["team_a"] + match["team_b"]:
+        if not hold_sync(match["_id"], uid, match["entry"], session, match["round_id"]):
+            for h in held: refund_sync(match["_id"], h, match["entry"], session, match["round_id"])
+            col_matches.sync.delete_one({"_id": match["_id"]}, session=session)
+            return uid
+        held.append(uid)
+    return None
+
+async def cancel_match(match):
+    # Whoever deletes the match doc owns the refund; settlement claims it the same way.
+    claimed = await col_matches.find_one_and_delete({"_id": match["_id"]})
+    if not claimed: return False
+    await run_transaction(lambda session: [refund_sync(claimed["_id"], uid, claimed["entry"], session, claimed.get("round_id")) for uid in claimed["team_a"] + claimed["team_b"]])
+    user_cache.invalidate(*claimed["team_a"], *claimed["team_b"])
+    if claimed.get("channel_id"): router.remove_match(claimed["channel_id"])
+    return True
+
+async def reconcile_escrow():
+    # Matches stuck in "opening" never got a room; escrow entries with no match
+    # doc lost theirs mid-settlement or mid-cancel. Both are refunded.
+    stale = datetime.now(timezone.utc) - timedelta(minutes=5)
+    cancelled = 0
+    for match in await col_matches.find({"status": "opening", "opened_at": {"$lt": stale}}):
+        cancelled += await cancel_match(match)
+    refunded = 0
+    for user in await col_users.find({"escrow.m": {"$exists": True}}, {"escrow": 1}):
+        live = {m["_id"] for m in await col_matches.find({"_id": {"$in": [e["m"] for e in user["escrow"]]}}, {"_id": 1})}
+        for entry in user["escrow"]:
+            if entry["m"] in live: continue
+            await run_db(refund_sync, entry["m"], user["_id"], entry["amt"])
+            user_cache.invalidate(user["_id"])
+            refunded += 1
+    if cancelled or refunded: print(f"💰 Escrow reconciled: {cancelled} stuck match(es) cancelled, {refunded} orphaned hold(s) refunded")
+
+async def backfill_legacy_matches(bot):
+    # Matches opened before guild_id and expires_at were recorded get them here,
+    # so they stay settleable per guild and still time out. The timeout starts now.
+    await col_matches.update_many({"expires_at": {"$exists": False}}, {"$set": {"expires_at": datetime.now(timezone.utc) + MATCH_TIMEOUT}})
+    for m in await col_matches.find({"guild_id": {"$exists": False}}, {"channel_id": 1}):
+        channel = bot.get_channel(m.get("channel_id") or 0)
+        if channel: await col_matches.update_one({"_id": m["_id"]}, {"$set": {"guild_id": channel.guild.id}})
+
 # 🤖 BOT SETUP
 # =========================================
 
-class EGBot(commands.Bot):
+# SHARD_COUNT / SHARD_IDS ("0,1") pin this process to a slice of the shards;
+# leave both unset to let discord.py pick the count and run every shard here.
+SHARD_COUNT = int(os.getenv("SHARD_COUNT")) if os.getenv("SHARD_COUNT") else None
+SHARD_IDS = [int(x) for x in os.getenv("SHARD_IDS").split(",")] if os.getenv("SHARD_IDS") else None
+
+# 🚀 STARTUP
+# Boot is timed phase by phase (DB connect, each warm-up load, command sync, the
+# gateway, guild warm-up) and logged once on the first READY; the same numbers go
+# to startup_seconds. Warm-up loads are independent and run side by side.
+class StartupTimer:
+    def __init__(self):
+        self.phases = {}
+        self.started = self.last = None
+        self.done = False
+
+    def begin(self):
+        self.started = self.last = time.perf_counter()
+        # Imports and module setup ran before anything could time them; the process CPU time is a close proxy.
+        self.add("import", time.process_time())
+
+    def add(self, name, secs):
+        if self.done: return
+        self.phases[name] = secs
+        metrics.observe("startup_seconds", name, secs)
+
+    def lap(self, name):
+        now = time.perf_counter()
+        self.add(name, now - self.last)
+        self.last = now
+
+    async def phase(self, name, coro):
+        start = time.perf_counter()
+        try: return await coro
+        finally: self.add(name, time.perf_counter() - start)
+
+    def finish(self):
+        if self.done: return
+        self.add("total", time.perf_counter() - self.started + self.phases["import"])
+        self.done = True
+        print("⏱️ Startup: " + ", ".join(f"{name} {secs:.2f}s" for name, secs in self.phases.items()))
+
+startup = StartupTimer()
+
+class InstrumentedTree(app_commands.CommandTree):
+    async def _call(self, interaction):
+        name = interaction.command.qualified_name if interaction.command else (interaction.data or {}).get("name", "?")
+        await metrics.span("command", name, super()._call(interaction))
+
+class EGBot(commands.AutoShardedBot):
     def __init__(self):
         intents = discord.Intents.default()
         intents.members = True
         intents.message_content = True
         intents.invites = True
-        super().__init__(command_prefix=".", intents=intents)
-        self.invite_cache = {}
+        super().__init__(command_prefix=".", intents=intents, shard_count=SHARD_COUNT, shard_ids=SHARD_IDS, tree_cls=InstrumentedTree)
+
+    def owns_guild(self, guild_id):
+        return self.shard_ids is None or (guild_id >> 22) % self.shard_count in self.shard_ids
+
+    def owns_doc(self, doc):
+        # Documents written before guild_id was recorded belong to whoever can see the channel.
+        if doc.get("guild_id"): return self.owns_guild(doc["guild_id"])
+        return self.shard_ids is None or self.get_channel(doc.get("channel_id", 0)) is not None
+
+    @property
+    def shard_scope(self): return "all" if self.shard_ids is None else ",".join(map(str, sorted(self.shard_ids)))
+
+    async def on_leader(self):
+        # Replicas of the same shard slice share one lease for deadlines and pool upkeep.
+        await reconcile_escrow()
+        await scheduler.rehydrate()
+        asyncio.create_task(self.backfill_history())
+        await self.wait_until_ready()
+        await backfill_legacy_matches(self)
+        await scheduler.rescan()
+        for guild in self.guilds: asyncio.create_task(channel_pool.fill(guild))
+
+    async def backfill_history(self):
+        try:
+            moved = await metrics.span("task", "history_backfill", backfill_history())
+            if moved: print(f"📜 Backfilled {moved} legacy history rows")
+        except Exception as e: metrics.error("history_backfill", e)
+
+    async def close(self):
+        try: await coin_journal.flush()
+        except Exception: traceback.print_exc()
+        await leases.release_all()
+        await super().close()
+
+    async def sync_commands(self):
+        # Syncing is slow and rate limited, so it only happens when the command payload changed.
+        payload = json.dumps([c.to_dict(self.tree) for c in self.tree.get_commands()], sort_keys=True)
+        digest = hashlib.sha256(payload.encode()).hexdigest()
+        doc = await col_settings.find_one({"_id": "command_hash"})
+        if doc and doc.get("hash") == digest: return print("✅ Commands unchanged, sync skipped")
+        await self.tree.sync()
+        await col_settings.update_one({"_id": "command_hash"}, {"$set": {"hash": digest}}, upsert=True)
+        print("✅ Commands Synced")
 
     async def setup_hook(self):
-        self.check_vouch_timers.start()
-        self.check_channel_expiry.start()
-        self.check_request_timeouts.start()
-        self.check_giveaways.start()
-        self.check_team_rent.start()
+        startup.begin()
+        instrument_http(self.http)
+        asyncio.create_task(serve_metrics())
+        await startup.phase("connect", connect_db())
+        # A SIGTERM from the orchestrator goes through close(), which flushes the journal buffer.
+        try: asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, lambda: asyncio.create_task(self.close()))
+        except NotImplementedError: pass
+        await asyncio.gather(
+            startup.phase("settings", ensure_settings()),
+            startup.phase("indexes", ensure_indexes()),
+            startup.phase("router", router.load()),
+            startup.phase("leaderboard", weekly_board.rebuild()),
+            startup.phase("commands", self.sync_commands())
+        )
+        scheduler.register("vouch", self.expire_vouch, col_vouch, vouch_deadline, "start_time", VOUCH_FIRST_WARN, {"start_time": 1, "warned_10": 1, "warned_20": 1})
+        scheduler.register("cleanup", self.run_cleanup, col_cleanup, "delete_at")
+        scheduler.register("team_rent", self.expire_team_rent, col_teams, "rent_expiry")
+        scheduler.register("channel", self.expire_channel, col_channels, "end_time")
+        scheduler.register("giveaway", self.draw_giveaway, col_giveaways, "end_time")
+        scheduler.register("request", self.expire_request, col_requests, "expires_at")
+        scheduler.register("match", self.expire_match, col_matches, "expires_at")
+        scheduler.lease = f"deadlines:{self.shard_scope}"
+        leases.want(scheduler.lease, self.on_leader)
+        leases.want("weekly")
+        leases.want("snapshots")
+        leases.want("invites")
+        leases.start()
+        coin_journal.start()
+        jobs.start(self.shard_scope, self.wait_until_ready)
+        self.add_view(BoostShopView())
+        self.add_dynamic_items(PersistentButton)
+        self.balance_snapshot_task.start()
+        self.check_invite_validation.start()
+        self.vouch_refresh_task.start()
+        self.pool_refill_task.start()
+        if MULTI_PROCESS:
+            self.leaderboard_refresh_task.start()
+            self.settings_refresh_task.start()
+        scheduler.start(self.wait_until_ready)
         self.weekly_leaderboard_task.start()
-        self.check_cleanup_tasks.start()
-        await self.tree.sync()
-        print("✅ Commands Synced")
+        startup.lap("setup")
+
+    async def warm_guild(self, guild):
+        if leases.holds(scheduler.lease): asyncio.create_task(channel_pool.fill(guild))
+        try:
+            await invite_tracker.load(guild)
+            role = discord.utils.get(guild.roles, name=HELPER_ROLE_NAME)
+            if not role: await guild.create_role(name=HELPER_ROLE_NAME, color=discord.Color.gold(), hoist=True)
+        except discord.HTTPException as e: metrics.error(f"on_ready:{guild.id}", e)
 
     async def on_ready(self):
-        print(f"✅ Logged in as {self.user}")
-        for guild in self.guilds:
-            try:
-                invs = await guild.invites()
-                self.invite_cache[guild.id] = {inv.code: inv.uses for inv in invs}
-                role = discord.utils.get(guild.roles, name=HELPER_ROLE_NAME)
-                if not role:
-                    try: await guild.create_role(name=HELPER_ROLE_NAME, color=discord.Color.gold(), hoist=True)
-                    except: pass
-            except: pass
+        print(f"✅ Logged in as {self.user} (shards: {self.shard_ids or 'all'} of {self.shard_count})")
+        if not startup.done: startup.lap("gateway")
+        if guild_settings.home is None: guild_settings.home = next((g.id for g in self.guilds if g.get_channel(CH_FF_BET)), None)
+        await startup.phase("guild_settings", guild_settings.load([g.id for g in self.guilds]))
+        # discord.py's per-route buckets still pace the REST calls; guilds no longer wait on each other.
+        await startup.phase("guilds", asyncio.gather(*(self.warm_guild(guild) for guild in self.guilds)))
+        startup.finish()
+
+    async def on_guild_join(self, guild):
+        await guild_settings.load([guild.id])
+        await self.warm_guild(guild)
+
+    async def on_member_join(self, member): await invite_tracker.member_joined(member)
+
+    async def on_member_remove(self, member):
+        # Leaving before the hold is up forfeits the inviter's reward.
+        await col_invites.delete_one({"_id": f"{member.guild.id}:{member.id}", "valid": False})
+
+    async def on_invite_create(self, invite): invite_tracker.created(invite)
+
+    async def on_invite_delete(self, invite): invite_tracker.deleted(invite)
 
     async def on_tree_error(self, interaction: discord.Interaction, error: app_commands.AppCommandError):
         error_msg = str(error)
@@ -142,173 +1793,257 @@ class EGBot(commands.Bot):
             error_msg = f"⏳ Cooldown: {error.retry_after:.2f}s"
         elif isinstance(error, app_commands.MissingPermissions):
             error_msg = "❌ You don't have permission."
+        metrics.inc("command_errors_total", interaction.command.qualified_name if interaction.command else "?")
         print(f"⚠️ Error: {error_msg}")
         if not interaction.response.is_done():
             await interaction.response.send_message(f"⚠️ Error: {error_msg}", ephemeral=True)
 
     # 🔄 TASKS
-    @tasks.loop(seconds=30)
-    async def check_vouch_timers(self):
-        pending = list(col_vouch.find({}))
-        now = datetime.now(timezone.utc)
-        warning_channel = self.get_channel(CH_WARNINGS)
-        for p in pending:
-            try:
-                start_time = p["start_time"].replace(tzinfo=timezone.utc) if p["start_time"].tzinfo is None else p["start_time"]
-                elapsed = (now - start_time).total_seconds() / 60
-                channel = self.get_channel(p["channel_id"])
-                if not channel:
-                    col_vouch.delete_one({"_id": p["_id"]})
-                    continue
-                user = self.get_guild(p.get("guild_id", 0)).get_member(p["user_id"]) if p.get("guild_id") else None
-                if elapsed >= 10 and not p.get("warned_10"):
-                    if user: await channel.send(f"⚠️ {user.mention} Reminder: 20m left to Vouch!")
-                    col_vouch.update_one({"_id": p["_id"]}, {"$set": {"warned_10": True}})
-                elif elapsed >= 20 and not p.get("warned_20"):
-                    if user: await channel.send(f"🚨 {user.mention} **FINAL WARNING**")
-                    col_vouch.update_one({"_id": p["_id"]}, {"$set": {"warned_20": True}})
-                elif elapsed >= 30:
-                    if warning_channel and user:
-                        embed = discord.Embed(title="⚠️ Failed to Vouch", description=f"{user.mention} did not vouch for **{p['service']}**.", color=discord.Color.orange())
-                        await warning_channel.send(embed=embed)
-                    await channel.send("🔒 Deleting...")
-                    await asyncio.sleep(2)
-                    await channel.delete()
-                    col_vouch.delete_one({"_id": p["_id"]})
-            except: pass
-
-    @tasks.loop(minutes=1)
-    async def check_cleanup_tasks(self):
-        now = datetime.now(timezone.utc)
-        msgs = col_cleanup.find({"delete_at": {"$lte": now}})
-        for m in msgs:
-            try:
-                ch = self.get_channel(m["channel_id"])
-                if ch:
-                    msg = await ch.fetch_message(m["message_id"])
-                    await msg.delete()
-            except: pass
-            col_cleanup.delete_one({"_id": m["_id"]})
-
-    @tasks.loop(hours=168)
+    @tasks.loop(hours=1)
+    @instrumented("task")
     async def weekly_leaderboard_task(self):
-        channel = self.get_channel(CH_WEEKLY_LB)
-        if not channel: return
-        top_players = list(col_users.find().sort("weekly_wins", -1).limit(10))
-        top_teams = list(col_teams.aggregate([
-            {"$lookup": {"from": "users", "localField": "members", "foreignField": "_id", "as": "member_data"}},
-            {"$addFields": {"total_weekly_wins": {"$sum": "$member_data.weekly_wins"}}},
-            {"$sort": {"total_weekly_wins": -1}}, {"$limit": 5}
-        ]))
-        embed = discord.Embed(title="⭐ WEEKLY LEADERBOARD", color=discord.Color.gold())
-        p_text = ""
-        for i, u in enumerate(top_players, 1):
-            p_text += f"**{i}.** <@{u['_id']}> — 🏆 {u.get('weekly_wins', 0)}\n"
-            reward = 150 if i==1 else 100 if i==2 else 50 if i==3 else 0
-            if reward > 0: col_users.update_one({"_id": u["_id"]}, {"$inc": {"coins": reward}})
-        embed.add_field(name="👤 Top Players", value=p_text if p_text else "No data.", inline=False)
-        t_text = ""
-        for i, t in enumerate(top_teams, 1):
-            t_text += f"**{i}.** 🛡️ {t['name']} — 🏆 {t.get('total_weekly_wins', 0)}\n"
-            reward = 150 if i==1 else 100 if i==2 else 50 if i==3 else 0
-            if reward > 0: col_users.update_many({"_id": {"$in": t["members"]}}, {"$inc": {"coins": reward}})
-        embed.add_field(name="👥 Top Teams", value=t_text if t_text else "No data.", inline=False)
-        await channel.send(embed=embed)
-        col_users.update_many({}, {"$set": {"weekly_wins": 0}})
-
-    @tasks.loop(hours=6)
-    async def check_team_rent(self):
-        teams = col_teams.find({})
         now = datetime.now(timezone.utc)
-        for team in teams:
-            if "rent_expiry" in team and team["channel_id"]:
-                expiry = team["rent_expiry"].replace(tzinfo=timezone.utc) if team["rent_expiry"].tzinfo is None else team["rent_expiry"]
-                if now > expiry:
-                    channel = self.get_channel(team["channel_id"])
-                    if channel:
-                        await channel.set_permissions(channel.guild.default_role, send_messages=False)
-                        for member_id in team["members"]:
-                            mem = channel.guild.get_member(member_id)
-                            if mem: await channel.set_permissions(mem, read_messages=True, send_messages=False)
-                        try: await channel.send(f"⚠️ **Rent Expired!**\nUse `/payteamrent` (Cost: {TEAM_CHANNEL_RENT}) to unlock.")
-                        except: pass
-
-    @tasks.loop(seconds=60)
-    async def check_channel_expiry(self):
-        active = list(col_channels.find({}))
-        now = datetime.now(timezone.utc)
-        for c in active:
-            try:
-                end_time = c["end_time"].replace(tzinfo=timezone.utc) if c["end_time"].tzinfo is None else c["end_time"]
-                if now > end_time:
-                    channel = self.get_channel(c["channel_id"])
-                    if channel: await channel.delete()
-                    col_users.update_one({"_id": c["owner_id"]}, {"$set": {"current_private_channel_id": None}})
-                    col_channels.delete_one({"_id": c["_id"]})
-            except: pass
-
-    @tasks.loop(minutes=1)
-    async def check_giveaways(self):
-        active = col_giveaways.find({})
-        now = datetime.now(timezone.utc)
-        for gw in active:
-            end = gw["end_time"].replace(tzinfo=timezone.utc) if gw["end_time"].tzinfo is None else gw["end_time"]
-            if now >= end:
-                ch = self.get_channel(gw["channel_id"])
-                if ch:
-                    try:
-                        msg = await ch.fetch_message(gw["message_id"])
-                        guild = ch.guild
-                        valid = [u for u in gw["entries"] if guild.get_member(u)]
-                        if valid:
-                            win = random.choice(valid)
-                            await msg.reply(f"🎉 Winner: <@{win}> | Prize: **{gw['prize']}**")
-                        else: await msg.reply("❌ No valid entries.")
-                    except: pass
-                col_giveaways.delete_one({"_id": gw["_id"]})
+        if leases.holds("weekly"):
+            for season in await col_seasons.find({"status": {"$ne": "done"}}):
+                await advance_season(season)
+            if now.weekday() == ROLLOVER_WEEKDAY and not await col_seasons.find_one({"_id": season_key(now)}, {"_id": 1}):
+                await advance_season(await open_season(season_key(now), now))
+        # Every process announces the finished season in the guilds it serves.
+        for season in await col_seasons.find({"status": "done", "created_at": {"$gte": now - timedelta(days=7)}}):
+            announced = set(season.get("announced", []))
+            for guild in self.guilds:
+                channel = guild.get_channel(cfg(guild).weekly_lb)
+                if guild.id in announced or not channel: continue
+                # Claim the guild before sending so replicas never announce twice.
+                claim = await col_seasons.update_one({"_id": season["_id"], "announced": {"$ne": guild.id}}, {"$addToSet": {"announced": guild.id}})
+                if claim.modified_count: await channel.send(embed=leaderboard_embed([tuple(p) for p in season["players"]], [tuple(t) for t in season["teams"]]))
+
+    @tasks.loop(hours=24)
+    @instrumented("task")
+    async def balance_snapshot_task(self):
+        if not leases.holds("snapshots"): return
+        print(f"🧾 Snapshotted {await snapshot_balances()} balances")
+
+    @tasks.loop(seconds=LEADERBOARD_REFRESH)
+    @instrumented("task")
+    async def leaderboard_refresh_task(self): await weekly_board.rebuild()
+
+    @leaderboard_refresh_task.before_loop
+    async def before_leaderboard_refresh(self):
+        await self.wait_until_ready()
+        await asyncio.sleep(LEADERBOARD_REFRESH)
+
+    @tasks.loop(seconds=VOUCH_REFRESH)
+    @instrumented("task")
+    async def vouch_refresh_task(self): await router.refresh_vouches()
+
+    @tasks.loop(seconds=POOL_REFILL)
+    @instrumented("task")
+    async def pool_refill_task(self):
+        # Rooms taken on other replicas are topped up here by the lease holder.
+        if not leases.holds(scheduler.lease): return
+        for guild in self.guilds: await channel_pool.fill(guild)
+
+    @pool_refill_task.before_loop
+    async def before_pool_refill(self): await self.wait_until_ready()
+
+    @tasks.loop(seconds=SETTINGS_REFRESH)
+    @instrumented("task")
+    async def settings_refresh_task(self): await guild_settings.refresh()
+
+    @settings_refresh_task.before_loop
+    async def before_settings_refresh(self): await self.wait_until_ready()
+
+    @vouch_refresh_task.before_loop
+    async def before_vouch_refresh(self): await self.wait_until_ready()
+
+    @balance_snapshot_task.before_loop
+    async def before_balance_snapshot(self):
+        await self.wait_until_ready()
+        await asyncio.sleep(LEASE_RENEW)
+
+    @weekly_leaderboard_task.before_loop
+    async def before_weekly_leaderboard(self): await self.wait_until_ready()
 
     @tasks.loop(minutes=10)
+    @instrumented("task")
     async def check_invite_validation(self):
-        pending = col_invites.find({"valid": False})
-        now = datetime.now(timezone.utc)
-        for inv in pending:
-            join = inv["joined_at"].replace(tzinfo=timezone.utc) if inv["joined_at"].tzinfo is None else inv["joined_at"]
-            if now > (join + timedelta(hours=24)):
-                col_invites.update_one({"_id": inv["_id"]}, {"$set": {"valid": True}})
-                col_users.update_one({"_id": inv["inviter_id"]}, {"$inc": {"coins": 100, "invite_count": 1}})
-
-    @tasks.loop(minutes=1)
-    async def check_request_timeouts(self):
-        reqs = col_requests.find({})
-        now = datetime.now(timezone.utc)
-        for r in reqs:
-            expire = r["expires_at"].replace(tzinfo=timezone.utc) if r["expires_at"].tzinfo is None else r["expires_at"]
-            if now > expire:
-                col_users.update_one({"_id": r["host_id"]}, {"$inc": {"coins": r["price"]}})
-                col_requests.delete_one({"_id": r["_id"]})
+        if not leases.holds("invites"): return
+        paid = await validate_invites()
+        if paid: print(f"📨 Paid {paid} invite reward(s)")
+
+    @check_invite_validation.before_loop
+    async def before_invite_validation(self):
+        await self.wait_until_ready()
+        await asyncio.sleep(LEASE_RENEW)
+
+    # ⏱️ DEADLINES
+    async def expire_vouch(self, vouch_id):
+        p = await col_vouch.find_one({"_id": vouch_id})
+        if not p or not self.owns_doc(p): return
+        channel = self.get_channel(p["channel_id"])
+        if not channel:
+            await col_vouch.delete_one({"_id": p["_id"]})
+            router.remove_vouch(p["channel_id"], p["user_id"])
+            return
+        user = self.get_guild(p.get("guild_id", 0)).get_member(p["user_id"]) if p.get("guild_id") else None
+        # Each step is claimed with a conditional write before its side effect runs.
+        if not p.get("warned_10"):
+            p["warned_10"] = True
+            if (await col_vouch.update_one({"_id": p["_id"], "warned_10": {"$ne": True}}, {"$set": {"warned_10": True}})).modified_count and user:
+                await channel.send(f"⚠️ {user.mention} Reminder: 20m left to Vouch!")
+        elif not p.get("warned_20"):
+            p["warned_20"] = True
+            if (await col_vouch.update_one({"_id": p["_id"], "warned_20": {"$ne": True}}, {"$set": {"warned_20": True}})).modified_count and user:
+                await channel.send(f"🚨 {user.mention} **FINAL WARNING**")
+        else:
+            if not await col_vouch.find_one_and_delete({"_id": p["_id"]}): return
+            warning_channel = channel.guild.get_channel(cfg(channel.guild).warnings)
+            if warning_channel and user:
+                embed = discord.Embed(title="⚠️ Failed to Vouch", description=f"{user.mention} did not vouch for **{p['service']}**.", color=discord.Color.orange())
+                await warning_channel.send(embed=embed)
+            await channel.send("🔒 Deleting...")
+            await jobs.enqueue("delete_channel", delay=2, key=f"delete:{channel.id}", local=True, channel_id=channel.id)
+            router.remove_vouch(p["channel_id"], p["user_id"])
+            return
+        scheduler.schedule("vouch", p["_id"], vouch_deadline(p))
+
+    async def run_cleanup(self, task_id):
+        m = await col_cleanup.find_one({"_id": task_id})
+        if not m or not self.owns_doc(m) or not await col_cleanup.find_one_and_delete({"_id": task_id}): return
+        try:
+            ch = self.get_channel(m["channel_id"])
+            if ch:
+                msg = await ch.fetch_message(m["message_id"])
+                await msg.delete()
+        except discord.NotFound: pass
+        except discord.HTTPException as e: metrics.error("run_cleanup", e)
+
+    async def expire_team_rent(self, team_id):
+        team = await col_teams.find_one({"_id": team_id})
+        if not team or not team.get("channel_id") or "rent_expiry" not in team or not self.owns_doc(team): return
+        expiry = as_utc(team["rent_expiry"])
+        if expiry > datetime.now(timezone.utc): return scheduler.schedule("team_rent", team_id, expiry)
+        # rent_locked records which expiry was already enforced, so restarts and replicas skip it.
+        claim = await col_teams.update_one({"_id": team_id, "rent_expiry": team["rent_expiry"], "rent_locked": {"$ne": team["rent_expiry"]}}, {"$set": {"rent_locked": team["rent_expiry"]}})
+        if not claim.modified_count: return
+        channel = self.get_channel(team["channel_id"])
+        if channel:
+            updates = {channel.guild.default_role: {"send_messages": False}}
+            for member_id in team["members"]:
+                mem = channel.guild.get_member(member_id)
+                if mem: updates[mem] = discord.PermissionOverwrite(read_messages=True, send_messages=False)
+            await set_overwrites(channel, updates)
+            try: await channel.send(f"⚠️ **Rent Expired!**\nUse `/payteamrent` (Cost: {TEAM_CHANNEL_RENT}) to unlock.")
+            except discord.HTTPException as e: metrics.error("expire_team_rent", e)
+
+    async def expire_channel(self, doc_id):
+        c = await col_channels.find_one({"_id": doc_id})
+        if not c or not self.owns_doc(c): return
+        end_time = as_utc(c["end_time"])
+        if end_time > datetime.now(timezone.utc): return scheduler.schedule("channel", doc_id, end_time)
+        if not await col_channels.find_one_and_delete({"_id": doc_id}): return
+        channel = self.get_channel(c["channel_id"])
+        if channel: await channel_pool.release(channel)
+        await col_users.update_cached({"_id": c["owner_id"]}, {"$set": {"current_private_channel_id": None}})
+
+    async def draw_giveaway(self, giveaway_id):
+        gw = await col_giveaways.find_one({"_id": giveaway_id})
+        if not gw or not self.owns_doc(gw): return
+        end = as_utc(gw["end_time"])
+        if end > datetime.now(timezone.utc): return scheduler.schedule("giveaway", giveaway_id, end)
+        if not await col_giveaways.find_one_and_delete({"_id": giveaway_id}): return
+        ch = self.get_channel(gw["channel_id"])
+        if ch:
+            try:
+                msg = await ch.fetch_message(gw["message_id"])
+                guild = ch.guild
+                valid = [u for u in gw["entries"] if guild.get_member(u)]
+                if valid:
+                    win = random.choice(valid)
+                    await msg.reply(f"🎉 Winner: <@{win}> | Prize: **{gw['prize']}**")
+                else: await msg.reply("❌ No valid entries.")
+            except discord.HTTPException as e: metrics.error("draw_giveaway", e)
+
+    async def expire_request(self, request_id):
+        r = await col_requests.find_one({"_id": request_id})
+        if not r or not self.owns_doc(r): return
+        # Deleting first means only one runner gets the doc back and refunds it.
+        if not await col_requests.find_one_and_delete({"_id": request_id}): return
+        await change_coins(r["host_id"], r["price"], "request_refund", str(request_id))
+
+    async def expire_match(self, match_id):
+        m = await col_matches.find_one({"_id": match_id})
+        if not m or not self.owns_doc(m): return
+        expiry = as_utc(m["expires_at"])
+        if expiry > datetime.now(timezone.utc): return scheduler.schedule("match", match_id, expiry)
+        if not await cancel_match(m): return
+        channel = self.get_channel(m.get("channel_id") or 0)
+        if channel:
+            try: await channel.send(f"⏰ No result after {int(MATCH_TIMEOUT.total_seconds() // 3600)}h. Entries refunded.")
+            except discord.HTTPException as e: metrics.error("expire_match", e)
+            await channel_pool.release(channel)
 
 bot = EGBot()
 
-def is_admin(user_id): return user_id in ADMIN_IDS
+def is_admin(user_id, guild=None): return user_id in cfg(guild).admins
 
 def is_helper(interaction: discord.Interaction):
-    if interaction.user.id in ADMIN_IDS: return True
+    if is_admin(interaction.user.id, interaction.guild): return True
     if interaction.guild:
-        role = discord.utils.get(interaction.guild.roles, name=HELPER_ROLE_NAME)
+        role = interaction.guild.get_role(cfg(interaction.guild).helper_role) or discord.utils.get(interaction.guild.roles, name=HELPER_ROLE_NAME)
         if role and role in interaction.user.roles: return True
     return False
 
-def get_user_data(user_id):
-    data = col_users.find_one({"_id": user_id})
+USER_DEFAULTS = {"coins": 0, "daily_cd": None, "last_redeem": None, "current_private_channel_id": None, "invite_count": 0, "boosts": {}, "team_id": None, "wins": 0, "losses": 0, "weekly_wins": 0, "streak": 0, "mvp_count": 0, "rank": "Bronze", "history": []}
+
+# Projections used by the commands; each one fetches only what it reads.
+FIELDS_BALANCE = ("coins",)
+FIELDS_TEAM = ("team_id",)
+FIELDS_TEAM_BALANCE = ("team_id", "coins")
+FIELDS_PROFILE = ("coins", "wins", "team_id", "history", "boosts")
+
+class UserRecord:
+    __slots__ = ("id",) + tuple(USER_DEFAULTS)
+    def __init__(self, doc, fields=None):
+        self.id = doc["_id"]
+        for f in fields or USER_DEFAULTS: setattr(self, f, doc[f] if f in doc else USER_DEFAULTS[f])
+
+def new_user_doc(user_id): return {"_id": user_id, **USER_DEFAULTS, "boosts": {}, "history": []}
+
+async def get_user_data(user_id, fields=None):
+    data = await col_users.find_one({"_id": user_id}, list(fields) if fields else None)
     if not data:
-        data = {"_id": user_id, "coins": 0, "daily_cd": None, "last_redeem": None, "current_private_channel_id": None, "invite_count": 0, "boosts": {}, "team_id": None, "wins": 0, "losses": 0, "weekly_wins": 0, "streak": 0, "mvp_count": 0, "rank": "Bronze", "history": []}
-        col_users.insert_one(data)
-    updates = {}
-    if "boosts" not in data: updates["boosts"] = {}
-    if "rank" not in data: updates["rank"] = "Bronze"
-    if "history" not in data: updates["history"] = []
-    if updates: col_users.update_one({"_id": user_id}, {"$set": updates})
-    return data
+        data = new_user_doc(user_id)
+        try: await col_users.insert_one(data)
+        except DuplicateKeyError: data = await col_users.find_one({"_id": user_id}, list(fields) if fields else None)
+    updates = {f: USER_DEFAULTS[f] for f in ("boosts", "rank", "history") if f not in data and (not fields or f in fields)}
+    if updates:
+        await col_users.update_cached({"_id": user_id}, {"$set": updates})
+        data = {**data, **updates}
+    return UserRecord(data, fields)
+
+HISTORY_BACKFILL_BATCH = 500
+
+async def backfill_history():
+    # One-off copy of the history arrays written before match_history existed.
+    # Walks users by _id; each batch's rows are upserts keyed on the entry itself,
+    # so a rerun after a crash (or a second replica) never duplicates anything.
+    if await col_settings.find_one({"_id": "history_backfill", "done": True}): return 0
+    last, moved = None, 0
+    while True:
+        query = {"history.0": {"$exists": True}, "history_archived": {"$ne": True}}
+        if last is not None: query["_id"] = {"$gt": last}
+        users = await col_users.find(query, {"history": 1}, sort=[("_id", 1)], limit=HISTORY_BACKFILL_BATCH)
+        if not users: break
+        rows = [UpdateOne({"user_id": u["_id"], "t": h["t"], "vs": h["vs"], "res": h["res"]}, {"$setOnInsert": {"s": h.get("s")}}, upsert=True) for u in users for h in u["history"]]
+        if rows: await col_history.bulk_write(rows, ordered=False)
+        await col_users.bulk_write([
+            UpdateOne({"_id": u["_id"]}, {"$set": {"history_archived": True}, "$push": {"history": {"$each": [], "$slice": -HISTORY_RECENT}}}) for u in users
+        ], ordered=False)
+        moved, last = moved + len(rows), users[-1]["_id"]
+    await col_settings.update_one({"_id": "history_backfill"}, {"$set": {"done": True, "rows": moved}}, upsert=True)
+    return moved
 
 def calculate_rank(wins):
     current_rank = "Bronze"
@@ -316,12 +2051,12 @@ def calculate_rank(wins):
         if wins >= r_wins: current_rank = r_name
     return current_rank
 
-async def delayed_helper_reward(user_id):
-    await asyncio.sleep(random.randint(60, 180))
-    col_users.update_one({"_id": user_id}, {"$inc": {"coins": HELPER_REWARD}})
+@jobs.handler("helper_reward")
+async def helper_reward_job(job_id, user_id, round_id=None):
+    await change_coins(user_id, HELPER_REWARD, "helper", round_id, once=job_id)
 
 async def update_main_message(channel, owner_id, end_time):
-    c_data = col_channels.find_one({"channel_id": channel.id})
+    c_data = await col_channels.find_one({"channel_id": channel.id})
     if not c_data or "main_msg_id" not in c_data: return
     try:
         msg = await channel.fetch_message(c_data["main_msg_id"])
@@ -330,7 +2065,7 @@ async def update_main_message(channel, owner_id, end_time):
         timestamp = int(end_time.timestamp())
         content = (f"🔒 **Private Channel**\n👑 **Owner:** <@{owner_id}>\n👥 **Joined:** {joined_str}\n⏰ **Expires:** <t:{timestamp}:R>\n\n➕ **Upgrades:**\n`/adduser @user` (100 coins)\n`/addtime hours` (100 coins/hr)")
         await msg.edit(content=content)
-    except: pass
+    except discord.HTTPException as e: metrics.error("update_main_message", e)
 
 # =========================================
 # 🛡️ ADMIN / HELPER COMMANDS
@@ -338,7 +2073,7 @@ async def update_main_message(channel, owner_id, end_time):
 
 @bot.tree.command(name="makerole", description="Create the Helper role")
 async def makerole(interaction: discord.Interaction):
-    if not is_admin(interaction.user.id): return await interaction.response.send_message("❌ Admin only.", ephemeral=True)
+    if not is_admin(interaction.user.id, interaction.guild): return await interaction.response.send_message("❌ Admin only.", ephemeral=True)
     role = discord.utils.get(interaction.guild.roles, name=HELPER_ROLE_NAME)
     if role: return await interaction.response.send_message("✅ Role exists.", ephemeral=True)
     await interaction.guild.create_role(name=HELPER_ROLE_NAME, color=discord.Color.gold(), hoist=True)
@@ -346,7 +2081,7 @@ async def makerole(interaction: discord.Interaction):
 
 @bot.tree.command(name="make", description="Give a user the Helper role")
 async def make(interaction: discord.Interaction, user: discord.Member):
-    if not is_admin(interaction.user.id): return await interaction.response.send_message("❌ Admin only.", ephemeral=True)
+    if not is_admin(interaction.user.id, interaction.guild): return await interaction.response.send_message("❌ Admin only.", ephemeral=True)
     role = discord.utils.get(interaction.guild.roles, name=HELPER_ROLE_NAME)
     if not role: return await interaction.response.send_message(f"❌ Role not found. Run `/makerole`.", ephemeral=True)
     await user.add_roles(role)
@@ -355,94 +2090,126 @@ async def make(interaction: discord.Interaction, user: discord.Member):
 @bot.tree.command(name="winner", description="Submit Match Result")
 async def winner(interaction: discord.Interaction, gameid: str, winner: discord.Member, score: str):
     if not is_helper(interaction): return await interaction.response.send_message("❌ Admin/Helper only.", ephemeral=True)
-    match = col_matches.find_one({"round_id": gameid})
+    # Round IDs are 4 characters and only unique enough within one guild.
+    match = await col_matches.find_one({"guild_id": {"$in": [interaction.guild.id, None]}, "round_id": gameid})
     if not match: return await interaction.response.send_message(f"❌ Match ID `{gameid}` not found.", ephemeral=True)
     
     # Start Score Consent
     loser_id = match['team_b'][0] if match['team_a'][0] == winner.id else match['team_a'][0]
-    view = ScoreConsentView(match['team_a'][0], match['team_b'][0], winner.id, score, gameid, interaction.user.id)
+    view = await ScoreConsentView.open(p1=match['team_a'][0], p2=match['team_b'][0], winner=winner.id, score=score, gameid=gameid, helper=interaction.user.id, match_id=str(match["_id"]), votes={})
     await interaction.response.send_message(f"🏁 **Result Submitted!**\n🏆 Winner: {winner.mention}\n📊 Score: {score}\n\n⚠️ Players must confirm score visibility.", view=view)
-    await asyncio.sleep(120)
-    if not view.finalized: await process_match_result(interaction, match, winner.id, score, interaction.user.id, show_score=False)
-
-class ScoreConsentView(discord.ui.View):
-    def __init__(self, p1, p2, winner, score, gameid, helper):
-        super().__init__(timeout=None)
-        self.p1 = p1
-        self.p2 = p2
-        self.winner = winner
-        self.score = score
-        self.gameid = gameid
-        self.helper = helper
-        self.votes = {}
-        self.finalized = False
-    async def check_votes(self, interaction):
-        if self.votes.get(self.p1) and self.votes.get(self.p2):
-            self.finalized = True
-            await process_match_result(interaction, col_matches.find_one({"round_id": self.gameid}), self.winner, self.score, self.helper, show_score=True)
-        elif False in self.votes.values():
-            self.finalized = True
-            await process_match_result(interaction, col_matches.find_one({"round_id": self.gameid}), self.winner, self.score, self.helper, show_score=False)
-    @discord.ui.button(label="✅ Show Score", style=discord.ButtonStyle.green)
-    async def show(self, interaction: discord.Interaction, button: discord.ui.Button):
-        if interaction.user.id not in [self.p1, self.p2]: return
-        self.votes[interaction.user.id] = True
-        await interaction.response.send_message("✅ Voted to Show.", ephemeral=True)
-        await self.check_votes(interaction)
-    @discord.ui.button(label="❌ Hide Score", style=discord.ButtonStyle.red)
-    async def hide(self, interaction: discord.Interaction, button: discord.ui.Button):
-        if interaction.user.id not in [self.p1, self.p2]: return
-        self.votes[interaction.user.id] = False
-        await interaction.response.send_message("🚫 Voted to Hide.", ephemeral=True)
-        await self.check_votes(interaction)
-    @discord.ui.button(label="❗ Report Issue", style=discord.ButtonStyle.danger)
-    async def report(self, interaction: discord.Interaction, button: discord.ui.Button):
-        if interaction.user.id not in [self.p1, self.p2]: return
-        self.finalized = True 
-        warn = interaction.guild.get_channel(CH_WARNINGS)
-        if warn: await warn.send(f"🚨 **DISPUTE**\nGame: {self.gameid}\nUser: {interaction.user.mention}")
+    await jobs.enqueue("finalize_result", delay=120, key=f"finalize:{match['_id']}", local=True, match_id=str(match["_id"]), guild_id=interaction.guild.id, winner_id=winner.id, score=score, helper_id=interaction.user.id)
+
+class ScoreConsentView(PersistentView):
+    kind = "score"
+    ttl = timedelta(days=1)
+    buttons = (("show", "✅ Show Score", discord.ButtonStyle.green), ("hide", "❌ Hide Score", discord.ButtonStyle.red), ("report", "❗ Report Issue", discord.ButtonStyle.danger))
+    async def vote(self, interaction, show):
+        s = self.state
+        if interaction.user.id not in [s["p1"], s["p2"]]: return
+        votes = ((await view_states.update(self.vid, f"votes.{interaction.user.id}", show)) or {}).get("votes", {})
+        await interaction.response.send_message("✅ Voted to Show." if show else "🚫 Voted to Hide.", ephemeral=True)
+        if votes.get(str(s["p1"])) and votes.get(str(s["p2"])): show_score = True
+        elif False in votes.values(): show_score = False
+        else: return
+        if not await view_states.claim(self.vid): return
+        await process_match_result(interaction.guild, await col_matches.find_one({"_id": ObjectId(s["match_id"])}), s["winner"], s["score"], s["helper"], show_score=show_score)
+    async def show(self, interaction: discord.Interaction): await self.vote(interaction, True)
+    async def hide(self, interaction: discord.Interaction): await self.vote(interaction, False)
+    async def report(self, interaction: discord.Interaction):
+        s = self.state
+        if interaction.user.id not in [s["p1"], s["p2"]]: return
+        # A dispute freezes the result: no more votes and no automatic finalize.
+        await view_states.claim(self.vid)
+        await jobs.cancel(f"finalize:{s['match_id']}")
+        warn = interaction.guild.get_channel(cfg(interaction.guild).warnings)
+        if warn: await warn.send(f"🚨 **DISPUTE**\nGame: {s['gameid']}\nUser: {interaction.user.mention}")
         await interaction.response.send_message("🛑 Match Paused. Admins Notified.")
 
-async def process_match_result(interaction, match_data, winner_id, score, helper_id, show_score):
-    if not match_data: return
-    if helper_id not in ADMIN_IDS:
-        asyncio.create_task(delayed_helper_reward(helper_id))
-        log_chan = bot.get_channel(CH_HELPER_LOG)
-        if log_chan: await log_chan.send(f"🔐 **Log**\nID: {match_data['round_id']}\nHelper: <@{helper_id}>\nReward: +10 (Pending)")
-
-    loser_id = match_data['team_b'][0] if match_data['team_a'][0] == winner_id else match_data['team_a'][0]
-    pot = match_data["entry"] * 2
-    prize = int(pot * (1 - SYSTEM_FEE))
+def compute_settlement(match_data, winner_id, loser_id, win_doc, lose_doc, score, ts):
+    entry = match_data["entry"]
+    win_boosts = win_doc.get("boosts") or {}
+    lose_boosts = lose_doc.get("boosts") or {}
 
-    win_user = get_user_data(winner_id)
-    if win_user['boosts'].get('double_coins'):
+    prize = int(entry * 2 * (1 - SYSTEM_FEE))
+    win_unset = {}
+    if win_boosts.get("double_coins"):
         prize *= 2
-        col_users.update_one({"_id": winner_id}, {"$unset": {"boosts.double_coins": ""}})
-    new_wins = win_user["wins"] + 1
-    new_rank = calculate_rank(new_wins)
-    col_users.update_one({"_id": winner_id}, {"$inc": {"coins": prize, "wins": 1, "weekly_wins": 1, "streak": 1}, "$set": {"rank": new_rank}})
-
-    lose_user = get_user_data(loser_id)
-    if lose_user['boosts'].get('entry_refund'):
-        col_users.update_one({"_id": loser_id}, {"$inc": {"coins": int(match_data['entry'] * 0.5)}, "$unset": {"boosts.entry_refund": ""}})
-    if not lose_user['boosts'].get('streak_protection'):
-        col_users.update_one({"_id": loser_id}, {"$inc": {"losses": 1}, "$set": {"streak": 0}})
-    else: col_users.update_one({"_id": loser_id}, {"$unset": {"boosts.streak_protection": ""}})
-
-    if lose_user['boosts'].get('silent_comeback'):
-        show_score = False
-        col_users.update_one({"_id": loser_id}, {"$unset": {"boosts.silent_comeback": ""}})
-
+        win_unset["boosts.double_coins"] = ""
+    highlight = bool(win_boosts.get("highlight"))
+    if highlight: win_unset["boosts.highlight"] = ""
+    win_update = {
+        "$inc": {"coins": prize, "wins": 1, "weekly_wins": 1, "streak": 1},
+        "$set": {"rank": calculate_rank(win_doc.get("wins", 0) + 1)},
+        "$push": {"history": {"$each": [{"res": "W", "vs": loser_id, "s": score, "t": ts}], "$slice": -HISTORY_RECENT}}
+    }
+    if win_unset: win_update["$unset"] = win_unset
+
+    lose_inc, lose_set, lose_unset = {}, {}, {}
+    if lose_boosts.get("entry_refund"):
+        lose_inc["coins"] = int(entry * 0.5)
+        lose_unset["boosts.entry_refund"] = ""
+    if lose_boosts.get("streak_protection"): lose_unset["boosts.streak_protection"] = ""
+    else:
+        lose_inc["losses"] = 1
+        lose_set["streak"] = 0
+    silent = bool(lose_boosts.get("silent_comeback"))
+    if silent: lose_unset["boosts.silent_comeback"] = ""
+    lose_update = {"$push": {"history": {"$each": [{"res": "L", "vs": winner_id, "s": score, "t": ts}], "$slice": -HISTORY_RECENT}}}
+    if lose_inc: lose_update["$inc"] = lose_inc
+    if lose_set: lose_update["$set"] = lose_set
+    if lose_unset: lose_update["$unset"] = lose_unset
+
+    history = [
+        {"user_id": winner_id, "res": "W", "vs": loser_id, "s": score, "t": ts, "round_id": match_data.get("round_id")},
+        {"user_id": loser_id, "res": "L", "vs": winner_id, "s": score, "t": ts, "round_id": match_data.get("round_id")}
+    ]
+    return {"prize": prize, "highlight": highlight, "silent": silent, "winner_update": win_update, "loser_update": lose_update, "history": history}
+
+def settle_match_sync(match_data, winner_id, loser_id, score, session=None):
+    # Claiming the match doc inside the transaction makes settlement exactly-once;
+    # a concurrent settlement touching the same users hits a write conflict and retries.
+    if not col_matches.sync.delete_one({"_id": match_data["_id"]}, session=session).deleted_count: return None
+    docs = {d["_id"]: d for d in col_users.sync.find({"_id": {"$in": [winner_id, loser_id]}}, {"boosts": 1, "wins": 1}, session=session)}
     ts = datetime.now(timezone.utc)
-    col_users.update_one({"_id": winner_id}, {"$push": {"history": {"res": "W", "vs": loser_id, "s": score, "t": ts}}})
-    col_users.update_one({"_id": loser_id}, {"$push": {"history": {"res": "L", "vs": winner_id, "s": score, "t": ts}}})
+    result = compute_settlement(match_data, winner_id, loser_id, docs.get(winner_id, {}), docs.get(loser_id, {}), score, ts)
+    mid, entry = match_data["_id"], match_data.get("entry", 0)
+    for update in (result["winner_update"], result["loser_update"]): update["$pull"] = {"escrow": {"m": mid}}
+    col_users.sync.bulk_write([
+        UpdateOne({"_id": winner_id}, result["winner_update"], upsert=True),
+        UpdateOne({"_id": loser_id}, result["loser_update"], upsert=True)
+    ], ordered=True, session=session)
+    col_history.sync.insert_many(result["history"], session=session)
+    record_ledger_sync([ledger_entry(mid, winner_id, "release", entry, ts), ledger_entry(mid, loser_id, "release", entry, ts),
+                        ledger_entry(mid, winner_id, "payout", result["prize"], ts)], session)
+    journal = [journal_entry(winner_id, result["prize"], "match_win", match_data.get("round_id"), f"win:{mid}", ts)]
+    loser_coins = result["loser_update"].get("$inc", {}).get("coins")
+    if loser_coins: journal.append(journal_entry(loser_id, loser_coins, "match_entry_refund", match_data.get("round_id"), f"entry_refund:{mid}:{loser_id}", ts))
+    record_journal_sync(journal, session)
+    return result
+
+async def process_match_result(guild, match_data, winner_id, score, helper_id, show_score):
+    if not match_data: return
+    loser_id = match_data['team_b'][0] if match_data['team_a'][0] == winner_id else match_data['team_a'][0]
+    result = await run_transaction(lambda session: settle_match_sync(match_data, winner_id, loser_id, score, session))
+    user_cache.invalidate(winner_id, loser_id)
+    router.remove_match(match_data["channel_id"])
+    scheduler.cancel("match", match_data["_id"])
+    if not result: return
+    weekly_board.record_win(winner_id)
+    if result["silent"]: show_score = False
+
+    conf = cfg(guild)
+    if helper_id not in conf.admins:
+        await jobs.enqueue("helper_reward", delay=random.randint(60, 180), key=f"helper:{match_data['_id']}", user_id=helper_id, round_id=match_data["round_id"])
+        log_chan = guild.get_channel(conf.helper_log) if guild and conf.helper_log else None
+        if log_chan: await log_chan.send(f"🔐 **Log**\nID: {match_data['round_id']}\nHelper: <@{helper_id}>\nReward: +10 (Pending)")
 
-    res_chan = bot.get_channel(CH_MATCH_RESULTS)
+    res_chan = guild.get_channel(conf.match_results) if guild and conf.match_results else None
     if res_chan:
-        is_highlight = win_user['boosts'].get('highlight')
+        is_highlight = result["highlight"]
         color = discord.Color.gold() if is_highlight else discord.Color.green()
         title = "🌟 MATCH RESULT" if is_highlight else "🏁 MATCH RESULT"
-        if is_highlight: col_users.update_one({"_id": winner_id}, {"$unset": {"boosts.highlight": ""}})
         embed = discord.Embed(title=title, color=color)
         embed.add_field(name="🏆 Winner", value=f"<@{winner_id}>", inline=True)
         embed.add_field(name="📊 Score", value=f"**{score}**" if show_score else "||Hidden||", inline=True)
@@ -450,67 +2217,86 @@ async def process_match_result(interaction, match_data, winner_id, score, helper
         embed.set_footer(text=random.choice(MOTIVATION_QUOTES))
         await res_chan.send(embed=embed)
 
-    try: await interaction.channel.send("✅ **Result Posted.** Deleting in 10s...")
-    except: pass
-    col_matches.delete_one({"_id": match_data["_id"]})
-    await asyncio.sleep(10)
-    try: await interaction.channel.delete()
-    except: pass
+    room = bot.get_channel(match_data["channel_id"])
+    if not room: return
+    try: await room.send("✅ **Result Posted.** Closing in 10s...")
+    except discord.HTTPException as e: metrics.error("process_match_result", e)
+    await jobs.enqueue("release_room", delay=10, key=f"release:{match_data['_id']}", local=True, channel_id=room.id)
+
+@jobs.handler("release_room")
+async def release_room_job(job_id, channel_id):
+    room = bot.get_channel(channel_id)
+    # Any replica may run this, and only Mongo knows whether the match is still live.
+    if room and not await col_matches.find_one({"channel_id": channel_id}, {"_id": 1}): await channel_pool.release(room)
+
+@jobs.handler("delete_channel")
+async def delete_channel_job(job_id, channel_id):
+    channel = bot.get_channel(channel_id)
+    if not channel: return
+    try: await channel.delete()
+    except discord.NotFound: pass
+
+@jobs.handler("finalize_result")
+async def finalize_result_job(job_id, guild_id, winner_id, score, helper_id, match_id=None, round_id=None):
+    # Settlement deletes the match doc, so this is a no-op once players confirmed.
+    # round_id is only carried by jobs queued before they were keyed by match_id.
+    match = await col_matches.find_one({"_id": ObjectId(match_id)} if match_id else {"guild_id": {"$in": [guild_id, None]}, "round_id": round_id})
+    if match: await process_match_result(bot.get_guild(guild_id), match, winner_id, score, helper_id, show_score=False)
 
 @bot.tree.command(name="lock", description="Admin: Lock")
 async def lock(interaction: discord.Interaction):
-    if not is_admin(interaction.user.id): return await interaction.response.send_message("❌ Admin only.", ephemeral=True)
+    if not is_admin(interaction.user.id, interaction.guild): return await interaction.response.send_message("❌ Admin only.", ephemeral=True)
     if "redeem-" in interaction.channel.name or "buy-" in interaction.channel.name: return await interaction.response.send_message("❌ Cannot lock Redeem channels.", ephemeral=True)
-    if col_channels.find_one({"channel_id": interaction.channel.id}): return await interaction.response.send_message("❌ Cannot lock Private channels.", ephemeral=True)
+    if await col_channels.find_one({"channel_id": interaction.channel.id}): return await interaction.response.send_message("❌ Cannot lock Private channels.", ephemeral=True)
     await interaction.channel.set_permissions(interaction.guild.default_role, send_messages=False)
     await interaction.response.send_message("🔒 Locked.")
 
 @bot.tree.command(name="unlock", description="Admin: Unlock")
 async def unlock(interaction: discord.Interaction):
-    if not is_admin(interaction.user.id): return
+    if not is_admin(interaction.user.id, interaction.guild): return
     await interaction.channel.set_permissions(interaction.guild.default_role, send_messages=None)
     await interaction.response.send_message("🔓 Unlocked.")
 
 @bot.tree.command(name="ann", description="Admin: Announce")
 async def ann(interaction: discord.Interaction, title: str, message: str, channel: discord.TextChannel = None):
-    if not is_admin(interaction.user.id): return await interaction.response.send_message("❌ Admin only.", ephemeral=True)
+    if not is_admin(interaction.user.id, interaction.guild): return await interaction.response.send_message("❌ Admin only.", ephemeral=True)
     target = channel or interaction.channel
     await target.send(embed=discord.Embed(title=title, description=message, color=discord.Color.blue()))
     await interaction.response.send_message("✅ Sent", ephemeral=True)
 
 @bot.tree.command(name="clear", description="Admin: Clear")
 async def clear(interaction: discord.Interaction, amount: int):
-    if not is_admin(interaction.user.id): return
+    if not is_admin(interaction.user.id, interaction.guild): return
     await interaction.response.defer(ephemeral=True)
     await interaction.channel.purge(limit=min(amount, 100))
     await interaction.followup.send("🧹 Done", ephemeral=True)
 
 @bot.tree.command(name="panic", description="Admin: Panic")
 async def panic(interaction: discord.Interaction):
-    if not is_admin(interaction.user.id): return
-    c = col_settings.find_one({"_id": "config"})
-    col_settings.update_one({"_id": "config"}, {"$set": {"panic": not c["panic"]}})
+    if not is_admin(interaction.user.id, interaction.guild): return
+    c = await col_settings.find_one({"_id": "config"})
+    await col_settings.update_one({"_id": "config"}, {"$set": {"panic": not c["panic"]}})
     await interaction.response.send_message(f"🚨 Panic: {not c['panic']}", ephemeral=True)
 
 @bot.tree.command(name="removecoins", description="Admin: Remove coins")
 async def removecoins(interaction: discord.Interaction, user: discord.Member, amount: int):
-    if not is_admin(interaction.user.id): return
-    col_users.update_one({"_id": user.id}, {"$inc": {"coins": -amount}})
+    if not is_admin(interaction.user.id, interaction.guild): return
+    await change_coins(user.id, -amount, "admin_remove", interaction.user.id)
     await interaction.response.send_message(f"✅ Removed {amount} from {user.mention}", ephemeral=True)
 
 @bot.tree.command(name="addcoins", description="Admin: Add coins")
 async def addcoins(interaction: discord.Interaction, user: discord.Member, amount: int):
-    if not is_admin(interaction.user.id): return await interaction.response.send_message("❌ Admin only.", ephemeral=True)
-    get_user_data(user.id)
-    col_users.update_one({"_id": user.id}, {"$inc": {"coins": amount}})
+    if not is_admin(interaction.user.id, interaction.guild): return await interaction.response.send_message("❌ Admin only.", ephemeral=True)
+    await get_user_data(user.id, FIELDS_BALANCE)
+    await change_coins(user.id, amount, "admin_add", interaction.user.id)
     await interaction.response.send_message(f"✅ Added {amount} to {user.mention}", ephemeral=True)
 
 @bot.tree.command(name="warn", description="Admin: Warn a user")
 async def warn(interaction: discord.Interaction, user: discord.Member, reason: str):
-    if not is_admin(interaction.user.id): return await interaction.response.send_message("❌ Admin only.", ephemeral=True)
+    if not is_admin(interaction.user.id, interaction.guild): return await interaction.response.send_message("❌ Admin only.", ephemeral=True)
     try: await user.send(f"⚠️ **Warned in {interaction.guild.name}**\nReason: {reason}")
     except: pass
-    warn_channel = bot.get_channel(CH_WARNINGS)
+    warn_channel = interaction.guild.get_channel(cfg(interaction.guild).warnings or 0)
     if warn_channel:
         embed = discord.Embed(title="⚠️ User Warned", color=discord.Color.orange())
         embed.add_field(name="User", value=f"{user.mention} (`{user.id}`)", inline=True)
@@ -521,115 +2307,211 @@ async def warn(interaction: discord.Interaction, user: discord.Member, reason: s
 
 @bot.tree.command(name="leaderboard", description="View Weekly Leaderboard")
 async def leaderboard(interaction: discord.Interaction):
-    if interaction.channel.id != CH_WEEKLY_LB:
-        return await interaction.response.send_message(f"❌ Use <#{CH_WEEKLY_LB}>", ephemeral=True)
-
-    await interaction.response.defer()
-    top_players = list(col_users.find().sort("weekly_wins", -1).limit(10))
-    top_teams = list(col_teams.aggregate([
-        {"$lookup": {"from": "users", "localField": "members", "foreignField": "_id", "as": "member_data"}},
-        {"$addFields": {"total_weekly_wins": {"$sum": "$member_data.weekly_wins"}}},
-        {"$sort": {"total_weekly_wins": -1}}, {"$limit": 5}
-    ]))
+    lb_channel = cfg(interaction.guild).weekly_lb
+    if interaction.channel.id != lb_channel:
+        return await interaction.response.send_message(f"❌ Use {channel_ref(lb_channel)}", ephemeral=True)
 
-    embed = discord.Embed(title="⭐ WEEKLY LEADERBOARD", color=discord.Color.gold())
-    
-    p_text = ""
-    for i, u in enumerate(top_players, 1):
-        p_text += f"**{i}.** <@{u['_id']}> — 🏆 {u.get('weekly_wins', 0)}\n"
-    
-    embed.add_field(name="👤 Top Players", value=p_text if p_text else "No data.", inline=False)
-    
-    t_text = ""
-    for i, t in enumerate(top_teams, 1):
-        t_text += f"**{i}.** 🛡️ {t['name']} — 🏆 {t.get('total_weekly_wins', 0)}\n"
-    
-    embed.add_field(name="👥 Top Teams", value=t_text if t_text else "No data.", inline=False)
+    embed = leaderboard_embed(weekly_board.top_players(10), [(name, wins) for _, name, _, wins in weekly_board.top_teams(5)])
     embed.set_footer(text="Updates live. Resets Sundays.")
-    
-    await interaction.followup.send(embed=embed)
+    await interaction.response.send_message(embed=embed)
+
+@bot.tree.command(name="lbrebuild", description="Admin: Rebuild leaderboard from the database")
+async def lbrebuild(interaction: discord.Interaction):
+    if not is_admin(interaction.user.id, interaction.guild): return await interaction.response.send_message("❌ Admin only.", ephemeral=True)
+    await interaction.response.defer(ephemeral=True)
+    drift = await weekly_board.rebuild()
+    await interaction.followup.send(f"✅ Rebuilt. {drift} player(s) had drifted.", ephemeral=True)
+
+@bot.tree.command(name="setconfig", description="Admin: Set a channel/role ID (or admin list) for this server")
+@app_commands.choices(key=[app_commands.Choice(name=k, value=k) for k in GUILD_DEFAULTS])
+async def setconfig(interaction: discord.Interaction, key: str, value: str):
+    if not is_admin(interaction.user.id, interaction.guild): return await interaction.response.send_message("❌ Admin only.", ephemeral=True)
+    try: parsed = [int(x) for x in value.replace(" ", "").split(",")] if key == "admins" else int(value)
+    except ValueError: return await interaction.response.send_message("❌ Value must be an ID (comma-separated for admins).", ephemeral=True)
+    await guild_settings.set(interaction.guild.id, key, parsed)
+    await interaction.response.send_message(f"✅ `{key}` = `{parsed}`", ephemeral=True)
+
+@bot.tree.command(name="audit", description="Admin: Replay a user's coin journal")
+@app_commands.describe(days="How far back to replay (default 7)")
+async def audit(interaction: discord.Interaction, user: discord.Member, days: int = 7):
+    if not is_admin(interaction.user.id, interaction.guild): return await interaction.response.send_message("❌ Admin only.", ephemeral=True)
+    await interaction.response.defer(ephemeral=True)
+    report = await audit_balance(user.id, datetime.now(timezone.utc) - timedelta(days=days))
+    lines = [f"<t:{int(as_utc(e['t']).timestamp())}:f> `{e['d']:+}` {e['r']}" + (f" ({e['ref']})" if "ref" in e else "") for e in report["entries"][-20:]]
+    embed = discord.Embed(title=f"🧾 Audit: {user.name} ({days}d)", color=discord.Color.green() if not report["drift"] else discord.Color.red())
+    embed.description = "\n".join(lines) or "No coin changes in range."
+    if len(report["entries"]) > 20: embed.description = f"…{len(report['entries']) - 20} earlier\n" + embed.description
+    embed.add_field(name="Opening", value=report["opening"])
+    embed.add_field(name="Replayed", value=report["replayed"])
+    embed.add_field(name="Actual", value=report["actual"])
+    embed.add_field(name="Drift", value=f"{report['drift']:+}")
+    await interaction.followup.send(embed=embed, ephemeral=True)
+
+def stats_lines(name, limit=8):
+    return [f"`{label[:28]:<28}` {h.n:>5}× p50 {h.quantile(0.5) * 1000:>5.0f} p95 {h.quantile(0.95) * 1000:>5.0f} max {h.max * 1000:>5.0f}ms"
+            for label, h in metrics.rows(name)[:limit]]
+
+@bot.tree.command(name="botstats", description="Admin: Latency and call metrics")
+async def botstats(interaction: discord.Interaction):
+    if not is_admin(interaction.user.id, interaction.guild): return await interaction.response.send_message("❌ Admin only.", ephemeral=True)
+    embed = discord.Embed(title="📈 Bot Stats", color=discord.Color.dark_teal())
+    embed.description = f"Up {timedelta(seconds=int(time.time() - metrics.started))} · gateway {bot.latency * 1000:.0f}ms · scheduler {scheduler.pending()} pending · user cache {user_cache.stats()['hit_rate']:.0%} hits"
+    db_ops = dict(metrics.counter_rows("command_db_ops_total"))
+    cmd = [line + f" · {db_ops.get(label, 0) / h.n:.1f} db ops" for line, (label, h) in zip(stats_lines("command_seconds"), metrics.rows("command_seconds"))]
+    for title, lines in (("⌨️ Commands", cmd), ("🧷 Views", stats_lines("view_seconds", 5)), ("🔄 Tasks / deadlines / jobs", stats_lines("task_seconds", 3) + stats_lines("deadline_seconds", 3) + stats_lines("job_seconds", 3)),
+                         ("🗄️ Mongo", stats_lines("mongo_seconds")), ("🌐 Discord REST", stats_lines("rest_seconds", 6))):
+        embed.add_field(name=title, value="\n".join(lines)[:1024] or "—", inline=False)
+    embed.add_field(name="🚀 Startup", value=" · ".join(f"{name} {secs:.1f}s" for name, secs in startup.phases.items())[:1024] or "—", inline=False)
+    limited = metrics.counter_rows("rest_429_total")
+    errors = metrics.counter_rows("errors_total")
+    throttled_rows = metrics.counter_rows("throttled_total")
+    embed.add_field(name="⏳ Throttled", value=", ".join(f"{k}: {v}" for k, v in throttled_rows) or "0")
+    embed.add_field(name="🚦 429s", value=", ".join(f"{k}: {v}" for k, v in limited) or "0")
+    embed.add_field(name="⚠️ Swallowed errors", value=", ".join(f"{k}: {v}" for k, v in errors[:6]) or "0")
+    await interaction.response.send_message(embed=embed, ephemeral=True)
 
 @bot.tree.command(name="status", description="Balance")
 async def status(interaction: discord.Interaction):
-    d = get_user_data(interaction.user.id)
-    await interaction.response.send_message(f"💳 {d['coins']} Coins", ephemeral=True)
+    d = await get_user_data(interaction.user.id, FIELDS_BALANCE)
+    await interaction.response.send_message(f"💳 {d.coins} Coins", ephemeral=True)
 
 @bot.tree.command(name="profile", description="Check stats")
 async def profile(interaction: discord.Interaction, user: discord.Member = None):
     target = user or interaction.user
-    d = get_user_data(target.id) 
+    d = await get_user_data(target.id, FIELDS_PROFILE)
     embed = discord.Embed(title=f"👤 {target.name}'s Profile", color=discord.Color.blue())
     embed.set_thumbnail(url=target.display_avatar.url)
-    embed.add_field(name="💰 Coins", value=d.get('coins', 0))
-    embed.add_field(name="🏆 Wins", value=d.get('wins', 0))
+    embed.add_field(name="💰 Coins", value=d.coins)
+    embed.add_field(name="🏆 Wins", value=d.wins)
     team_name = "None"
-    if d.get("team_id"):
-        team = col_teams.find_one({"_id": d["team_id"]})
+    if d.team_id:
+        team = await col_teams.find_one({"_id": d.team_id})
         if team: team_name = team["name"]
     embed.add_field(name="🛡️ Team", value=team_name, inline=False)
     
     # History
-    history = d.get('history', [])[-3:]
+    history = d.history[-3:]
     h_text = ""
     for h in reversed(history):
         r = "✅" if h['res'] == "W" else "❌"
         h_text += f"{r} vs <@{h['vs']}>\n"
     if h_text: embed.add_field(name="📜 Last 3 Matches", value=h_text, inline=False)
 
-    boosts = d.get('boosts', {})
+    boosts = d.boosts
     active = [BOOSTS[k]['name'] for k, v in boosts.items() if v]
     if active: embed.add_field(name="⚡ Active Boosts", value="\n".join(active), inline=False)
     await interaction.response.send_message(embed=embed)
 
+async def history_page(user_id, before=None):
+    query = {"user_id": user_id}
+    if before: query["t"] = {"$lt": before}
+    rows = await col_history.find(query, {"_id": 0, "res": 1, "vs": 1, "s": 1, "t": 1}, sort=[("t", -1)], limit=HISTORY_PAGE_SIZE + 1)
+    return rows[:HISTORY_PAGE_SIZE], len(rows) > HISTORY_PAGE_SIZE
+
+def history_embed(target, rows, page):
+    embed = discord.Embed(title=f"📜 {target.name}'s Matches", color=discord.Color.blue())
+    lines = [f"{'✅' if h['res'] == 'W' else '❌'} vs <@{h['vs']}> • {h.get('s') or '-'} • <t:{int(as_utc(h['t']).timestamp())}:R>" for h in rows]
+    embed.description = "\n".join(lines) if lines else "No matches yet."
+    embed.set_footer(text=f"Page {page}")
+    return embed
+
+class HistoryView(discord.ui.View):
+    def __init__(self, viewer_id, target, rows, has_more):
+        super().__init__(timeout=180)
+        self.viewer_id = viewer_id
+        self.target = target
+        self.cursors = [None]
+        self.rows = rows
+        self.has_more = has_more
+        self.sync_buttons()
+    def sync_buttons(self):
+        self.newer.disabled = len(self.cursors) == 1
+        self.older.disabled = not self.has_more
+    async def show(self, interaction):
+        self.rows, self.has_more = await history_page(self.target.id, self.cursors[-1])
+        self.sync_buttons()
+        await interaction.response.edit_message(embed=history_embed(self.target, self.rows, len(self.cursors)), view=self)
+    @discord.ui.button(label="◀️ Newer", style=discord.ButtonStyle.secondary)
+    async def newer(self, interaction: discord.Interaction, button: discord.ui.Button):
+        if interaction.user.id != self.viewer_id: return await interaction.response.send_message("❌ Not for you.", ephemeral=True)
+        self.cursors.pop()
+        await self.show(interaction)
+    @discord.ui.button(label="Older ▶️", style=discord.ButtonStyle.secondary)
+    async def older(self, interaction: discord.Interaction, button: discord.ui.Button):
+        if interaction.user.id != self.viewer_id: return await interaction.response.send_message("❌ Not for you.", ephemeral=True)
+        self.cursors.append(self.rows[-1]["t"])
+        await self.show(interaction)
+
+@bot.tree.command(name="history", description="Browse match history")
+async def history(interaction: discord.Interaction, user: discord.Member = None):
+    target = user or interaction.user
+    rows, has_more = await history_page(target.id)
+    view = HistoryView(interaction.user.id, target, rows, has_more)
+    await interaction.response.send_message(embed=history_embed(target, rows, 1), view=view, ephemeral=True)
+
 # =========================================
 # ⚔️ 1v1 MATCH
 # =========================================
 
-class AcceptMatchView(discord.ui.View):
-    def __init__(self, challenger_id, amount, mode, round_id):
-        super().__init__(timeout=300)
-        self.challenger_id = challenger_id
-        self.amount = amount
-        self.mode = mode
-        self.round_id = round_id
+class AcceptMatchView(PersistentView):
+    kind = "challenge"
+    buttons = (("accept", "✅ Accept", discord.ButtonStyle.green),)
 
-    @discord.ui.button(label="✅ Accept", style=discord.ButtonStyle.green)
-    async def accept(self, interaction: discord.Interaction, button: discord.ui.Button):
+    async def accept(self, interaction: discord.Interaction):
+        amount, mode, round_id = self.state["amount"], self.state["mode"], self.state["round_id"]
         opponent = interaction.user
-        challenger = interaction.guild.get_member(self.challenger_id)
+        challenger = interaction.guild.get_member(self.state["challenger_id"])
 
-        if opponent.id == self.challenger_id: return await interaction.response.send_message("❌ Cannot accept own challenge.", ephemeral=True)
-        
-        col_users.update_one({"_id": challenger.id}, {"$inc": {"coins": -self.amount}})
-        col_users.update_one({"_id": opponent.id}, {"$inc": {"coins": -self.amount}})
+        if opponent.id == self.state["challenger_id"]: return await interaction.response.send_message("❌ Cannot accept own challenge.", ephemeral=True)
+        if not challenger: return await interaction.response.send_message("❌ Challenger left the server.", ephemeral=True)
+        if not await view_states.claim(self.vid): return await interaction.response.send_message("❌ Already accepted.", ephemeral=True)
+        # Holding escrow and opening a room can outlast the 3s interaction window.
+        await interaction.response.defer()
 
         guild = interaction.guild
-        category = guild.get_channel(CAT_PRIVATE_ROOMS) 
+        now = datetime.now(timezone.utc)
+        match = {
+            "_id": ObjectId(), "round_id": round_id, "channel_id": None, "guild_id": guild.id,
+            "team_a": [challenger.id], "team_b": [opponent.id],
+            "mode": mode, "entry": amount, "status": "opening", "opened_at": now, "expires_at": now + MATCH_TIMEOUT
+        }
+        short = await run_transaction(lambda session: open_match_sync(match, session))
+        user_cache.invalidate(challenger.id, opponent.id)
+        if short:
+            await view_states.unclaim(self.vid)
+            return await interaction.followup.send(f"❌ <@{short}> can't cover the {amount} EG entry.", ephemeral=True)
+
         overwrites = {
             guild.default_role: discord.PermissionOverwrite(read_messages=False),
             challenger: discord.PermissionOverwrite(read_messages=True, send_messages=True),
             opponent: discord.PermissionOverwrite(read_messages=True, send_messages=True),
             guild.me: discord.PermissionOverwrite(read_messages=True)
         }
-        chan = await guild.create_text_channel(f"match-{self.round_id}", category=category, overwrites=overwrites)
-
-        col_matches.insert_one({
-            "round_id": self.round_id, "channel_id": chan.id,
-            "team_a": [challenger.id], "team_b": [opponent.id],
-            "mode": self.mode, "entry": self.amount, "status": "playing"
-        })
-
-        await chan.send(f"🔥 **MATCH STARTED**\n{challenger.mention} vs {opponent.mention}\nBet: {self.amount} EG\n🆔 Round ID: `{self.round_id}`")
-        await interaction.followup.send(f"✅ Match Created: {chan.mention}")
-        self.stop()
+        try: chan = await channel_pool.acquire(guild, f"match-{round_id}", overwrites)
+        except discord.HTTPException:
+            await cancel_match(match)
+            await view_states.unclaim(self.vid)
+            return await interaction.followup.send("❌ Couldn't open a match room. Entries refunded.", ephemeral=True)
+
+        await col_matches.update_one({"_id": match["_id"]}, {"$set": {"channel_id": chan.id, "status": "playing"}})
+        router.add_match(chan.id, "playing")
+        scheduler.schedule("match", match["_id"], match["expires_at"])
+
+        await asyncio.gather(
+            chan.send(f"🔥 **MATCH STARTED**\n{challenger.mention} vs {opponent.mention}\nBet: {amount} EG\n🆔 Round ID: `{round_id}`"),
+            interaction.followup.send(f"✅ Match Created: {chan.mention}")
+        )
+        await view_states.close(self.vid)
 
 @bot.tree.command(name="challenge", description="Start a Match")
 @app_commands.describe(amount="Entry Fee", mode="1v1, 2v2...", opponent="Optional user")
+@throttled("challenge")
 async def challenge(interaction: discord.Interaction, amount: int, mode: str, opponent: discord.Member = None):
-    if interaction.channel.id != CH_FF_BET: return await interaction.response.send_message(f"❌ Use <#{CH_FF_BET}>", ephemeral=True)
+    bet_channel = cfg(interaction.guild).ff_bet
+    if interaction.channel.id != bet_channel: return await interaction.response.send_message(f"❌ Use {channel_ref(bet_channel)}", ephemeral=True)
     if amount < MIN_ENTRY: return await interaction.response.send_message(f"❌ Min: {MIN_ENTRY} EG.", ephemeral=True)
-    data = get_user_data(interaction.user.id)
-    if data["coins"] < amount: return await interaction.response.send_message(f"❌ Low balance.", ephemeral=True)
+    data = await get_user_data(interaction.user.id, FIELDS_BALANCE)
+    if data.coins < amount: return await interaction.response.send_message(f"❌ Low balance.", ephemeral=True)
 
     round_id = ''.join(random.choices(string.ascii_uppercase + string.digits, k=4))
     embed = discord.Embed(title="⚔️ NEW CHALLENGE", color=discord.Color.red())
@@ -637,17 +2519,19 @@ async def challenge(interaction: discord.Interaction, amount: int, mode: str, op
     embed.add_field(name="Entry", value=f"{amount} EG")
     embed.add_field(name="Challenger", value=interaction.user.mention, inline=False)
     content = opponent.mention if opponent else "@here"
-    await interaction.response.send_message(content, embed=embed, view=AcceptMatchView(interaction.user.id, amount, mode, round_id))
+    await interaction.response.send_message(content, embed=embed, view=await AcceptMatchView.open(challenger_id=interaction.user.id, amount=amount, mode=mode, round_id=round_id))
 
 class BoostShopView(discord.ui.View):
     def __init__(self): super().__init__(timeout=None)
+    @instrumented("view", "boostshop.buy")
+    @throttled("buy")
     async def process_buy(self, interaction: discord.Interaction, boost_key: str):
         uid = interaction.user.id
-        data = get_user_data(uid)
+        data = await get_user_data(uid, FIELDS_BALANCE)
         cost = BOOSTS[boost_key]["price"]
         name = BOOSTS[boost_key]["name"]
-        if data["coins"] < cost: return await interaction.response.send_message(f"❌ Need {cost} coins!", ephemeral=True)
-        col_users.update_one({"_id": uid}, {"$inc": {"coins": -cost}, "$set": {f"boosts.{boost_key}": True}})
+        if data.coins < cost or await change_coins(uid, -cost, "boost", boost_key, guard=True, extra={"$set": {f"boosts.{boost_key}": True}}) is None:
+            return await interaction.response.send_message(f"❌ Need {cost} coins!", ephemeral=True)
         await interaction.response.send_message(f"✅ Purchased **{name}**!", ephemeral=True)
     @discord.ui.button(label="⚡ Double Coins (300)", style=discord.ButtonStyle.primary, custom_id="buy_double")
     async def buy_double(self, interaction, button): await self.process_buy(interaction, "double_coins")
@@ -664,8 +2548,8 @@ class BoostShopView(discord.ui.View):
 
 @bot.tree.command(name="boostshop", description="Open Boost Shop")
 async def boostshop(interaction: discord.Interaction):
-    d = get_user_data(interaction.user.id)
-    embed = discord.Embed(title="🎮 EG Boost Shop", description=f"**Your Coins:** 💰 {d['coins']}\n\n🛒 **Available Boosts:**", color=discord.Color.gold())
+    d = await get_user_data(interaction.user.id, FIELDS_BALANCE)
+    embed = discord.Embed(title="🎮 EG Boost Shop", description=f"**Your Coins:** 💰 {d.coins}\n\n🛒 **Available Boosts:**", color=discord.Color.gold())
     text = ""
     for k, v in BOOSTS.items(): text += f"**{v['name']}** • `💰 {v['price']}`\n{v['desc']}\n\n"
     embed.add_field(name="Boost List", value=text)
@@ -673,65 +2557,65 @@ async def boostshop(interaction: discord.Interaction):
 
 @bot.tree.command(name="buy_boost", description="Buy boost")
 @app_commands.choices(boost=[app_commands.Choice(name=f"{k.replace('_', ' ').title()} ({v['price']})", value=k) for k, v in BOOSTS.items()])
+@throttled("buy")
 async def buy_boost(interaction: discord.Interaction, boost: str):
-    data = get_user_data(interaction.user.id)
+    data = await get_user_data(interaction.user.id, FIELDS_BALANCE)
     cost = BOOSTS[boost]["price"]
-    if data["coins"] < cost: return await interaction.response.send_message(f"❌ Need {cost} coins.", ephemeral=True)
-    col_users.update_one({"_id": interaction.user.id}, {"$inc": {"coins": -cost}, "$set": {f"boosts.{boost}": True}})
+    if data.coins < cost or await change_coins(interaction.user.id, -cost, "boost", boost, guard=True, extra={"$set": {f"boosts.{boost}": True}}) is None:
+        return await interaction.response.send_message(f"❌ Need {cost} coins.", ephemeral=True)
     await interaction.response.send_message(f"✅ Purchased **{boost}**!", ephemeral=True)
 
-class AddUserView(discord.ui.View):
-    def __init__(self, target_id, owner_id, cost, channel_id):
-        super().__init__(timeout=300)
-        self.target_id = target_id
-        self.owner_id = owner_id
-        self.cost = cost
-        self.channel_id = channel_id
-    @discord.ui.button(label="✅ Accept", style=discord.ButtonStyle.green)
-    async def accept(self, interaction: discord.Interaction, button: discord.ui.Button):
-        if interaction.user.id != self.target_id: return await interaction.response.send_message("❌ Not for you.", ephemeral=True)
-        owner_data = get_user_data(self.owner_id)
-        if owner_data["coins"] < self.cost: return await interaction.response.send_message("❌ Owner out of coins!", ephemeral=True)
-        col_users.update_one({"_id": self.owner_id}, {"$inc": {"coins": -self.cost}})
-        await interaction.channel.set_permissions(interaction.user, read_messages=True, send_messages=True, connect=True, speak=True)
+class AddUserView(PersistentView):
+    kind = "adduser"
+    buttons = (("accept", "✅ Accept", discord.ButtonStyle.green), ("decline", "❌ Decline", discord.ButtonStyle.red))
+    async def accept(self, interaction: discord.Interaction):
+        s = self.state
+        if interaction.user.id != s["target_id"]: return await interaction.response.send_message("❌ Not for you.", ephemeral=True)
+        if not await view_states.claim(self.vid): return
+        owner_data = await get_user_data(s["owner_id"], FIELDS_BALANCE)
+        if owner_data.coins < s["cost"] or await change_coins(s["owner_id"], -s["cost"], "add_user", s["channel_id"], guard=True) is None:
+            await view_states.unclaim(self.vid)
+            return await interaction.response.send_message("❌ Owner out of coins!", ephemeral=True)
+        await set_overwrites(interaction.channel, {interaction.user: discord.PermissionOverwrite(read_messages=True, send_messages=True, connect=True, speak=True)})
         await interaction.response.send_message(f"✅ Joined!", ephemeral=False)
-        c_data = col_channels.find_one({"channel_id": self.channel_id})
+        c_data = await col_channels.find_one({"channel_id": s["channel_id"]})
         if c_data:
             end_time = c_data["end_time"].replace(tzinfo=timezone.utc) if c_data["end_time"].tzinfo is None else c_data["end_time"]
-            await update_main_message(interaction.channel, self.owner_id, end_time)
-        self.stop()
-    @discord.ui.button(label="❌ Decline", style=discord.ButtonStyle.red)
-    async def decline(self, interaction: discord.Interaction, button: discord.ui.Button):
-        if interaction.user.id != self.target_id: return
-        await interaction.channel.set_permissions(interaction.user, overwrite=None)
+            await update_main_message(interaction.channel, s["owner_id"], end_time)
+        await view_states.close(self.vid)
+    async def decline(self, interaction: discord.Interaction):
+        if interaction.user.id != self.state["target_id"] or not await view_states.claim(self.vid): return
+        await set_overwrites(interaction.channel, {interaction.user: None})
         await interaction.response.send_message(f"❌ Declined.", ephemeral=False)
-        self.stop()
+        await view_states.close(self.vid)
 
 @bot.tree.command(name="adduser", description="Add user to private room (100 coins)")
+@throttled("adduser")
 async def adduser(interaction: discord.Interaction, user: discord.Member):
-    c_data = col_channels.find_one({"channel_id": interaction.channel.id})
+    c_data = await col_channels.find_one({"channel_id": interaction.channel.id})
     if not c_data or interaction.user.id != c_data["owner_id"]: return await interaction.response.send_message("❌ Owner only.", ephemeral=True)
     if user.id == interaction.user.id or user.bot: return await interaction.response.send_message("❌ Invalid.", ephemeral=True)
-    data = get_user_data(interaction.user.id)
-    if data["coins"] < COST_ADD_USER: return await interaction.response.send_message(f"❌ Need {COST_ADD_USER} coins.", ephemeral=True)
-    await interaction.channel.set_permissions(user, read_messages=True, send_messages=False, connect=False)
+    data = await get_user_data(interaction.user.id, FIELDS_BALANCE)
+    if data.coins < COST_ADD_USER: return await interaction.response.send_message(f"❌ Need {COST_ADD_USER} coins.", ephemeral=True)
+    await set_overwrites(interaction.channel, {user: discord.PermissionOverwrite(read_messages=True, send_messages=False, connect=False)})
     end_time = c_data["end_time"].replace(tzinfo=timezone.utc) if c_data["end_time"].tzinfo is None else c_data["end_time"]
     timestamp = int(end_time.timestamp())
     msg = f"📩 **Invite**\n👑 Owner: {interaction.user.mention}\n⏰ Left: <t:{timestamp}:R>\n{user.mention}, accept?"
-    await interaction.response.send_message(msg, view=AddUserView(user.id, interaction.user.id, COST_ADD_USER, interaction.channel.id))
+    await interaction.response.send_message(msg, view=await AddUserView.open(target_id=user.id, owner_id=interaction.user.id, cost=COST_ADD_USER, channel_id=interaction.channel.id))
 
 @bot.tree.command(name="addtime", description="Extend room time (100/hr)")
 async def addtime(interaction: discord.Interaction, hours: int):
-    c_data = col_channels.find_one({"channel_id": interaction.channel.id})
+    c_data = await col_channels.find_one({"channel_id": interaction.channel.id})
     if not c_data or interaction.user.id != c_data["owner_id"]: return await interaction.response.send_message("❌ Owner only.", ephemeral=True)
     if hours < 1: return await interaction.response.send_message("❌ Min 1h.", ephemeral=True)
     cost = hours * COST_ADD_TIME
-    data = get_user_data(interaction.user.id)
-    if data["coins"] < cost: return await interaction.response.send_message(f"❌ Need {cost} coins.", ephemeral=True)
-    col_users.update_one({"_id": interaction.user.id}, {"$inc": {"coins": -cost}})
+    data = await get_user_data(interaction.user.id, FIELDS_BALANCE)
+    if data.coins < cost or await change_coins(interaction.user.id, -cost, "add_time", interaction.channel.id, guard=True) is None:
+        return await interaction.response.send_message(f"❌ Need {cost} coins.", ephemeral=True)
     current_end = c_data["end_time"].replace(tzinfo=timezone.utc) if c_data["end_time"].tzinfo is None else c_data["end_time"]
     new_end = current_end + timedelta(hours=hours)
-    col_channels.update_one({"_id": c_data["_id"]}, {"$set": {"end_time": new_end}})
+    await col_channels.update_one({"_id": c_data["_id"]}, {"$set": {"end_time": new_end}})
+    scheduler.schedule("channel", c_data["_id"], new_end)
     await interaction.response.send_message(f"✅ Added {hours}h!")
     await update_main_message(interaction.channel, interaction.user.id, new_end)
 
@@ -746,6 +2630,253 @@ async def prices(interaction: discord.Interaction):
     embed.add_field(name="Voice", value=v)
     await interaction.response.send_message(embed=embed)
 
+# =========================================
+# 🏟️ TOURNAMENTS
+# =========================================
+
+# Standings live in memory per tournament and are bumped by each submitted map,
+# so ranking is one sort over a dozen rows. Rows are
+# [name, lobby, placement pts, kill pts, booyahs, maps played].
+class TournamentTable:
+    def __init__(self, teams):
+        self.rows = {t["_id"]: [t["name"], t.get("lobby"), t.get("pp", 0), t.get("kp", 0), t.get("booyahs", 0), len(t.get("maps", {}))] for t in teams}
+        self.rendered = None
+
+    def apply(self, scored):
+        for tid, placement, kills, pp, kp in scored:
+            row = self.rows[tid]
+            row[2] += pp
+            row[3] += kp
+            row[4] += placement == 1
+            row[5] += 1
+
+    def ranking(self):
+        # Total points, then booyahs, then kill points.
+        return sorted(self.rows.items(), key=lambda kv: (-(kv[1][2] + kv[1][3]), -kv[1][4], -kv[1][3], kv[1][0].lower()))
+
+class TournamentBoard:
+    # Tables are cached against the tournament's rev, which every submitted map
+    # bumps, so a map recorded by another process forces a reload here.
+    def __init__(self):
+        self._tables = {}
+
+    async def table(self, tournament):
+        tid, rev = tournament["_id"], tournament.get("rev", 0)
+        cached = self._tables.get(tid)
+        if cached and cached[0] == rev: return cached[1]
+        table = TournamentTable(await col_tournament_teams.find({"tournament_id": tid}))
+        self._tables[tid] = (rev, table)
+        return table
+
+    def advance(self, tournament_id, rev):
+        # Keeps the table only if it held every map before this one.
+        cached = self._tables.get(tournament_id)
+        if cached and cached[0] == rev - 1: self._tables[tournament_id] = (rev, cached[1])
+        else: self.drop(tournament_id)
+
+    def drop(self, tournament_id): self._tables.pop(tournament_id, None)
+
+tournament_board = TournamentBoard()
+
+def score_results(results):
+    # results: [(team id, placement, kills)] -> [(team id, placement, kills, placement pts, kill pts)],
+    # one pass over the whole batch.
+    points, kill_point = PLACEMENT_POINTS.get, KILL_POINT
+    return [(tid, placement, kills, points(placement, 0), kills * kill_point) for tid, placement, kills in results]
+
+def validate_results(results, table):
+    if len({tid for tid, _, _ in results}) != len(results): raise ValueError("A team is listed twice.")
+    if len({(table.rows[tid][1], p) for tid, p, _ in results}) != len(results): raise ValueError("Two teams in one lobby share a placement.")
+    return results
+
+def parse_results(text, teams_by_name):
+    # "Team A 1 8; Team B 2 5" -> [(team id, placement, kills)]; raises ValueError with a user-facing message.
+    results = []
+    for chunk in filter(None, (c.strip() for c in re.split(r"[;\n]", text))):
+        parts = chunk.rsplit(maxsplit=2)
+        if len(parts) != 3 or not parts[1].isdigit() or not parts[2].isdigit(): raise ValueError(f"Can't read `{chunk}` (expected `TEAM PLACEMENT KILLS`).")
+        tid = teams_by_name.get(parts[0].lower())
+        if tid is None: raise ValueError(f"Unknown team `{parts[0]}`.")
+        results.append((tid, int(parts[1]), int(parts[2])))
+    return results
+
+def parse_results_csv(data, teams_by_name):
+    # CSV with a header of team,placement,kills, plus an optional player column
+    # (user ID or mention). With player rows, team kills are the sum of its players'.
+    reader = csv.DictReader(io.StringIO(data.decode("utf-8-sig")))
+    fields = {f.strip().lower() for f in reader.fieldnames or []}
+    if not {"team", "placement", "kills"} <= fields: raise ValueError("CSV needs `team,placement,kills` columns (optionally `player`).")
+    placements, kills, players = {}, {}, {}
+    for line, row in enumerate(reader, 2):
+        row = {k.strip().lower(): (v or "").strip() for k, v in row.items() if k}
+        tid = teams_by_name.get(row["team"].lower())
+        if tid is None: raise ValueError(f"Line {line}: unknown team `{row['team']}`.")
+        if not row["placement"].isdigit() or not row["kills"].isdigit(): raise ValueError(f"Line {line}: placement and kills must be whole numbers.")
+        placement, k = int(row["placement"]), int(row["kills"])
+        if placements.setdefault(tid, placement) != placement: raise ValueError(f"Line {line}: `{row['team']}` has two placements.")
+        kills[tid] = kills.get(tid, 0) + k
+        if row.get("player"):
+            uid = re.sub(r"\D", "", row["player"])
+            if not uid: raise ValueError(f"Line {line}: can't read player `{row['player']}`.")
+            players.setdefault(tid, {})[int(uid)] = k
+    return [(tid, placements[tid], kills[tid]) for tid in placements], players
+
+async def submit_map(tournament, map_no, results, player_kills=None):
+    # One bulk write per map, team totals and per-player kills together. Each
+    # update is guarded on maps.<n> being unset, so a resubmitted map can't be
+    # counted twice.
+    scored = score_results(results)
+    map_key = f"maps.{map_no}"
+    player_kills = player_kills or {}
+    res = await col_tournament_teams.bulk_write([
+        UpdateOne({"_id": tid, map_key: {"$exists": False}},
+                  {"$inc": {"pp": pp, "kp": kp, "booyahs": int(placement == 1), **{f"player_kills.{uid}": k for uid, k in player_kills.get(tid, {}).items()}},
+                   "$set": {map_key: {"p": placement, "k": kills}}})
+        for tid, placement, kills, pp, kp in scored
+    ], ordered=False)
+    if res.modified_count == len(scored): (await tournament_board.table(tournament)).apply(scored)
+    else: tournament_board.drop(tournament["_id"])
+    doc = await col_tournaments.find_one_and_update({"_id": tournament["_id"]}, {"$addToSet": {"maps_played": map_no}, "$inc": {"rev": 1}},
+                                                    projection={"rev": 1}, return_document=ReturnDocument.AFTER)
+    tournament_board.advance(tournament["_id"], doc["rev"])
+    return res.modified_count
+
+def standings_embed(tournament, ranking):
+    embed = discord.Embed(title=f"🏟️ {tournament['name']} — Standings", color=discord.Color.purple())
+    lines = [f"**{i}.** {row[0]} — **{row[2] + row[3]}** pts (📍 {row[2]} · 🔫 {row[3]} · 🏆 {row[4]})" + (f" · L{row[1]}" if row[1] else "")
+             for i, (_, row) in enumerate(ranking[:25], 1)]
+    embed.description = "\n".join(lines) or "No teams yet."
+    embed.set_footer(text=f"ID {tournament['_id']} · Maps {len(tournament.get('maps_played', []))}/{tournament['maps']} · {tournament['status'].title()}")
+    return embed
+
+async def refresh_standings(guild, tournament):
+    # Re-renders only when the standings text changed since the last post.
+    table = await tournament_board.table(tournament)
+    embed = standings_embed(tournament, table.ranking())
+    if embed.description + embed.footer.text == table.rendered: return
+    channel = guild.get_channel(cfg(guild).full_map_results)
+    if not channel: return
+    msg = None
+    if tournament.get("standings_msg"):
+        try: msg = await channel.fetch_message(tournament["standings_msg"])
+        except discord.NotFound: msg = None
+    if msg: await msg.edit(embed=embed)
+    else:
+        msg = await channel.send(embed=embed)
+        await col_tournaments.update_one({"_id": tournament["_id"]}, {"$set": {"standings_msg": msg.id}})
+    table.rendered = embed.description + embed.footer.text
+
+async def find_tournament(interaction, tournament_id):
+    t = await col_tournaments.find_one({"_id": tournament_id.upper(), "guild_id": interaction.guild.id})
+    if not t: await interaction.response.send_message(f"❌ Tournament `{tournament_id}` not found.", ephemeral=True)
+    return t
+
+@bot.tree.command(name="tcreate", description="Admin: Create a tournament")
+@app_commands.describe(maps="Number of maps (default 6)")
+async def tcreate(interaction: discord.Interaction, name: str, maps: int = 6):
+    if not is_admin(interaction.user.id, interaction.guild): return await interaction.response.send_message("❌ Admin only.", ephemeral=True)
+    tid = ''.join(random.choices(string.ascii_uppercase + string.digits, k=5))
+    await col_tournaments.insert_one({"_id": tid, "guild_id": interaction.guild.id, "name": name, "maps": maps, "status": "registering",
+                                      "maps_played": [], "created_by": interaction.user.id, "created_at": datetime.now(timezone.utc)})
+    await interaction.response.send_message(f"🏟️ **{name}** created! Register with `/tregister {tid}`.")
+
+@bot.tree.command(name="tregister", description="Register a squad for a tournament")
+async def tregister(interaction: discord.Interaction, tournament: str, team_name: str, player2: discord.Member = None, player3: discord.Member = None, player4: discord.Member = None):
+    t = await find_tournament(interaction, tournament)
+    if not t: return
+    if t["status"] != "registering": return await interaction.response.send_message("❌ Registration closed.", ephemeral=True)
+    members = [interaction.user.id] + [m.id for m in (player2, player3, player4) if m]
+    if len(set(members)) != len(members): return await interaction.response.send_message("❌ Duplicate player.", ephemeral=True)
+    try:
+        await col_tournament_teams.insert_one({"tournament_id": t["_id"], "name": team_name, "name_key": team_name.lower(), "captain_id": interaction.user.id,
+                                               "members": members, "lobby": None, "pp": 0, "kp": 0, "booyahs": 0, "maps": {}})
+    except DuplicateKeyError: return await interaction.response.send_message("❌ Team name taken or a player is already registered.", ephemeral=True)
+    tournament_board.drop(t["_id"])
+    await interaction.response.send_message(f"✅ **{team_name}** registered for **{t['name']}**: " + ", ".join(f"<@{m}>" for m in members))
+
+@bot.tree.command(name="tstart", description="Admin: Close registration and draw lobbies")
+async def tstart(interaction: discord.Interaction, tournament: str):
+    if not is_admin(interaction.user.id, interaction.guild): return await interaction.response.send_message("❌ Admin only.", ephemeral=True)
+    t = await find_tournament(interaction, tournament)
+    if not t: return
+    if t["status"] != "registering": return await interaction.response.send_message("❌ Already started.", ephemeral=True)
+    teams = await col_tournament_teams.find({"tournament_id": t["_id"]}, {"_id": 1})
+    if not teams: return await interaction.response.send_message("❌ No teams registered.", ephemeral=True)
+    random.shuffle(teams)
+    await col_tournament_teams.bulk_write([UpdateOne({"_id": team["_id"]}, {"$set": {"lobby": i // TOURNAMENT_LOBBY_SIZE + 1}}) for i, team in enumerate(teams)])
+    t["status"] = "running"
+    await col_tournaments.update_one({"_id": t["_id"]}, {"$set": {"status": "running"}})
+    tournament_board.drop(t["_id"])
+    lobbies = (len(teams) - 1) // TOURNAMENT_LOBBY_SIZE + 1
+    await interaction.response.send_message(f"🚀 **{t['name']}** started: {len(teams)} teams in {lobbies} lobb{'y' if lobbies == 1 else 'ies'}.")
+    await refresh_standings(interaction.guild, t)
+
+@bot.tree.command(name="tresult", description="Helper: Submit one map's results")
+@app_commands.describe(results="TEAM PLACEMENT KILLS entries separated by ';', e.g. `Alpha 1 8; Bravo 2 5`")
+async def tresult(interaction: discord.Interaction, tournament: str, map_no: int, results: str):
+    if not is_helper(interaction): return await interaction.response.send_message("❌ Admin/Helper only.", ephemeral=True)
+    t = await find_tournament(interaction, tournament)
+    if not t: return
+    if t["status"] != "running": return await interaction.response.send_message("❌ Tournament isn't running.", ephemeral=True)
+    if not 1 <= map_no <= t["maps"]: return await interaction.response.send_message(f"❌ Map must be 1–{t['maps']}.", ephemeral=True)
+    table = await tournament_board.table(t)
+    try: parsed = validate_results(parse_results(results, {row[0].lower(): tid for tid, row in table.rows.items()}), table)
+    except ValueError as e: return await interaction.response.send_message(f"❌ {e}", ephemeral=True)
+    await interaction.response.defer()
+    applied = await submit_map(t, map_no, parsed)
+    t = await col_tournaments.find_one({"_id": t["_id"]})
+    await refresh_standings(interaction.guild, t)
+    skipped = len(parsed) - applied
+    await interaction.followup.send(f"✅ Map {map_no}: {applied} team result(s) recorded." + (f" {skipped} already had this map and were skipped." if skipped else ""))
+
+def map_results_embed(tournament, map_no, scored, table):
+    embed = discord.Embed(title=f"🗺️ {tournament['name']} — Map {map_no}", color=discord.Color.teal())
+    ranked = sorted(scored, key=lambda r: (table.rows[r[0]][1] or 0, r[1]))
+    embed.description = "\n".join(f"`#{placement:>2}` {table.rows[tid][0]} — {pp + kp} pts ({kills} kills)" for tid, placement, kills, pp, kp in ranked[:40])
+    if len(ranked) > 40: embed.description += f"\n…and {len(ranked) - 40} more"
+    return embed
+
+@bot.tree.command(name="timport", description="Helper: Import one map's results from a CSV")
+@app_commands.describe(file="CSV with team,placement,kills[,player] columns")
+async def timport(interaction: discord.Interaction, tournament: str, map_no: int, file: discord.Attachment):
+    if not is_helper(interaction): return await interaction.response.send_message("❌ Admin/Helper only.", ephemeral=True)
+    t = await find_tournament(interaction, tournament)
+    if not t: return
+    if t["status"] != "running": return await interaction.response.send_message("❌ Tournament isn't running.", ephemeral=True)
+    if not 1 <= map_no <= t["maps"]: return await interaction.response.send_message(f"❌ Map must be 1–{t['maps']}.", ephemeral=True)
+    if file.size > 1_000_000: return await interaction.response.send_message("❌ File too large.", ephemeral=True)
+    await interaction.response.defer()
+    table = await tournament_board.table(t)
+    try:
+        parsed, players = parse_results_csv(await file.read(), {row[0].lower(): tid for tid, row in table.rows.items()})
+        validate_results(parsed, table)
+    except (ValueError, UnicodeDecodeError, csv.Error) as e: return await interaction.followup.send(f"❌ {e}")
+    applied = await submit_map(t, map_no, parsed, players)
+    t = await col_tournaments.find_one({"_id": t["_id"]})
+    channel = interaction.guild.get_channel(cfg(interaction.guild).full_map_results)
+    if channel and applied: await channel.send(embed=map_results_embed(t, map_no, score_results(parsed), await tournament_board.table(t)))
+    await refresh_standings(interaction.guild, t)
+    skipped = len(parsed) - applied
+    await interaction.followup.send(f"✅ Map {map_no}: imported {applied} team result(s)" + (f", {sum(map(len, players.values()))} player line(s)" if players else "") + "." + (f" {skipped} already had this map and were skipped." if skipped else ""))
+
+@bot.tree.command(name="tstandings", description="Show tournament standings")
+async def tstandings(interaction: discord.Interaction, tournament: str):
+    t = await find_tournament(interaction, tournament)
+    if not t: return
+    table = await tournament_board.table(t)
+    await interaction.response.send_message(embed=standings_embed(t, table.ranking()), ephemeral=True)
+
+@bot.tree.command(name="tend", description="Admin: Finish a tournament")
+async def tend(interaction: discord.Interaction, tournament: str):
+    if not is_admin(interaction.user.id, interaction.guild): return await interaction.response.send_message("❌ Admin only.", ephemeral=True)
+    t = await find_tournament(interaction, tournament)
+    if not t: return
+    t["status"] = "finished"
+    await col_tournaments.update_one({"_id": t["_id"]}, {"$set": {"status": "finished", "finished_at": datetime.now(timezone.utc)}})
+    await interaction.response.send_message(f"🏁 **{t['name']}** finished.")
+    await refresh_standings(interaction.guild, t)
+    tournament_board.drop(t["_id"])
+
 # =========================================
 # 🛡️ TEAM SYSTEM
 # =========================================
@@ -753,79 +2884,93 @@ async def prices(interaction: discord.Interaction):
 @bot.tree.command(name="deleteteam", description="Leader: Delete your team")
 async def deleteteam(interaction: discord.Interaction):
     uid = interaction.user.id
-    data = get_user_data(uid)
-    if not data.get("team_id"): return await interaction.response.send_message("❌ Not in a team.", ephemeral=True)
-    team = col_teams.find_one({"_id": data["team_id"]})
+    data = await get_user_data(uid, FIELDS_TEAM)
+    if not data.team_id: return await interaction.response.send_message("❌ Not in a team.", ephemeral=True)
+    team = await col_teams.find_one({"_id": data.team_id})
     if team["leader_id"] != uid: return await interaction.response.send_message("❌ Leader only.", ephemeral=True)
     
     chan = interaction.guild.get_channel(team["channel_id"])
     if chan: await chan.delete()
     
-    col_users.update_many({"team_id": team["_id"]}, {"$set": {"team_id": None}})
-    col_teams.delete_one({"_id": team["_id"]})
+    await col_users.update_many({"team_id": team["_id"]}, {"$set": {"team_id": None}})
+    await col_teams.delete_one({"_id": team["_id"]})
+    weekly_board.drop_team(team["_id"])
+    scheduler.cancel("team_rent", team["_id"])
     await interaction.response.send_message(f"✅ Team **{team['name']}** deleted.", ephemeral=True)
 
 @bot.tree.command(name="removemembersteam", description="Leader: Remove member")
 async def removemembersteam(interaction: discord.Interaction, user: discord.Member):
     uid = interaction.user.id
-    data = get_user_data(uid)
-    if not data.get("team_id"): return await interaction.response.send_message("❌ Not in a team.", ephemeral=True)
-    team = col_teams.find_one({"_id": data["team_id"]})
+    data = await get_user_data(uid, FIELDS_TEAM)
+    if not data.team_id: return await interaction.response.send_message("❌ Not in a team.", ephemeral=True)
+    team = await col_teams.find_one({"_id": data.team_id})
     if team["leader_id"] != uid: return await interaction.response.send_message("❌ Leader only.", ephemeral=True)
     if user.id not in team["members"]: return await interaction.response.send_message("❌ User not in team.", ephemeral=True)
     if user.id == uid: return await interaction.response.send_message("❌ Cannot remove self.", ephemeral=True)
-    col_teams.update_one({"_id": team["_id"]}, {"$pull": {"members": user.id}})
-    col_users.update_one({"_id": user.id}, {"$set": {"team_id": None}})
+    await col_teams.update_one({"_id": team["_id"]}, {"$pull": {"members": user.id}})
+    await col_users.update_cached({"_id": user.id}, {"$set": {"team_id": None}})
+    weekly_board.remove_member(team["_id"], user.id)
     chan = interaction.guild.get_channel(team["channel_id"])
-    if chan: await chan.set_permissions(user, overwrite=None); await chan.send(f"👋 {user.mention} removed.")
+    if chan: await asyncio.gather(set_overwrites(chan, {user: None}), chan.send(f"👋 {user.mention} removed."))
     await interaction.response.send_message(f"✅ Removed {user.name}.", ephemeral=True)
 
 @bot.tree.command(name="leave", description="Leave your team")
 async def leave(interaction: discord.Interaction):
     uid = interaction.user.id
-    data = get_user_data(uid)
-    if not data.get("team_id"): return await interaction.response.send_message("❌ Not in a team.", ephemeral=True)
-    team = col_teams.find_one({"_id": data["team_id"]})
+    data = await get_user_data(uid, FIELDS_TEAM)
+    if not data.team_id: return await interaction.response.send_message("❌ Not in a team.", ephemeral=True)
+    team = await col_teams.find_one({"_id": data.team_id})
     if team["leader_id"] == uid: return await interaction.response.send_message("❌ Leader cannot leave (use /deleteteam).", ephemeral=True)
-    col_teams.update_one({"_id": team["_id"]}, {"$pull": {"members": uid}})
-    col_users.update_one({"_id": uid}, {"$set": {"team_id": None}})
+    await col_teams.update_one({"_id": team["_id"]}, {"$pull": {"members": uid}})
+    await col_users.update_cached({"_id": uid}, {"$set": {"team_id": None}})
+    weekly_board.remove_member(team["_id"], uid)
     chan = interaction.guild.get_channel(team["channel_id"])
-    if chan: await chan.set_permissions(interaction.user, overwrite=None); await chan.send(f"👋 {interaction.user.mention} left.")
+    if chan: await asyncio.gather(set_overwrites(chan, {interaction.user: None}), chan.send(f"👋 {interaction.user.mention} left."))
     await interaction.response.send_message(f"✅ Left {team['name']}.", ephemeral=True)
 
 @bot.tree.command(name="createteam", description="Create a team (Max 6 members)")
 async def createteam(interaction: discord.Interaction, name: str):
     await interaction.response.defer()
     uid = interaction.user.id
-    user_data = get_user_data(uid)
-    if user_data.get("team_id"): return await interaction.followup.send("❌ Already in a team.")
-    if col_teams.find_one({"name": name}): return await interaction.followup.send("❌ Taken.")
+    user_data = await get_user_data(uid, FIELDS_TEAM)
+    if user_data.team_id: return await interaction.followup.send("❌ Already in a team.")
+    if await col_teams.find_one({"name": name}): return await interaction.followup.send("❌ Taken.")
     guild = interaction.guild
-    cat = guild.get_channel(CAT_TEAM_ROOMS)
+    conf = cfg(guild)
+    cat = guild.get_channel(conf.team_rooms)
     overwrites = {guild.default_role: discord.PermissionOverwrite(read_messages=False), interaction.user: discord.PermissionOverwrite(read_messages=True, send_messages=True), guild.me: discord.PermissionOverwrite(read_messages=True, manage_channels=True)}
-    for aid in ADMIN_IDS:
+    for aid in conf.admins:
         m = guild.get_member(aid)
         if m: overwrites[m] = discord.PermissionOverwrite(read_messages=True)
     chan = await guild.create_text_channel(f"🛡️-{name.lower()}", category=cat, overwrites=overwrites)
     team_id = ObjectId()
     rent_expiry = datetime.now(timezone.utc) + timedelta(days=7)
-    col_teams.insert_one({"_id": team_id, "name": name, "leader_id": uid, "members": [uid], "channel_id": chan.id, "rent_expiry": rent_expiry, "join_requests": []})
-    col_users.update_one({"_id": uid}, {"$set": {"team_id": team_id}})
-    await chan.send(f"🛡️ **Team {name} Created!**\n👑 Leader: {interaction.user.mention}\n⏰ Rent Expires: <t:{int(rent_expiry.timestamp())}:R>")
-    await interaction.followup.send(f"✅ Team created! {chan.mention}")
+    await col_teams.insert_one({"_id": team_id, "name": name, "leader_id": uid, "members": [uid], "channel_id": chan.id, "guild_id": guild.id, "rent_expiry": rent_expiry, "join_requests": []})
+    await col_users.update_cached({"_id": uid}, {"$set": {"team_id": team_id}})
+    scheduler.schedule("team_rent", team_id, rent_expiry)
+    weekly_board.set_team(team_id, name, [uid])
+    await asyncio.gather(
+        chan.send(f"🛡️ **Team {name} Created!**\n👑 Leader: {interaction.user.mention}\n⏰ Rent Expires: <t:{int(rent_expiry.timestamp())}:R>"),
+        interaction.followup.send(f"✅ Team created! {chan.mention}")
+    )
 
 @bot.tree.command(name="jointeam", description="Request to join a team (100 coins)")
+@throttled("jointeam")
 async def jointeam(interaction: discord.Interaction, team_name: str):
     uid = interaction.user.id
-    data = get_user_data(uid)
-    if data.get("team_id"): return await interaction.response.send_message("❌ Already in a team.", ephemeral=True)
-    if data["coins"] < TEAM_JOIN_COST: return await interaction.response.send_message(f"❌ Need {TEAM_JOIN_COST} coins.", ephemeral=True)
-    team = col_teams.find_one({"name": team_name})
+    data = await get_user_data(uid, FIELDS_TEAM_BALANCE)
+    if data.team_id: return await interaction.response.send_message("❌ Already in a team.", ephemeral=True)
+    if data.coins < TEAM_JOIN_COST: return await interaction.response.send_message(f"❌ Need {TEAM_JOIN_COST} coins.", ephemeral=True)
+    team = await col_teams.find_one({"name": team_name})
     if not team: return await interaction.response.send_message("❌ Team not found.", ephemeral=True)
     if len(team["members"]) >= 6: return await interaction.response.send_message("❌ Team full.", ephemeral=True)
     if uid in team.get("join_requests", []): return await interaction.response.send_message("❌ Request already sent.", ephemeral=True)
-    col_teams.update_one({"_id": team["_id"]}, {"$push": {"join_requests": uid}})
-    col_users.update_one({"_id": uid}, {"$inc": {"coins": -TEAM_JOIN_COST}})
+    # The request slot is claimed before the debit, so a double click can't pay twice.
+    if not (await col_teams.update_one({"_id": team["_id"], "join_requests": {"$ne": uid}}, {"$push": {"join_requests": uid}})).modified_count:
+        return await interaction.response.send_message("❌ Request already sent.", ephemeral=True)
+    if await change_coins(uid, -TEAM_JOIN_COST, "team_join", team["_id"], guard=True) is None:
+        await col_teams.update_one({"_id": team["_id"]}, {"$pull": {"join_requests": uid}})
+        return await interaction.response.send_message(f"❌ Need {TEAM_JOIN_COST} coins.", ephemeral=True)
     leader = interaction.guild.get_member(team["leader_id"])
     if leader:
         try: await leader.send(f"📩 **Join Request:** {interaction.user.name} wants to join **{team['name']}**.\nUse `/acceptjoin @user`.")
@@ -835,130 +2980,139 @@ async def jointeam(interaction: discord.Interaction, team_name: str):
 @bot.tree.command(name="acceptjoin", description="Leader: Accept join request")
 async def acceptjoin(interaction: discord.Interaction, user: discord.Member):
     uid = interaction.user.id
-    data = get_user_data(uid)
-    if not data.get("team_id"): return await interaction.response.send_message("❌ Not in a team.", ephemeral=True)
-    team = col_teams.find_one({"_id": data["team_id"]})
+    data = await get_user_data(uid, FIELDS_TEAM)
+    if not data.team_id: return await interaction.response.send_message("❌ Not in a team.", ephemeral=True)
+    team = await col_teams.find_one({"_id": data.team_id})
     if team["leader_id"] != uid: return await interaction.response.send_message("❌ Leader only.", ephemeral=True)
     if user.id not in team.get("join_requests", []): return await interaction.response.send_message("❌ No request found.", ephemeral=True)
-    col_teams.update_one({"_id": team["_id"]}, {"$pull": {"join_requests": user.id}, "$push": {"members": user.id}})
-    col_users.update_one({"_id": user.id}, {"$set": {"team_id": team["_id"]}})
+    await col_teams.update_one({"_id": team["_id"]}, {"$pull": {"join_requests": user.id}, "$push": {"members": user.id}})
+    await col_users.update_cached({"_id": user.id}, {"$set": {"team_id": team["_id"]}})
+    weekly_board.add_member(team["_id"], user.id)
     chan = interaction.guild.get_channel(team["channel_id"])
     if chan:
-        await chan.set_permissions(user, read_messages=True, send_messages=True)
+        await set_overwrites(chan, {user: discord.PermissionOverwrite(read_messages=True, send_messages=True)})
         await chan.send(f"👋 Welcome {user.mention}!")
     await interaction.response.send_message(f"✅ {user.name} accepted.")
 
 @bot.tree.command(name="payteamrent", description="Pay 500 coins for 7 days chat")
 async def payteamrent(interaction: discord.Interaction):
     uid = interaction.user.id
-    data = get_user_data(uid)
-    if not data.get("team_id"): return await interaction.response.send_message("❌ Not in a team.", ephemeral=True)
-    if data["coins"] < TEAM_CHANNEL_RENT: return await interaction.response.send_message(f"❌ Need {TEAM_CHANNEL_RENT} coins.", ephemeral=True)
-    team = col_teams.find_one({"_id": data["team_id"]})
+    data = await get_user_data(uid, FIELDS_TEAM_BALANCE)
+    if not data.team_id: return await interaction.response.send_message("❌ Not in a team.", ephemeral=True)
+    if data.coins < TEAM_CHANNEL_RENT: return await interaction.response.send_message(f"❌ Need {TEAM_CHANNEL_RENT} coins.", ephemeral=True)
+    team = await col_teams.find_one({"_id": data.team_id})
     current_expiry = team.get("rent_expiry")
     now = datetime.now(timezone.utc)
     if current_expiry and current_expiry.tzinfo is None: current_expiry = current_expiry.replace(tzinfo=timezone.utc)
     if not current_expiry or current_expiry < now: new_expiry = now + timedelta(days=7)
     else: new_expiry = current_expiry + timedelta(days=7)
-    col_users.update_one({"_id": uid}, {"$inc": {"coins": -TEAM_CHANNEL_RENT}})
-    col_teams.update_one({"_id": data["team_id"]}, {"$set": {"rent_expiry": new_expiry}})
+    if await change_coins(uid, -TEAM_CHANNEL_RENT, "team_rent", data.team_id, guard=True) is None:
+        return await interaction.response.send_message(f"❌ Need {TEAM_CHANNEL_RENT} coins.", ephemeral=True)
+    await col_teams.update_one({"_id": data.team_id}, {"$set": {"rent_expiry": new_expiry}})
+    scheduler.schedule("team_rent", data.team_id, new_expiry)
     chan = interaction.guild.get_channel(team["channel_id"])
     if chan:
-        for mid in team["members"]:
-            mem = interaction.guild.get_member(mid)
-            if mem: await chan.set_permissions(mem, read_messages=True, send_messages=True)
+        members = (interaction.guild.get_member(mid) for mid in team["members"])
+        await set_overwrites(chan, {mem: discord.PermissionOverwrite(read_messages=True, send_messages=True) for mem in members if mem})
         await chan.send(f"✅ **Rent Paid!** Chat unlocked.\nExpires: <t:{int(new_expiry.timestamp())}:R>")
     await interaction.response.send_message(f"✅ Paid {TEAM_CHANNEL_RENT} coins.")
 
-class JoinTeamView(discord.ui.View):
-    def __init__(self, host_id):
-        super().__init__(timeout=1800)
-        self.host_id = host_id
-    @discord.ui.button(label="✋ Request to Join", style=discord.ButtonStyle.green)
-    async def request_join(self, interaction: discord.Interaction, button: discord.ui.Button):
-        if interaction.user.id == self.host_id: return await interaction.response.send_message("❌ Host.", ephemeral=True)
+class JoinTeamView(PersistentView):
+    kind = "findteam"
+    ttl = timedelta(minutes=30)
+    buttons = (("request_join", "✋ Request to Join", discord.ButtonStyle.green),)
+    async def request_join(self, interaction: discord.Interaction):
+        host_id = self.state["host_id"]
+        if interaction.user.id == host_id: return await interaction.response.send_message("❌ Host.", ephemeral=True)
         await interaction.response.send_message("✅ Sent!", ephemeral=True)
-        host = interaction.guild.get_member(self.host_id)
+        host = interaction.guild.get_member(host_id)
         if host:
             try:
-                view = AcceptTeamRequestView(interaction.user.id, interaction.guild)
+                view = await AcceptTeamRequestView.open(applicant_id=interaction.user.id, guild_id=interaction.guild.id)
                 await host.send(f"📩 **{interaction.user.name}** wants to join your team!", view=view)
             except: await interaction.channel.send(f"{host.mention}, **{interaction.user.name}** wants to join!")
 
-class AcceptTeamRequestView(discord.ui.View):
-    def __init__(self, applicant_id, guild):
-        super().__init__(timeout=300)
-        self.applicant_id = applicant_id
-        self.guild = guild
-    @discord.ui.button(label="✅ Accept (Create Room)", style=discord.ButtonStyle.green)
-    async def accept(self, interaction: discord.Interaction, button: discord.ui.Button):
-        applicant = self.guild.get_member(self.applicant_id)
-        if not applicant: return
-        cat = self.guild.get_channel(CAT_PRIVATE_ROOMS)
-        overwrites = {self.guild.default_role: discord.PermissionOverwrite(read_messages=False), interaction.user: discord.PermissionOverwrite(read_messages=True, send_messages=True), applicant: discord.PermissionOverwrite(read_messages=True, send_messages=True)}
-        chan = await self.guild.create_text_channel(f"team-{interaction.user.name[:5]}-{applicant.name[:5]}", category=cat, overwrites=overwrites)
-        await interaction.response.send_message(f"✅ Created: {chan.name}")
+class AcceptTeamRequestView(PersistentView):
+    kind = "teamreq"
+    buttons = (("accept", "✅ Accept (Create Room)", discord.ButtonStyle.green), ("deny", "❌ Deny", discord.ButtonStyle.red))
+    async def accept(self, interaction: discord.Interaction):
+        guild = bot.get_guild(self.state["guild_id"])
+        applicant = guild.get_member(self.state["applicant_id"]) if guild else None
+        if not applicant or not await view_states.claim(self.vid): return
+        await interaction.response.defer()
+        overwrites = {guild.default_role: discord.PermissionOverwrite(read_messages=False), interaction.user: discord.PermissionOverwrite(read_messages=True, send_messages=True), applicant: discord.PermissionOverwrite(read_messages=True, send_messages=True), guild.me: discord.PermissionOverwrite(read_messages=True)}
+        try: chan = await channel_pool.acquire(guild, f"team-{interaction.user.name[:5]}-{applicant.name[:5]}", overwrites)
+        except discord.HTTPException:
+            await view_states.unclaim(self.vid)
+            return await interaction.followup.send("❌ Couldn't open a room. Try again.", ephemeral=True)
+        await interaction.followup.send(f"✅ Created: {chan.name}")
         await chan.send(f"👋 **Team Up!**\n{interaction.user.mention} 🤝 {applicant.mention}")
-        self.stop()
-    @discord.ui.button(label="❌ Deny", style=discord.ButtonStyle.red)
-    async def deny(self, interaction, button): await interaction.response.send_message("🚫 Denied.", ephemeral=True); self.stop()
+        await view_states.close(self.vid)
+    async def deny(self, interaction: discord.Interaction):
+        await interaction.response.send_message("🚫 Denied.", ephemeral=True)
+        await view_states.close(self.vid)
 
 @bot.tree.command(name="findteam", description="Find a team")
 async def findteam(interaction: discord.Interaction, role: str, level: str):
-    if interaction.channel.id != CH_FIND_TEAM: return await interaction.response.send_message(f"❌ Use <#{CH_FIND_TEAM}>", ephemeral=True)
+    find_channel = cfg(interaction.guild).find_team
+    if interaction.channel.id != find_channel: return await interaction.response.send_message(f"❌ Use {channel_ref(find_channel)}", ephemeral=True)
     embed = discord.Embed(title="🎮 Looking for Team", color=discord.Color.orange())
     embed.add_field(name="Player", value=interaction.user.mention, inline=True)
     embed.add_field(name="Role", value=role, inline=True)
     embed.add_field(name="Level", value=level, inline=True)
     embed.set_footer(text="Click to request join")
-    msg = await interaction.channel.send(embed=embed, view=JoinTeamView(interaction.user.id))
+    msg = await interaction.channel.send(embed=embed, view=await JoinTeamView.open(host_id=interaction.user.id))
     await interaction.response.send_message("✅ Posted.", ephemeral=True)
     # Store for cleanup
-    col_requests.insert_one({"message_id": msg.id, "channel_id": msg.channel.id, "expires_at": datetime.now(timezone.utc) + timedelta(days=1), "host_id": interaction.user.id, "price": 0})
+    req = {"message_id": msg.id, "channel_id": msg.channel.id, "guild_id": interaction.guild.id, "expires_at": datetime.now(timezone.utc) + timedelta(days=1), "host_id": interaction.user.id, "price": 0}
+    await col_requests.insert_one(req)
+    scheduler.schedule("request", req["_id"], req["expires_at"])
 
 @bot.event
 async def on_message(message):
     if message.author.bot: return
     # STRICT CHANNEL CLEANER
-    if not is_admin(message.author.id):
-        if message.channel.id == CH_FIND_TEAM:
+    conf = cfg(message.guild)
+    if not is_admin(message.author.id, message.guild):
+        if message.channel.id == conf.find_team:
             await message.delete()
-            msg = await message.channel.send(f"{message.author.mention} ❌ Only use `/findteam` here! [Auto-deletes]")
-            await asyncio.sleep(5)
-            await msg.delete()
+            await message.channel.send(f"{message.author.mention} ❌ Only use `/findteam` here! [Auto-deletes]", delete_after=5)
             return
-        if message.channel.id == CH_FF_BET:
+        if message.channel.id == conf.ff_bet:
             await message.delete()
-            msg = await message.channel.send(f"{message.author.mention} ❌ Only use `/challenge` here!")
-            await asyncio.sleep(5)
-            await msg.delete()
+            await message.channel.send(f"{message.author.mention} ❌ Only use `/challenge` here!", delete_after=5)
             return
-        if message.channel.id == CH_WEEKLY_LB:
+        if message.channel.id == conf.weekly_lb:
             await message.delete()
-            msg = await message.channel.send(f"{message.author.mention} ❌ Only use `/leaderboard` here!")
-            await asyncio.sleep(5)
-            await msg.delete()
+            await message.channel.send(f"{message.author.mention} ❌ Only use `/leaderboard` here!", delete_after=5)
             return
 
     # Vouch
-    pending = col_vouch.find_one({"channel_id": message.channel.id, "user_id": message.author.id})
+    pending = None
+    if router.is_vouch(message.channel.id, message.author.id) or getattr(message.channel, "name", "").startswith(VOUCH_CHANNEL_PREFIXES):
+        pending = await col_vouch.find_one({"channel_id": message.channel.id, "user_id": message.author.id})
+        if pending: router.add_vouch(message.channel.id, message.author.id)
+        else: router.remove_vouch(message.channel.id, message.author.id)
     if pending:
         if re.match(r"^\[.+\]\s+i got\s+.+,\s*thanks\s+(@admin|<@!?\d+>|<@&\d+>)$", message.content, re.IGNORECASE):
             await message.add_reaction("✅")
-            col_vouch.delete_one({"_id": pending["_id"]})
-            if bot.get_channel(CH_VOUCH_LOG): await bot.get_channel(CH_VOUCH_LOG).send(f"✅ {message.author.name} vouched for `{pending['service']}`")
-            await asyncio.sleep(5)
-            await message.channel.delete()
+            await col_vouch.delete_one({"_id": pending["_id"]})
+            router.remove_vouch(message.channel.id, message.author.id)
+            scheduler.cancel("vouch", pending["_id"])
+            vouch_log = message.guild.get_channel(conf.vouch_log or 0) if message.guild else None
+            if vouch_log: await vouch_log.send(f"✅ {message.author.name} vouched for `{pending['service']}`")
+            await jobs.enqueue("delete_channel", delay=5, key=f"delete:{message.channel.id}", local=True, channel_id=message.channel.id)
         else:
             await message.delete()
             await message.channel.send("❌ Format: `[CODE] I got SERVICE, thanks @admin`", delete_after=5)
 
     # Match game confirmation
-    match = col_matches.find_one({"channel_id": message.channel.id})
-    if match and match.get("status") == "pending_game_name" and "free fire" in message.content.lower():
-        col_matches.update_one({"_id": match["_id"]}, {"$set": {"status": "playing"}})
+    if router.match_status(message.channel.id) == "pending_game_name" and "free fire" in message.content.lower():
+        await col_matches.update_one({"channel_id": message.channel.id, "status": "pending_game_name"}, {"$set": {"status": "playing"}})
+        router.add_match(message.channel.id, "playing")
         await message.channel.send("✅ Match Started!")
 
     await bot.process_commands(message)
 
-bot.run(TOKEN)
+if __name__ == "__main__":
+    bot.run(TOKEN)